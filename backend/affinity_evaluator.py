@@ -1,7 +1,46 @@
 import re
-import requests
+import os
 import json
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, List, Tuple
+from http_client import http_client_pool
+from response_formatter import clamp_affinity_change
+from affinity_scorer import local_affinity_scorer
+
+# 好感度評估模式：
+# "separate" - 回覆完成後另外呼叫一次模型評估（預設）
+# "inline" - 由主要的生成請求同時輸出好感度變化，省去一次請求
+AFFINITY_MODE = os.getenv("AFFINITY_MODE", "separate").lower()
+
+def build_inline_affinity_instruction(character: Dict[str, Any], current_affinity: int, 
+                                      output_format: str) -> str:
+    """
+    構建要求模型在回覆中一併輸出好感度變化的提示詞
+    
+    參數:
+        character: 角色設定
+        current_affinity: 當前好感度
+        output_format: "json" 要求輸出 JSON 物件，"tool" 要求呼叫 reply_with_affinity 工具，
+                       "trailer" 要求在回覆結尾附加 [[affinity:+N]] 標記
+        
+    返回:
+        附加到提示詞結尾的指示文本
+    """
+    instruction = f"""
+
+好感度評估（僅供系統使用，用戶不會看到）：
+目前 {character['name']} 對用戶的好感度為 {current_affinity}/100。請同時評估這次對話後好感度的變化（介於 -5 到 +5 之間的整數），考慮：
+1. 用戶的態度是否友善、尊重
+2. 用戶的回應是否符合 {character['name']} 的喜好或特性
+3. 對話是否融洽、有趣或深入
+"""
+    if output_format == "json":
+        instruction += '請以 JSON 物件回覆，包含 "reply"（你以角色身份的完整回覆，遵循上述所有格式要求）和 "affinity_change"（好感度變化的整數）兩個欄位。'
+    elif output_format == "tool":
+        instruction += '請使用 reply_with_affinity 工具回覆：在 "reply" 中填入你以角色身份的完整回覆（遵循上述所有格式要求），在 "affinity_change" 中填入好感度變化的整數。'
+    else:
+        instruction += "完成角色回覆後，在最後另起一行只寫上好感度標記，例如 [[affinity:+2]] 或 [[affinity:-1]]，不要做任何解釋。"
+    return instruction
 
 class AffinityEvaluator:
     """
@@ -10,12 +49,236 @@ class AffinityEvaluator:
     
     def __init__(self):
         """初始化好感度評估器"""
-        self.gemini_api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+        gemini_api_base = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+        self.gemini_api_url = f"{gemini_api_base}/v1beta/models/gemini-1.5-flash:generateContent"
+        
+        # 是否由主要生成請求內嵌輸出好感度變化
+        self.inline_mode = AFFINITY_MODE == "inline"
+        
+        # 本地評分器：信心值達到門檻時不呼叫模型
+        self.local_scorer_enabled = os.getenv("AFFINITY_LOCAL_SCORER", "true").lower() == "true"
+        self.local_threshold = float(os.getenv("AFFINITY_LOCAL_THRESHOLD", "0.75"))
+        
+        # 批次評估：在短時間窗口內收集待評估的回合，以一次請求評估多個
+        self.batch_enabled = os.getenv("AFFINITY_BATCH_ENABLED", "true").lower() == "true"
+        self.batch_window = float(os.getenv("AFFINITY_BATCH_WINDOW_MS", "200")) / 1000
+        self.batch_size = int(os.getenv("AFFINITY_BATCH_SIZE", "16"))
+        
+        # 每個API密鑰各自排隊（不同用戶的密鑰不能混在同一個請求中）
+        self._batch_queues = {}  # API密鑰 -> [(評估項目, Future)]
+        self._batch_timers = {}  # API密鑰 -> 窗口計時任務
+        self._batch_tasks = set()  # 執行中的批次評估任務
+        
+        # 統計本地解決和交給模型評估的回合數，用於調整門檻
+        self._stats = {
+            "local": 0,
+            "escalated": 0,
+            "batches": 0,
+            "batched_turns": 0
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        獲取好感度評估的統計數據
+        
+        返回:
+            本地解決和交給模型評估的回合數、本地解決比例及目前門檻
+        """
+        total = self._stats["local"] + self._stats["escalated"]
+        return {
+            **self._stats,
+            "total": total,
+            "local_ratio": self._stats["local"] / total if total else 0.0,
+            "local_threshold": self.local_threshold,
+            "local_scorer_enabled": self.local_scorer_enabled,
+            "avg_batch_size": self._stats["batched_turns"] / self._stats["batches"] if self._stats["batches"] else 0.0,
+            "pending_batch_turns": sum(len(queue) for queue in self._batch_queues.values())
+        }
     
     async def evaluate_affinity_change(self, api_key: str, character: Dict[str, Any], 
                                     user_message: str, ai_reply: str, current_affinity: int) -> int:
         """
-        評估對話內容對好感度的影響
+        評估對話內容對好感度的影響（先嘗試本地評分，信心不足時才呼叫模型）
+        
+        參數:
+            api_key: API密鑰
+            character: 角色設定
+            user_message: 用戶消息
+            ai_reply: AI回覆
+            current_affinity: 當前好感度
+            
+        返回:
+            好感度變化值（-5到+5之間的整數）
+        """
+        if self.local_scorer_enabled:
+            change, confidence = local_affinity_scorer.score(character, user_message)
+            if confidence >= self.local_threshold:
+                self._stats["local"] += 1
+                return change
+        
+        self._stats["escalated"] += 1
+        if self.batch_enabled:
+            return await self._enqueue_batch(api_key, character, user_message, ai_reply, current_affinity)
+        return await self._evaluate_with_llm(api_key, character, user_message, ai_reply, current_affinity)
+    
+    async def _enqueue_batch(self, api_key: str, character: Dict[str, Any], 
+                             user_message: str, ai_reply: str, current_affinity: int) -> int:
+        """
+        將回合加入批次隊列，等待批次評估結果
+        
+        返回:
+            好感度變化值
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._batch_queues.setdefault(api_key, [])
+        queue.append(((character, user_message, ai_reply, current_affinity), future))
+        
+        if len(queue) >= self.batch_size:
+            # 隊列已滿，立即送出
+            self._flush_batch(api_key)
+        elif api_key not in self._batch_timers:
+            self._batch_timers[api_key] = asyncio.create_task(self._flush_after_window(api_key))
+        
+        return await future
+    
+    async def _flush_after_window(self, api_key: str) -> None:
+        """等待批次窗口結束後送出隊列"""
+        await asyncio.sleep(self.batch_window)
+        self._batch_timers.pop(api_key, None)
+        self._flush_batch(api_key)
+    
+    def _flush_batch(self, api_key: str) -> None:
+        """取出隊列中的項目並在後台執行批次評估"""
+        timer = self._batch_timers.pop(api_key, None)
+        if timer and timer is not asyncio.current_task():
+            timer.cancel()
+        
+        queue = self._batch_queues.pop(api_key, [])
+        if queue:
+            task = asyncio.create_task(self._run_batch(api_key, queue))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _run_batch(self, api_key: str, queue: List[Tuple[tuple, asyncio.Future]]) -> None:
+        """執行批次評估並將結果分發給各個等待者"""
+        self._stats["batches"] += 1
+        self._stats["batched_turns"] += len(queue)
+        
+        try:
+            if len(queue) == 1:
+                (character, user_message, ai_reply, current_affinity), _ = queue[0]
+                changes = [await self._evaluate_with_llm(api_key, character, user_message, ai_reply, current_affinity)]
+            else:
+                changes = await self._evaluate_batch_with_llm(api_key, [item for item, _ in queue])
+        except Exception as e:
+            print(f"批次評估好感度時發生錯誤: {str(e)}")
+            changes = [0] * len(queue)
+        
+        for (_, future), change in zip(queue, changes):
+            if not future.done():
+                future.set_result(change)
+    
+    async def _evaluate_batch_with_llm(self, api_key: str, items: List[tuple]) -> List[int]:
+        """
+        以一次模型請求評估多個回合的好感度變化
+        
+        參數:
+            api_key: API密鑰
+            items: [(角色設定, 用戶消息, AI回覆, 當前好感度)]
+            
+        返回:
+            與 items 順序相同的好感度變化列表（無法解析的項目為 0）
+        """
+        sections = []
+        for index, (character, user_message, ai_reply, current_affinity) in enumerate(items):
+            sections.append(f"""[{index}]
+角色: {character['name']}（喜好: {character.get('likes', '未設定')}；厭惡: {character.get('dislikes', '未設定')}）
+當前好感度: {current_affinity}/100
+用戶訊息: {user_message}
+{character['name']} 的回應: {ai_reply}""")
+        
+        eval_prompt = f"""以下是 {len(items)} 段互相獨立的對話，請分別以對話中角色的立場評估每段對話的好感度變化。
+
+""" + "\n\n".join(sections) + """
+
+每段對話的好感度變化是一個介於 -5 到 +5 之間的整數，正數表示好感增加，負數表示好感下降。
+請考慮:
+1. 用戶的態度是否友善、尊重
+2. 用戶的回應是否符合角色的喜好或特性
+3. 對話是否融洽、有趣或深入
+
+請以 JSON 陣列回覆，每段對話一個物件，例如 [{"index": 0, "change": 2}, {"index": 1, "change": -1}]。不要提供任何解釋。"""
+        
+        payload = {
+            "contents": [
+                {
+                    "parts": [
+                        {
+                            "text": eval_prompt
+                        }
+                    ]
+                }
+            ],
+            "generationConfig": {
+                "temperature": 0.1,
+                "topP": 0.95,
+                "topK": 40,
+                "responseMimeType": "application/json",
+                "responseSchema": {
+                    "type": "ARRAY",
+                    "items": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "index": {"type": "INTEGER"},
+                            "change": {"type": "INTEGER"}
+                        },
+                        "required": ["index", "change"]
+                    }
+                }
+            }
+        }
+        
+        headers = {"Content-Type": "application/json"}
+        changes = [0] * len(items)
+        
+        api_url = f"{self.gemini_api_url}?key={api_key}"
+        response = await http_client_pool.post(api_url, headers=headers, json=payload)
+        
+        if response.status_code != 200:
+            print(f"批次好感度評估 API 錯誤: {response.text}")
+            return changes
+        
+        result = response.json()
+        change_text = result["candidates"][0]["content"]["parts"][0]["text"]
+        
+        try:
+            entries = json.loads(change_text)
+        except ValueError:
+            print(f"無法解析批次好感度評估結果: {change_text[:200]}")
+            return changes
+        
+        for entry in entries if isinstance(entries, list) else []:
+            try:
+                index = int(entry["index"])
+                if 0 <= index < len(items):
+                    changes[index] = clamp_affinity_change(int(entry["change"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+        
+        print(f"批次評估 {len(items)} 個回合的好感度變化: {changes}")
+        return changes
+    
+    async def close(self) -> None:
+        """立即送出所有等待中的批次並等待完成（關閉應用時呼叫）"""
+        for api_key in list(self._batch_queues.keys()):
+            self._flush_batch(api_key)
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+    
+    async def _evaluate_with_llm(self, api_key: str, character: Dict[str, Any], 
+                                 user_message: str, ai_reply: str, current_affinity: int) -> int:
+        """
+        使用模型評估對話內容對好感度的影響
         
         參數:
             api_key: API密鑰
@@ -67,7 +330,7 @@ class AffinityEvaluator:
         try:
             # 發送評估請求
             api_url = f"{self.gemini_api_url}?key={api_key}"
-            response = requests.post(api_url, headers=headers, json=payload)
+            response = await http_client_pool.post(api_url, headers=headers, json=payload)
             
             if response.status_code != 200:
                 print(f"好感度評估 API 錯誤: {response.text}")
@@ -80,10 +343,8 @@ class AffinityEvaluator:
             # 從回應中提取數字
             matches = re.findall(r'[+-]?\d+', change_text)
             if matches:
-                change = int(matches[0])
                 # 限制變化範圍在 -5 到 +5 之間
-                change = max(-5, min(5, change))
-                return change
+                return clamp_affinity_change(int(matches[0]))
             else:
                 return 0  # 如果無法解析數字，不改變好感度
                 
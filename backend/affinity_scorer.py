@@ -0,0 +1,214 @@
+import re
+from typing import Dict, Any, List, Tuple
+from response_formatter import clamp_affinity_change
+
+# 禮貌、友善的詞彙及其權重（中文與英文）
+POLITE_TERMS = {
+    "謝謝": 1.0, "感謝": 1.0, "多謝": 1.0, "謝啦": 1.0, "辛苦了": 1.0,
+    "請問": 0.5, "麻煩你": 0.5, "不好意思": 0.5, "抱歉": 0.5, "對不起": 0.5,
+    "你好": 0.5, "哈囉": 0.5, "嗨": 0.5, "早安": 0.5, "午安": 0.5, "晚安": 0.5,
+    "喜歡你": 2.0, "愛你": 2.0, "想你": 1.5, "好可愛": 1.5, "好棒": 1.0, "好厲害": 1.0,
+    "真好": 1.0, "開心": 0.5, "陪你": 1.0, "關心": 1.0, "加油": 0.5,
+    "thank": 1.0, "thanks": 1.0, "thx": 1.0, "appreciate": 1.0, "please": 0.5,
+    "sorry": 0.5, "hello": 0.5, "hi": 0.5, "hey": 0.5, "good morning": 0.5, "good night": 0.5,
+    "love you": 2.0, "miss you": 1.5, "cute": 1.0, "awesome": 1.0, "amazing": 1.0, "great": 0.5,
+}
+
+# 敵意、不尊重的詞彙及其權重（中文與英文）
+# 單字（例如 幹、滾、蠢、醜）和 無聊 在一般用語中很常見（幹嘛、能幹、滾燙、我好無聊），
+# 只收錄帶上下文、明確針對對方的詞組
+HOSTILE_TERMS = {
+    "笨蛋": 1.5, "白痴": 2.0, "白癡": 2.0, "智障": 2.5, "廢物": 2.5, "垃圾": 2.0,
+    "好蠢": 1.5, "很蠢": 1.5, "真蠢": 1.5, "蠢貨": 2.0, "蠢蛋": 2.0,
+    "閉嘴": 2.0, "滾開": 2.0, "給我滾": 2.0, "滾出去": 2.0, "去死": 3.0, "討厭你": 2.0, "恨你": 2.5,
+    "煩死": 1.5, "噁心": 2.0, "你好無聊": 1.0, "你很無聊": 1.0, "你真無聊": 1.0,
+    "好醜": 1.5, "很醜": 1.5, "真醜": 1.5, "醜八怪": 2.0, "幹你": 2.5, "靠北": 2.0, "走開": 1.5, "少囉嗦": 1.5,
+    "idiot": 2.0, "stupid": 1.5, "dumb": 1.5, "shut up": 2.0, "hate you": 2.0, "you're ugly": 1.5,
+    "you are ugly": 1.5, "trash": 2.0, "loser": 2.0, "go away": 1.5, "you're boring": 1.0,
+    "you are boring": 1.0, "fuck": 2.5, "screw you": 2.5,
+}
+
+# 極性取決於上下文的字詞：沒有命中其他詞彙時，即使訊息很短也交給模型判斷
+AMBIGUOUS_PATTERN = re.compile(r"幹|滾|蠢|醜|無聊|\b(?:ugly|boring)\b", re.IGNORECASE)
+
+# 否定詞：與命中詞彙出現在同一個子句時（不論位置），極性無法確定（排除 特別、別人 之類的詞）
+NEGATION_PATTERN = re.compile(
+    r"不|沒|(?<![特分區差告離類級])別(?!人)|\b(?:not|no|never|don't|doesn't|didn't|isn't|aren't|wasn't|won't|can't)\b", re.IGNORECASE
+)
+
+# 子句的分隔符，否定詞只影響同一個子句中的詞彙
+CLAUSE_SEPARATORS = re.compile(r"[，。！？；,.!?;\n]+")
+
+# 只命中一個詞彙時的信心值，低於預設門檻（交給模型判斷）；每多命中一個詞彙增加 CONFIDENCE_PER_HIT
+SINGLE_HIT_CONFIDENCE = 0.6
+CONFIDENCE_PER_HIT = 0.15
+
+# 只有一個禮貌或敵意詞彙的短訊息（例如 "hi"、"謝謝"）的信心值，達到預設門檻
+SHORT_HIT_CONFIDENCE = 0.8
+
+# 上述短訊息中，詞彙以外（不計空白和標點）最多允許的字元數（例如 "謝謝你" 的 "你"）
+SHORT_HIT_EXTRA_CHARS = 2
+
+# 計算詞彙以外的字元時忽略的空白、標點和表情符號
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+# 沒有情感詞彙、可以直接判定為不變的短訊息長度
+TRIVIAL_MESSAGE_LENGTH = 6
+
+# 超過此長度的訊息通常語意較複雜，降低信心
+LONG_MESSAGE_LENGTH = 80
+
+# 角色喜好/厭惡欄位的分隔符
+PREFERENCE_SEPARATORS = re.compile(r"[、,，;；/|\n]+|\s+和\s+|\s+及\s+")
+
+def _compile_terms(terms) -> re.Pattern:
+    """將詞彙編譯成單一的正則表達式（英文詞彙加上單詞邊界）"""
+    parts = []
+    # 先匹配較長的詞彙，避免 "hi" 搶先匹配 "hi there" 之類的片語
+    for term in sorted(terms, key=len, reverse=True):
+        escaped = re.escape(term)
+        if term.isascii():
+            escaped = rf"\b{escaped}\b"
+        parts.append(escaped)
+    return re.compile("|".join(parts), re.IGNORECASE)
+
+class LocalAffinityScorer:
+    """
+    以詞彙和規則在本地評估好感度變化
+
+    對於明確的回合（例如 "謝謝你，辛苦了"、"閉嘴，笨蛋"）可以在微秒內給出結果，
+    同時返回信心值，信心不足時（只命中一個詞彙、帶否定詞、正負並存）由 AffinityEvaluator 交給模型評估；
+    只有一個詞彙而沒有其他內容的短訊息（例如 "hi"、"謝謝"）例外，直接在本地判定。
+    """
+
+    def __init__(self):
+        """初始化評分器並預先編譯詞彙"""
+        self._polite_pattern = _compile_terms(POLITE_TERMS)
+        self._hostile_pattern = _compile_terms(HOSTILE_TERMS)
+        self._polite_weights = {term.lower(): weight for term, weight in POLITE_TERMS.items()}
+        self._hostile_weights = {term.lower(): weight for term, weight in HOSTILE_TERMS.items()}
+
+        # 角色喜好/厭惡關鍵詞的緩存：(喜好文本, 厭惡文本) -> (喜好模式, 厭惡模式)
+        self._preference_cache = {}
+
+    def _split_preferences(self, text: Any) -> List[str]:
+        """將角色的喜好或厭惡欄位拆分成關鍵詞"""
+        if not text or not isinstance(text, str) or text in ("未設定", "未知"):
+            return []
+        return [keyword.strip() for keyword in PREFERENCE_SEPARATORS.split(text) if len(keyword.strip()) >= 2]
+
+    def _get_preference_patterns(self, character: Dict[str, Any]):
+        """獲取角色喜好/厭惡關鍵詞的已編譯模式"""
+        key = (character.get("likes"), character.get("dislikes"))
+        patterns = self._preference_cache.get(key)
+        if patterns is None:
+            likes = self._split_preferences(key[0])
+            dislikes = self._split_preferences(key[1])
+            patterns = (
+                _compile_terms(likes) if likes else None,
+                _compile_terms(dislikes) if dislikes else None
+            )
+            self._preference_cache[key] = patterns
+        return patterns
+
+    def _match(self, pattern: re.Pattern, message: str, weights: Dict[str, float] = None) -> Tuple[float, List[Tuple[int, int]]]:
+        """
+        計算匹配的權重總和
+
+        返回:
+            (權重總和, 各匹配的位置 (start, end) 列表)
+        """
+        total = 0.0
+        spans = []
+        for match in pattern.finditer(message):
+            spans.append(match.span())
+            total += weights.get(match.group(0).lower(), 1.0) if weights else 1.0
+        return total, spans
+
+    def _is_negated(self, message: str, spans: List[Tuple[int, int]]) -> bool:
+        """
+        檢查是否有命中的詞彙與否定詞出現在同一個子句（例如 "我不喜歡咖啡"、"not really a great day"）
+
+        詞彙本身包含的否定字（例如 不好意思、對不起）不算在內。
+        """
+        # 把命中的詞彙換成空白，避免詞彙中的字被當成否定詞
+        masked = list(message)
+        for start, end in spans:
+            masked[start:end] = " " * (end - start)
+        masked = "".join(masked)
+
+        clause_start = 0
+        for separator in list(CLAUSE_SEPARATORS.finditer(masked)) + [None]:
+            clause_end = separator.start() if separator else len(masked)
+            has_hit = any(start < clause_end and end > clause_start for start, end in spans)
+            if has_hit and NEGATION_PATTERN.search(masked, clause_start, clause_end):
+                return True
+            clause_start = separator.end() if separator else clause_end
+        return False
+
+    def _is_bare_hit(self, message: str, span: Tuple[int, int]) -> bool:
+        """檢查訊息是否幾乎只有命中的詞彙（其餘部分不超過 SHORT_HIT_EXTRA_CHARS 個字元，且沒有極性不明的字詞）"""
+        start, end = span
+        rest = NON_WORD_PATTERN.sub("", message[:start] + " " + message[end:])
+        return len(rest) <= SHORT_HIT_EXTRA_CHARS and not AMBIGUOUS_PATTERN.search(rest)
+
+    def score(self, character: Dict[str, Any], user_message: str) -> Tuple[int, float]:
+        """
+        評估用戶訊息對好感度的影響
+
+        參數:
+            character: 角色設定
+            user_message: 用戶消息
+
+        返回:
+            (好感度變化, 信心值 0-1)
+        """
+        message = user_message.strip()
+        if not message:
+            return 0, 1.0
+
+        positive, positive_spans = self._match(self._polite_pattern, message, self._polite_weights)
+        negative, negative_spans = self._match(self._hostile_pattern, message, self._hostile_weights)
+
+        lexicon_spans = positive_spans + negative_spans
+
+        # 提到角色喜歡或討厭的事物
+        likes_pattern, dislikes_pattern = self._get_preference_patterns(character)
+        if likes_pattern:
+            weight, spans = self._match(likes_pattern, message)
+            positive += weight
+            positive_spans += spans
+        if dislikes_pattern:
+            weight, spans = self._match(dislikes_pattern, message)
+            negative += weight
+            negative_spans += spans
+        positive_count = len(positive_spans)
+        negative_count = len(negative_spans)
+
+        # 沒有任何情感訊號
+        if positive_count == 0 and negative_count == 0:
+            if len(message) <= TRIVIAL_MESSAGE_LENGTH and not AMBIGUOUS_PATTERN.search(message):
+                return 0, 0.8
+            return 0, 0.2
+
+        # 正負訊號並存或帶否定詞，交給模型判斷
+        if (positive_count and negative_count) or self._is_negated(message, positive_spans + negative_spans):
+            return clamp_affinity_change(round(positive - negative)), 0.3
+
+        change = clamp_affinity_change(round(positive - negative))
+        if change == 0:
+            # 微弱的訊號（例如單獨的 "hi"）視為友善的小幅提升
+            change = 1 if positive_count else -1
+
+        # 只有一個詞彙、沒有其他內容的短訊息（打招呼、道謝）沒有可以改變語意的語境
+        if positive_count + negative_count == 1 and len(lexicon_spans) == 1 and self._is_bare_hit(message, lexicon_spans[0]):
+            return change, SHORT_HIT_CONFIDENCE
+
+        # 單一詞彙容易因語境而判斷錯誤，至少命中兩個才可能達到門檻
+        confidence = min(0.95, SINGLE_HIT_CONFIDENCE + CONFIDENCE_PER_HIT * (positive_count + negative_count - 1))
+        if len(message) > LONG_MESSAGE_LENGTH:
+            confidence -= 0.25
+        return change, confidence
+
+# 創建單例實例
+local_affinity_scorer = LocalAffinityScorer()
@@ -0,0 +1,84 @@
+import sys
+import time
+import random
+from keyword_matcher import KeywordMatcher, load_lexicon
+
+# 常用漢字，用於產生測試對話和額外的關鍵詞
+HANZI = "的一是不了人我在有他這中大來上個國到說們為子和你地出道也時年得就那要下以生會自著去之過家學對可她裡後小麼心多天而能好都然沒日於起還發成事只作當想看文無開手十用主行方又如前所本見經頭面公同三已老從動兩長"
+
+def build_corpus(conversations: int, messages: int, seed: int = 7) -> list:
+    """
+    產生長對話記錄：每條用戶消息約 80 到 200 字，少數包含內建詞庫的關鍵詞
+
+    參數:
+        conversations: 對話數
+        messages: 每段對話的消息數
+
+    返回:
+        用戶消息列表
+    """
+    rng = random.Random(seed)
+    phrases = ["我叫小明，", "我喜歡下雨天的咖啡廳。", "明天要去面試！", "My name is Alex. ", "I love cats, "]
+    corpus = []
+    for _ in range(conversations * messages):
+        text = "".join(rng.choice(HANZI) for _ in range(rng.randint(80, 200)))
+        if rng.random() < 0.2:
+            position = rng.randint(0, len(text))
+            text = text[:position] + rng.choice(phrases) + text[position:]
+        corpus.append(text)
+    return corpus
+
+def grow_lexicon(lexicon: dict, total: int, seed: int = 11) -> dict:
+    """在內建詞庫之外加入隨機的二到四字關鍵詞，直到共有 total 個"""
+    rng = random.Random(seed)
+    grown = {
+        category: {"template": config["template"], "patterns": {lang: list(items) for lang, items in config["patterns"].items()}}
+        for category, config in lexicon.items()
+    }
+    categories = list(grown)
+    count = sum(len(items) for config in grown.values() for items in config["patterns"].values())
+    while count < total:
+        pattern = "".join(rng.choice(HANZI) for _ in range(rng.randint(2, 4)))
+        grown[categories[count % len(categories)]]["patterns"].setdefault("generated", []).append(pattern)
+        count += 1
+    return grown
+
+def naive_scan(lexicon: dict, text: str) -> int:
+    """原本的做法：對每個關鍵詞各做一次子字串搜尋（返回命中的關鍵詞數）"""
+    lowered = text.lower()
+    hits = 0
+    for config in lexicon.values():
+        for patterns in config["patterns"].values():
+            for pattern in patterns:
+                if pattern.lower() in lowered:
+                    hits += 1
+    return hits
+
+def measure(scan, corpus: list) -> float:
+    """返回每條消息的平均耗時（微秒）"""
+    start = time.perf_counter()
+    for text in corpus:
+        scan(text)
+    return (time.perf_counter() - start) / len(corpus) * 1_000_000
+
+def run_benchmark(conversations: int = 50, messages: int = 100):
+    """比較逐個關鍵詞搜尋與自動機單次掃描在不同詞庫大小下的耗時"""
+    corpus = build_corpus(conversations, messages)
+    base = load_lexicon()
+    average_length = sum(len(text) for text in corpus) / len(corpus)
+    print(f"{len(corpus)} 條用戶消息（{conversations} 段對話，平均 {average_length:.0f} 字）\n")
+    print(f"{'關鍵詞數':<10}{'逐個搜尋 (µs)':>16}{'自動機 (µs)':>14}{'擷取片段 (µs)':>16}{'編譯 (ms)':>12}")
+
+    for size in (30, 300, 3000, 10000):
+        lexicon = grow_lexicon(base, size)
+        start = time.perf_counter()
+        matcher = KeywordMatcher(lexicon)
+        compile_ms = (time.perf_counter() - start) * 1000
+
+        naive = measure(lambda text: naive_scan(lexicon, text), corpus)
+        automaton = measure(matcher.find, corpus)
+        extract = measure(matcher.extract, corpus)
+        print(f"{matcher.pattern_count:<10}{naive:>16.2f}{automaton:>14.2f}{extract:>16.2f}{compile_ms:>12.1f}")
+
+if __name__ == "__main__":
+    run_benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,99 @@
+import sys
+import time
+import random
+import asyncio
+from db_pool import db_pool
+from memory_manager import memory_manager
+from migrate import run_migrations
+
+# 需要設定 DATABASE_URL 指向可寫入的 PostgreSQL；測試資料使用獨立的用戶ID，結束後刪除
+BENCHMARK_USER = "benchmark_memory_user"
+MEMORY_TYPES = ("personal_info", "preferences", "important_events")
+
+# 用於產生內容各不相同的記憶（內容相近的記憶會被近似去重合併，見 memory_dedup.py）
+HANZI = "的一是不了人我在有他這中大來上個國到說們為子和你地出道也時年得就那要下以生會自著去之過家學對可她裡後小麼心多天而能好都然沒日於起還發成事只作當想看文無開手十用主行方又如前所本見經頭面公同三已老從動兩長"
+
+def memory_text(i: int, version: int) -> str:
+    """第 i 條記憶在某個版本的內容（約三十個字，不同項目之間幾乎沒有共同的字）"""
+    rng = random.Random(i * 1000 + version)
+    return "".join(rng.choice(HANZI) for _ in range(30))
+
+def build_memory(size: int, turn: int) -> dict:
+    """
+    產生一段對話的記憶，每個回合約有 5% 的項目被替換
+
+    參數:
+        size: 記憶總數
+        turn: 回合編號
+
+    返回:
+        記憶字典
+    """
+    changed = max(1, size // 20)
+    memory = {memory_type: [] for memory_type in MEMORY_TYPES}
+    for i in range(size):
+        # 前 changed 條每回合都換成新內容，其餘保持不變
+        version = turn if i < changed else 0
+        memory[MEMORY_TYPES[i % 3]].append(memory_text(i, version))
+    return memory
+
+async def legacy_update(user_id: str, character_id: str, memory: dict) -> int:
+    """原本的寫入方式：重新讀取所有記憶，逐條插入和刪除（返回資料庫往返次數）"""
+    round_trips = 1
+    async with db_pool.acquire() as conn, conn.transaction():
+        current = {}
+        for row in await conn.fetch(
+            "SELECT id, memory_type, content FROM memories WHERE user_id = $1 AND character_id = $2",
+            user_id, character_id
+        ):
+            current.setdefault(row["memory_type"], {})[row["content"]] = row["id"]
+        for memory_type, items in memory.items():
+            existing = current.get(memory_type, {})
+            for item in items:
+                if item not in existing:
+                    await conn.execute(
+                        "INSERT INTO memories (user_id, character_id, memory_type, content) VALUES ($1, $2, $3, $4)",
+                        user_id, character_id, memory_type, item
+                    )
+                    round_trips += 1
+            for item in set(existing) - set(items):
+                await conn.execute("DELETE FROM memories WHERE id = $1", existing[item])
+                round_trips += 1
+    return round_trips
+
+async def measure(update, character_id: str, size: int, turns: int) -> float:
+    """返回每次更新的平均耗時（毫秒），第 0 回合的初次寫入和產生測試資料的時間不計入"""
+    memories = [build_memory(size, turn) for turn in range(turns + 1)]
+    await update(BENCHMARK_USER, character_id, memories[0])
+    start = time.perf_counter()
+    for memory in memories[1:]:
+        await update(BENCHMARK_USER, character_id, memory)
+    return (time.perf_counter() - start) / turns * 1000
+
+async def run_benchmark(turns: int = 20):
+    """比較逐條寫入與集合式寫入在不同記憶數量下的耗時"""
+    await db_pool.start()
+    if not db_pool.available:
+        print("無法連接資料庫，請設定 DATABASE_URL")
+        return
+    await run_migrations()
+    # 測量的是寫入本身，容量上限放寬到最大的記憶數，避免每次更新都觸發淘汰
+    memory_manager.max_entries = memory_manager.max_entries_per_type = 1000
+
+    print(f"每種記憶數量執行 {turns} 次更新（每次替換約 5% 的項目）")
+    print("本機資料庫的往返延遲接近 0；經由網路連接時，逐條寫入每多一次往返就多一個網路延遲\n")
+    print(f"{'記憶數':<8}{'逐條 (ms)':>12}{'集合 (ms)':>12}{'加速':>8}{'逐條往返':>10}{'集合往返':>10}")
+    try:
+        for size in (100, 300, 1000):
+            legacy = await measure(legacy_update, f"legacy_{size}", size, turns)
+            set_based = await measure(memory_manager.update_memory, f"set_{size}", size, turns)
+            # 每回合新增和刪除各 5%，集合式寫入只需一條語句
+            round_trips = await legacy_update(BENCHMARK_USER, f"legacy_{size}", build_memory(size, turns + 1))
+            print(f"{size:<8}{legacy:>12.2f}{set_based:>12.2f}{legacy / set_based:>7.1f}x{round_trips:>10}{1:>10}")
+    finally:
+        async with db_pool.acquire() as conn:
+            await conn.execute("DELETE FROM memories WHERE user_id = $1", BENCHMARK_USER)
+        await db_pool.close()
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
@@ -0,0 +1,57 @@
+import time
+from prompt_cache import PromptTemplateCache
+from model_factory import ModelFactory
+
+# 測試用角色（欄位長度接近實際角色目錄）
+CHARACTER = {
+    "id": "benchmark_character",
+    "name": "小雪",
+    "gender": "女",
+    "age": "19",
+    "job": "咖啡廳店員",
+    "personality": "溫柔、體貼，偶爾有點迷糊",
+    "speakingStyle": "輕柔、帶點撒嬌的語氣",
+    "description": "在大學附近的咖啡廳打工，夢想是開一間屬於自己的甜點店。" * 8,
+    "likes": "草莓蛋糕、下雨天、貓",
+    "dislikes": "苦瓜、吵鬧的地方",
+    "quote": "今天也要好好加油喔！",
+    "basicInfo": "身高: 158cm\n生日: 12月24日\n血型: A型\n" * 4,
+    "firstChatScene": "午後的咖啡廳裡，陽光灑在木質桌面上，她端著咖啡朝你走來。" * 3,
+    "firstChatLine": "歡迎光臨～今天想喝點什麼呢？"
+}
+
+MEMORY_TEXT = "用戶喜歡喝拿鐵，上次提到最近工作很忙。\n用戶養了一隻叫小黑的貓。"
+
+CHAT_HISTORY = [
+    {"role": "user" if i % 2 == 0 else "assistant", "content": f"第 {i} 條測試訊息，內容長度大約二十個字。"}
+    for i in range(20)
+]
+
+def measure(handler, iterations: int) -> float:
+    """返回每條訊息組裝提示詞的平均耗時（微秒）"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        handler.create_prompt(CHARACTER, CHAT_HISTORY, f"測試訊息 {i}", MEMORY_TEXT)
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+def run_benchmark(iterations: int = 20000):
+    """比較每條訊息都重建角色提示詞與使用已編譯模板的耗時"""
+    print(f"每個模型執行 {iterations} 次 create_prompt\n")
+    print(f"{'模型':<10}{'重建 (µs)':>12}{'緩存 (µs)':>12}{'加速':>8}")
+
+    for model_type in ("gemini", "openai", "claude"):
+        handler = ModelFactory.get_model_handler(model_type)
+        original_cache = handler.prompt_cache
+
+        # max_entries=0 時每次都會重新編譯，等同於沒有緩存時的行為
+        handler.prompt_cache = PromptTemplateCache(max_entries=0)
+        uncached = measure(handler, iterations)
+
+        handler.prompt_cache = PromptTemplateCache()
+        cached = measure(handler, iterations)
+
+        handler.prompt_cache = original_cache
+        print(f"{model_type:<10}{uncached:>12.2f}{cached:>12.2f}{uncached / cached:>7.1f}x")
+
+if __name__ == "__main__":
+    run_benchmark()
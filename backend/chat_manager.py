@@ -1,8 +1,15 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, AsyncIterator
+import os
 import asyncio
+from collections import deque
 from model_factory import ModelFactory
 from memory_manager import memory_manager
 from affinity_evaluator import affinity_evaluator
+from conversation_summarizer import conversation_summarizer
+from conversation_store import conversation_store, Message
+from conversation_persistence import conversation_persistence
+from state_backend import state_backend
+from conversation_locks import conversation_locks
 
 class ChatManager:
     """
@@ -11,16 +18,23 @@ class ChatManager:
     
     def __init__(self):
         """初始化聊天管理器"""
-        # 存儲不同用戶和角色的對話歷史
-        self._chat_histories = {}  # 用戶ID -> 角色ID -> 對話歷史
+        # 對話歷史、好感度、回合ID和好感度變化都保存在有界的對話存儲中
+        # （每段對話的消息數和對話總數都有上限，見 conversation_store.py）；
+        # 修改一律經過狀態後端，使用共享後端時其他 worker 也會看到（見 state_backend.py）
+        self._store = conversation_store
+        self._backend = state_backend
         
-        # 存儲不同用戶和角色的好感度
-        self._affinities = {}  # 用戶ID -> 角色ID -> 好感度值
+        # 尚未完成的好感度評估
+        self._pending_affinity = {}  # (用戶ID, 角色ID, 回合ID) -> asyncio.Task
         
-        # 默認起始好感度
-        self._default_affinity = 0  # 範圍為 0-100
+        # 尚未完成的記憶更新
+        self._pending_memory = set()  # asyncio.Task
+        
+        # 合併模式：前一個回合執行期間送達的多條消息合併成一個回合（只適用於非串流請求）
+        self.coalesce_messages = os.getenv("CHAT_COALESCE_MESSAGES", "false").lower() == "true"
+        self._coalescing = {}  # (用戶ID, 角色ID) -> {"messages": [...], "future": 回合結果}
     
-    def get_chat_history(self, user_id: str, character_id: str) -> List[Dict[str, str]]:
+    def get_chat_history(self, user_id: str, character_id: str) -> deque:
         """
         獲取特定用戶和角色的對話歷史
         
@@ -29,19 +43,11 @@ class ChatManager:
             character_id: 角色ID
             
         返回:
-            對話歷史列表
+            對話歷史（固定容量的 Message 環形緩衝區，新增消息時原地更新）
         """
-        # 確保用戶ID存在
-        if user_id not in self._chat_histories:
-            self._chat_histories[user_id] = {}
-        
-        # 確保角色ID存在
-        if character_id not in self._chat_histories[user_id]:
-            self._chat_histories[user_id][character_id] = []
-        
-        return self._chat_histories[user_id][character_id]
+        return self._store.get(user_id, character_id).messages
     
-    def add_message(self, user_id: str, character_id: str, role: str, content: str) -> None:
+    async def add_message(self, user_id: str, character_id: str, role: str, content: str) -> None:
         """
         添加消息到對話歷史
         
@@ -51,17 +57,21 @@ class ChatManager:
             role: 消息角色（"user" 或 "assistant"）
             content: 消息內容
         """
-        chat_history = self.get_chat_history(user_id, character_id)
-        chat_history.append({
-            "role": role,
-            "content": content
-        })
+        # 超出容量時環形緩衝區自動丟棄最舊的消息，其他地方持有的歷史引用保持有效
+        message = await self._backend.append_message(user_id, character_id, role, content)
+        conversation_persistence.record_message(user_id, character_id, message)
+    
+    async def load_conversation(self, user_id: str, character_id: str) -> None:
+        """
+        確保對話已載入記憶體（第一次存取、被淘汰或被其他 worker 修改後重新讀取）
         
-        # 管理對話歷史長度，避免無限增長
-        if len(chat_history) > 50:  # 保留最多 50 條消息
-            self._chat_histories[user_id][character_id] = chat_history[-50:]
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+        """
+        await self._backend.ensure_loaded(user_id, character_id)
     
-    def reset_chat(self, user_id: str, character_id: str) -> None:
+    async def reset_chat(self, user_id: str, character_id: str) -> None:
         """
         重置特定用戶和角色的對話歷史
         
@@ -69,21 +79,18 @@ class ChatManager:
             user_id: 用戶ID
             character_id: 角色ID
         """
-        if user_id in self._chat_histories and character_id in self._chat_histories[user_id]:
-            self._chat_histories[user_id][character_id] = []
+        await self._backend.clear(user_id, character_id)
+        conversation_persistence.record_clear(user_id, character_id)
     
-    def reset_all_chats(self, user_id: Optional[str] = None) -> None:
+    async def reset_all_chats(self, user_id: Optional[str] = None) -> None:
         """
         重置所有對話或特定用戶的所有對話
         
         參數:
             user_id: 用戶ID（可選，如果提供則只重置該用戶的對話）
         """
-        if user_id:
-            if user_id in self._chat_histories:
-                self._chat_histories[user_id] = {}
-        else:
-            self._chat_histories = {}
+        await self._backend.clear(user_id or None)
+        conversation_persistence.record_clear(user_id or None)
     
     def get_affinity(self, user_id: str, character_id: str) -> int:
         """
@@ -96,17 +103,10 @@ class ChatManager:
         返回:
             好感度值
         """
-        # 確保用戶ID存在
-        if user_id not in self._affinities:
-            self._affinities[user_id] = {}
-        
-        # 確保角色ID存在，並使用默認好感度
-        if character_id not in self._affinities[user_id]:
-            self._affinities[user_id][character_id] = self._default_affinity
-        
-        return self._affinities[user_id][character_id]
+        # 新對話使用默認好感度
+        return self._store.get(user_id, character_id).affinity
     
-    def update_affinity(self, user_id: str, character_id: str, change: int) -> int:
+    async def update_affinity(self, user_id: str, character_id: str, change: int) -> int:
         """
         更新特定用戶和角色的好感度
         
@@ -118,12 +118,12 @@ class ChatManager:
         返回:
             更新後的好感度值
         """
-        current_affinity = self.get_affinity(user_id, character_id)
-        new_affinity = max(0, min(100, current_affinity + change))  # 確保範圍在 0-100 之間
-        self._affinities[user_id][character_id] = new_affinity
+        # 由後端原子地套用並限制在 0-100 之間，多個 worker 同時更新也不會遺失變化
+        new_affinity = await self._backend.add_affinity(user_id, character_id, change)
+        conversation_persistence.mark_dirty(user_id, character_id)
         return new_affinity
     
-    def set_affinity(self, user_id: str, character_id: str, value: int) -> int:
+    async def set_affinity(self, user_id: str, character_id: str, value: int) -> int:
         """
         設置特定用戶和角色的好感度
         
@@ -138,20 +138,122 @@ class ChatManager:
         # 確保好感度在有效範圍內
         affinity = max(0, min(100, value))
         
-        # 確保用戶ID存在
-        if user_id not in self._affinities:
-            self._affinities[user_id] = {}
-        
         # 設置好感度
-        self._affinities[user_id][character_id] = affinity
+        await self._backend.set_affinity(user_id, character_id, affinity)
+        conversation_persistence.mark_dirty(user_id, character_id)
         return affinity
     
+    async def next_turn_id(self, user_id: str, character_id: str) -> int:
+        """
+        分配新的回合ID（每段對話內單調遞增）
+        
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            
+        返回:
+            新的回合ID
+        """
+        turn_id = await self._backend.next_turn_id(user_id, character_id)
+        conversation_persistence.mark_dirty(user_id, character_id)
+        return turn_id
+    
+    async def get_affinity_updates(self, user_id: str, character_id: str, since: int = 0) -> Dict[str, Any]:
+        """
+        獲取指定回合之後完成的好感度變化
+        
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            since: 只返回回合ID大於此值的結果
+            
+        返回:
+            包含變化列表和仍在計算中的回合ID的字典（計算中的回合只包括本 worker 的）
+        """
+        updates = await self._backend.get_affinity_updates(user_id, character_id)
+        conversation = self._store.peek(user_id, character_id)
+        pending = sorted(
+            turn_id for (uid, cid, turn_id) in self._pending_affinity
+            if uid == user_id and cid == character_id and turn_id > since
+        )
+        return {
+            "updates": [update for update in updates if update["turn_id"] > since],
+            "pending_turns": pending,
+            "latest_turn_id": conversation.turn_id if conversation is not None else 0
+        }
+    
+    def _schedule_affinity_evaluation(self, api_key: str, user_id: str, character_id: str, 
+                                      character: Dict[str, Any], message: str, ai_reply: str, 
+                                      turn_id: int) -> asyncio.Task:
+        """
+        在後台啟動好感度評估，不阻塞回覆
+        
+        返回:
+            評估任務，完成後的結果為好感度變化記錄
+        """
+        key = (user_id, character_id, turn_id)
+        task = asyncio.create_task(self._evaluate_affinity(
+            api_key, user_id, character_id, character, message, ai_reply, turn_id
+        ))
+        self._pending_affinity[key] = task
+        task.add_done_callback(lambda _: self._pending_affinity.pop(key, None))
+        return task
+    
+    async def _evaluate_affinity(self, api_key: str, user_id: str, character_id: str, 
+                                 character: Dict[str, Any], message: str, ai_reply: str, 
+                                 turn_id: int) -> Dict[str, Any]:
+        """
+        評估好感度變化並記錄結果的後台任務
+        
+        返回:
+            好感度變化記錄 {turn_id, affinity_change, affinity}
+        """
+        try:
+            current_affinity = self.get_affinity(user_id, character_id)
+            affinity_change = await affinity_evaluator.evaluate_affinity_change(
+                api_key,
+                character,
+                message,
+                ai_reply,
+                current_affinity
+            )
+        except Exception as e:
+            print(f"後台評估好感度時出錯: {str(e)}")
+            affinity_change = 0
+        
+        # 對話可能在評估期間被淘汰，先重新載入，避免以默認值覆蓋資料庫中的狀態
+        await self.load_conversation(user_id, character_id)
+        return await self._record_affinity_update(user_id, character_id, turn_id, affinity_change)
+    
+    async def _record_affinity_update(self, user_id: str, character_id: str, turn_id: int, 
+                                affinity_change: int) -> Dict[str, Any]:
+        """
+        套用好感度變化並記錄到該回合
+        
+        返回:
+            好感度變化記錄 {turn_id, affinity_change, affinity}
+        """
+        new_affinity = await self.update_affinity(user_id, character_id, affinity_change)
+        print(f"回合 {turn_id} 好感度變化: {affinity_change}, 新好感度: {new_affinity}")
+        
+        update = {
+            "turn_id": turn_id,
+            "affinity_change": affinity_change,
+            "affinity": new_affinity
+        }
+        # 只保留最近的結果
+        await self._backend.record_affinity_update(user_id, character_id, update)
+        return update
+    
     async def process_chat(self, api_key: str, character_id: str, message: str, 
                          user_id: str = "default_user", reset_context: bool = False, 
                          model_type: str = "gemini", character: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         處理聊天請求
         
+        同一對話的回合依序執行（不同對話並行）。啟用合併模式時，在前一個回合執行期間
+        送達的消息會合併成一個回合，這些請求都收到同一個回覆。
+        
         參數:
             api_key: API密鑰
             character_id: 角色ID
@@ -166,6 +268,65 @@ class ChatManager:
         """
         print(f"收到聊天請求: user_id={user_id}, character_id={character_id}, model_type={model_type}")
         
+        if self.coalesce_messages and not reset_context:
+            return await self._process_coalesced(api_key, character_id, message, user_id, model_type, character)
+        
+        async with conversation_locks.hold(user_id, character_id) as wait_ms:
+            if wait_ms >= 1:
+                print(f"對話 {user_id}/{character_id} 排隊等待 {wait_ms:.0f} ms")
+            return await self._process_turn(api_key, character_id, message, user_id, 
+                                            reset_context, model_type, character)
+    
+    async def _process_coalesced(self, api_key: str, character_id: str, message: str, user_id: str, 
+                                 model_type: str, character: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        以合併模式處理聊天請求：加入尚未開始的批次並等待其結果，沒有批次時建立新批次
+        
+        返回:
+            處理結果的字典（合併了多條消息時包含 coalesced_messages）
+        """
+        key = (user_id, character_id)
+        batch = self._coalescing.get(key)
+        if batch is not None:
+            batch["messages"].append(message)
+            print(f"消息已合併到 {user_id}/{character_id} 排隊中的回合（共 {len(batch['messages'])} 條）")
+            return await asyncio.shield(batch["future"])
+        
+        batch = {"messages": [message], "future": asyncio.get_running_loop().create_future()}
+        self._coalescing[key] = batch
+        result = None
+        try:
+            async with conversation_locks.hold(user_id, character_id) as wait_ms:
+                # 取得鎖後不再接受新消息，之後送達的消息組成下一個批次
+                if self._coalescing.get(key) is batch:
+                    del self._coalescing[key]
+                if wait_ms >= 1:
+                    print(f"對話 {user_id}/{character_id} 排隊等待 {wait_ms:.0f} ms")
+                
+                messages = batch["messages"]
+                result = await self._process_turn(api_key, character_id, "\n".join(messages), user_id, 
+                                                  False, model_type, character)
+                if len(messages) > 1 and result["success"]:
+                    result["coalesced_messages"] = len(messages)
+                return result
+        finally:
+            if self._coalescing.get(key) is batch:
+                del self._coalescing[key]
+            if not batch["future"].done():
+                batch["future"].set_result(result or {
+                    "success": False,
+                    "error": "處理聊天請求時發生錯誤",
+                    "details": "合併的請求已被取消",
+                    "status_code": 503
+                })
+    
+    async def _process_turn(self, api_key: str, character_id: str, message: str, user_id: str, 
+                            reset_context: bool, model_type: str, character: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        執行一個聊天回合（呼叫者必須持有對話的鎖）
+        
+        參數與返回值同 process_chat
+        """
         try:
             # 確保API Key存在
             if not api_key:
@@ -185,19 +346,27 @@ class ChatManager:
                     "status_code": 404
                 }
             
+            # 對話不在記憶體中時從資料庫載入
+            await self.load_conversation(user_id, character_id)
+            
             # 如果請求重置上下文，刪除當前對話歷史
             if reset_context:
-                self.reset_chat(user_id, character_id)
+                await self.reset_chat(user_id, character_id)
             
             # 獲取對話歷史
             chat_history = self.get_chat_history(user_id, character_id)
             
             # 添加用戶消息到歷史記錄
-            self.add_message(user_id, character_id, "user", message)
+            await self.add_message(user_id, character_id, "user", message)
             
             # 獲取模型處理器
             model_handler = ModelFactory.get_model_handler(model_type)
             
+            # 內嵌好感度模式下，讓模型在同一次請求中輸出好感度變化
+            inline_affinity = None
+            if affinity_evaluator.inline_mode:
+                inline_affinity = self.get_affinity(user_id, character_id)
+            
             # 調用模型生成回應
             print(f"開始生成回應，使用模型: {model_type}")
             result = await model_handler.generate_response(
@@ -206,7 +375,8 @@ class ChatManager:
                 chat_history, 
                 character, 
                 user_id, 
-                character_id
+                character_id,
+                current_affinity=inline_affinity
             )
             
             # 處理API響應
@@ -218,41 +388,62 @@ class ChatManager:
             print(f"成功生成回應，長度: {len(ai_reply)}")
             
             # 將AI回覆添加到對話歷史
-            self.add_message(user_id, character_id, "assistant", ai_reply)
+            await self.add_message(user_id, character_id, "assistant", ai_reply)
             
-            # 啟動後台任務來更新角色記憶
-            asyncio.create_task(self._update_memory(
+            # 啟動後台任務來更新角色記憶（傳入本回合的快照，不受之後的新消息影響）
+            self._schedule_memory_update(
+                api_key,
+                user_id,
+                character_id,
+                character,
+                list(chat_history),
+                model_type
+            )
+            
+            # 窗口前進足夠多回合時，在後台將較早的消息摺疊進摘要
+            conversation_summarizer.maybe_schedule(
                 api_key,
                 user_id,
                 character_id,
                 character,
                 chat_history,
                 model_type
-            ))
+            )
             
-            # 獲取當前好感度
-            current_affinity = self.get_affinity(user_id, character_id)
+            turn_id = await self.next_turn_id(user_id, character_id)
             
-            # 評估好感度變化
-            affinity_change = await affinity_evaluator.evaluate_affinity_change(
+            # 模型已內嵌輸出好感度變化，直接套用
+            if result.get("affinity_change") is not None:
+                update = await self._record_affinity_update(user_id, character_id, turn_id, result["affinity_change"])
+                return {
+                    "success": True,
+                    "reply": ai_reply, 
+                    "history_length": len(chat_history),
+                    "turn_id": turn_id,
+                    "affinity": update["affinity"],
+                    "affinity_change": update["affinity_change"],
+                    "affinity_pending": False
+                }
+            
+            # 在後台評估好感度變化，回覆不必等待第二次模型請求
+            self._schedule_affinity_evaluation(
                 api_key,
+                user_id,
+                character_id,
                 character,
                 message,
                 ai_reply,
-                current_affinity
+                turn_id
             )
             
-            # 更新好感度
-            new_affinity = self.update_affinity(user_id, character_id, affinity_change)
-            print(f"好感度變化: {affinity_change}, 新好感度: {new_affinity}")
-            
-            # 返回結果
+            # 返回結果（好感度為本回合評估前的值，變化可透過 /affinity 端點以 turn_id 查詢）
             return {
                 "success": True,
                 "reply": ai_reply, 
                 "history_length": len(chat_history),
-                "affinity": new_affinity,
-                "affinity_change": affinity_change
+                "turn_id": turn_id,
+                "affinity": self.get_affinity(user_id, character_id),
+                "affinity_pending": True
             }
             
         except Exception as e:
@@ -270,8 +461,178 @@ class ChatManager:
                 "status_code": 500
             }
     
+    async def process_chat_stream(self, api_key: str, character_id: str, message: str, 
+                                  user_id: str = "default_user", reset_context: bool = False, 
+                                  model_type: str = "gemini", 
+                                  character: Dict[str, Any] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        以串流方式處理聊天請求
+        
+        參數與 process_chat 相同
+            
+        返回:
+            依序產生的事件字典：多個 "delta" 事件，接著是 "done" 或 "error" 事件；
+            好感度在後台評估時，最後再推送一個帶有相同 turn_id 的 "affinity" 事件
+        """
+        print(f"收到串流聊天請求: user_id={user_id}, character_id={character_id}, model_type={model_type}")
+        
+        try:
+            if not api_key:
+                yield {
+                    "type": "error",
+                    "error": "缺少 API 金鑰",
+                    "details": "請在設定頁面中添加對應模型的 API 金鑰",
+                    "status_code": 400
+                }
+                return
+            
+            if not character:
+                yield {
+                    "type": "error",
+                    "error": "缺少角色設定",
+                    "details": f"找不到ID為 {character_id} 的角色設定",
+                    "status_code": 404
+                }
+                return
+            
+            # 同一對話的回合依序執行；串流送出完整回覆後即釋放，好感度結果不佔用對話
+            affinity_task = None
+            async with conversation_locks.hold(user_id, character_id) as wait_ms:
+                if wait_ms >= 1:
+                    print(f"對話 {user_id}/{character_id} 排隊等待 {wait_ms:.0f} ms")
+                
+                await self.load_conversation(user_id, character_id)
+                
+                if reset_context:
+                    await self.reset_chat(user_id, character_id)
+                
+                chat_history = self.get_chat_history(user_id, character_id)
+                await self.add_message(user_id, character_id, "user", message)
+                
+                model_handler = ModelFactory.get_model_handler(model_type)
+                
+                inline_affinity = None
+                if affinity_evaluator.inline_mode:
+                    inline_affinity = self.get_affinity(user_id, character_id)
+                
+                ai_reply = None
+                inline_change = None
+                async for event in model_handler.generate_response_stream(
+                    api_key, 
+                    message, 
+                    chat_history, 
+                    character, 
+                    user_id, 
+                    character_id,
+                    current_affinity=inline_affinity
+                ):
+                    if event["type"] == "delta":
+                        yield event
+                    elif event["type"] == "done":
+                        ai_reply = event["reply"]
+                        inline_change = event.get("affinity_change")
+                    else:
+                        print(f"串流生成回應失敗: {event.get('error', '未知錯誤')}")
+                        yield event
+                        return
+                
+                if ai_reply is None:
+                    yield {
+                        "type": "error",
+                        "error": "串流意外結束",
+                        "details": "模型沒有返回完整回應",
+                        "status_code": 502
+                    }
+                    return
+                
+                # 串流完成後才將完整回覆加入對話歷史
+                await self.add_message(user_id, character_id, "assistant", ai_reply)
+                print(f"串流回應完成，長度: {len(ai_reply)}")
+                
+                self._schedule_memory_update(
+                    api_key,
+                    user_id,
+                    character_id,
+                    character,
+                    list(chat_history),
+                    model_type
+                )
+                
+                # 窗口前進足夠多回合時，在後台將較早的消息摺疊進摘要
+                conversation_summarizer.maybe_schedule(
+                    api_key,
+                    user_id,
+                    character_id,
+                    character,
+                    chat_history,
+                    model_type
+                )
+                
+                turn_id = await self.next_turn_id(user_id, character_id)
+                
+                # 模型已內嵌輸出好感度變化，直接套用
+                if inline_change is not None:
+                    update = await self._record_affinity_update(user_id, character_id, turn_id, inline_change)
+                    yield {
+                        "type": "done",
+                        "reply": ai_reply,
+                        "history_length": len(chat_history),
+                        "turn_id": turn_id,
+                        "affinity": update["affinity"],
+                        "affinity_change": update["affinity_change"],
+                        "affinity_pending": False
+                    }
+                    return
+                
+                affinity_task = self._schedule_affinity_evaluation(
+                    api_key,
+                    user_id,
+                    character_id,
+                    character,
+                    message,
+                    ai_reply,
+                    turn_id
+                )
+                
+                # 回覆已完整送出，好感度結果稍後在同一個串流中推送
+                yield {
+                    "type": "done",
+                    "reply": ai_reply,
+                    "history_length": len(chat_history),
+                    "turn_id": turn_id,
+                    "affinity": self.get_affinity(user_id, character_id),
+                    "affinity_pending": True
+                }
+            
+            if affinity_task is not None:
+                update = await affinity_task
+                yield {"type": "affinity", **update}
+            
+        except Exception as e:
+            import traceback
+            print(f"處理串流聊天請求時發生錯誤: {str(e)}")
+            print(f"錯誤詳情:\n{traceback.format_exc()}")
+            
+            yield {
+                "type": "error",
+                "error": "處理聊天請求時發生錯誤",
+                "details": str(e),
+                "status_code": 500
+            }
+    
+    def _schedule_memory_update(self, api_key: str, user_id: str, character_id: str, 
+                                character: Dict[str, Any], chat_history: List[Message], 
+                                model_type: str) -> asyncio.Task:
+        """在後台啟動記憶更新，不阻塞回覆（關閉時等待完成）"""
+        task = asyncio.create_task(self._update_memory(
+            api_key, user_id, character_id, character, chat_history, model_type
+        ))
+        self._pending_memory.add(task)
+        task.add_done_callback(self._pending_memory.discard)
+        return task
+    
     async def _update_memory(self, api_key: str, user_id: str, character_id: str, 
-                           character: Dict[str, Any], chat_history: List[Dict[str, str]], 
+                           character: Dict[str, Any], chat_history: List[Message], 
                            model_type: str) -> None:
         """
         更新角色記憶的後台任務
@@ -285,35 +646,53 @@ class ChatManager:
             model_type: 模型類型
         """
         try:
-            # 只使用最近的對話，減輕計算負擔
-            recent_messages = chat_history[-10:]
-            
-            # 使用記憶管理器生成記憶
-            new_memory = await memory_manager.generate_memory_from_conversation(
-                api_key, 
-                character, 
-                recent_messages, 
-                model_type
-            )
-            
-            # 獲取現有記憶
-            existing_memory = await memory_manager.get_memory(user_id, character_id)
+            # 同一對話的記憶依序提取和合併：游標隨對話狀態持久化，只分析上次成功提取之後的新消息，
+            # 寫入成功後才前移游標，失敗的消息由下一個回合重新提取
+            async with conversation_locks.hold(user_id, character_id, scope="memory"):
+                # 對話可能在排隊期間被淘汰，重新載入以取得持久化的游標
+                await self.load_conversation(user_id, character_id)
+                cursor = self._store.get(user_id, character_id).memory_seq
+                new_messages = []
+                for msg in reversed(chat_history):
+                    if msg.seq <= cursor:
+                        break
+                    new_messages.append(msg)
+                if not new_messages:
+                    return
+                new_messages.reverse()
+                
+                # 使用記憶管理器生成記憶
+                new_memory = await memory_manager.generate_memory_from_conversation(
+                    api_key, 
+                    character, 
+                    new_messages, 
+                    model_type
+                )
+                
+                added = await memory_manager.add_memories(user_id, character_id, new_memory, source="inferred")
+                if added is None:
+                    return
+                await self._backend.advance_memory_seq(user_id, character_id, new_messages[-1].seq)
+                conversation_persistence.mark_dirty(user_id, character_id)
             
-            # 合併新記憶和現有記憶（避免重複）
-            for category in ["personal_info", "preferences", "important_events"]:
-                for item in new_memory[category]:
-                    if item not in existing_memory[category]:
-                        existing_memory[category].append(item)
-            
-            # 更新記憶
-            await memory_manager.update_memory(user_id, character_id, existing_memory)
-            
-            print(f"已更新 {user_id} 對 {character_id} 的記憶")
+            if added:
+                print(f"已為 {user_id} 對 {character_id} 新增 {added} 條記憶")
             
         except Exception as e:
             print(f"更新記憶時出錯: {str(e)}")
             import traceback
             print(f"錯誤詳情:\n{traceback.format_exc()}")
 
+    async def wait_memory_updates(self) -> None:
+        """等待進行中的記憶更新完成（需要使用模型處理器，應用關閉時在關閉模型處理器之前呼叫）"""
+        if self._pending_memory:
+            await asyncio.gather(*self._pending_memory, return_exceptions=True)
+    
+    async def close(self) -> None:
+        """等待進行中的記憶更新和好感度評估完成（應用關閉時呼叫）"""
+        await self.wait_memory_updates()
+        if self._pending_affinity:
+            await asyncio.gather(*self._pending_affinity.values(), return_exceptions=True)
+
 # 創建聊天管理器的單例實例
 chat_manager = ChatManager() 
\ No newline at end of file
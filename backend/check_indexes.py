@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import asyncio
+from typing import Dict, Any, List, Iterator
+from dotenv import load_dotenv
+from memory_manager import MEMORY_SELECT, MEMORY_ADD, MEMORY_CLEAR, MEMORY_SYNC, MEMORY_PRUNE
+
+# 載入環境變數
+load_dotenv()
+
+MEMORY_TYPES = ["personal_info", "preferences", "important_events"]
+
+def hot_queries(user_id: str, character_id: str) -> List[tuple]:
+    """
+    要檢查的記憶查詢：(名稱, SQL, 參數)
+
+    讀取、新增和淘汰每個回合都會執行；同步只用於維護時整份取代記憶（update_memory），
+    請求路徑不會呼叫，但同樣不應掃描整個記憶表。
+    """
+    return [
+        ("讀取記憶", MEMORY_SELECT, (user_id, character_id)),
+        ("新增記憶", MEMORY_ADD, (user_id, character_id, MEMORY_TYPES[:1], ["檢查用的記憶"], "inferred", [None])),
+        ("淘汰記憶", MEMORY_PRUNE, (user_id, character_id, 50, 100, 30 * 86400.0, 0.25)),
+        ("清除記憶", MEMORY_CLEAR, (user_id, character_id)),
+        ("同步記憶（僅維護用）", MEMORY_SYNC,
+         (user_id, character_id, MEMORY_TYPES[:1], ["檢查用的記憶"], MEMORY_TYPES, [None], "explicit")),
+    ]
+
+def walk(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """遍歷計劃樹的所有節點"""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from walk(child)
+
+def check_plan(plan: Dict[str, Any]) -> List[str]:
+    """
+    檢查計劃中讀取記憶表的節點
+
+    INSERT ... ON CONFLICT 不讀取記憶表，而是以衝突判定索引（Conflict Arbiter Indexes）檢查既有記錄。
+
+    參數:
+        plan: EXPLAIN (FORMAT JSON) 的根節點
+
+    返回:
+        問題列表（空列表表示所有對記憶表的讀取都使用索引）
+    """
+    problems = []
+    scans = [
+        node for node in walk(plan)
+        if node.get("Relation Name", "").startswith("memories") and node["Node Type"] != "ModifyTable"
+    ]
+    for node in scans:
+        if node["Node Type"] == "Seq Scan":
+            problems.append(f"對 {node['Relation Name']} 使用循序掃描")
+    if not scans and not arbiter_indexes(plan):
+        problems.append("計劃中沒有讀取記憶表的節點")
+    return problems
+
+def arbiter_indexes(plan: Dict[str, Any]) -> List[str]:
+    """計劃中寫入記憶表時用來判定衝突的索引"""
+    return [
+        index for node in walk(plan)
+        if node.get("Relation Name", "").startswith("memories")
+        for index in node.get("Conflict Arbiter Indexes", [])
+    ]
+
+def describe(plan: Dict[str, Any]) -> str:
+    """列出計劃中讀取記憶表時使用的索引"""
+    indexes = sorted({
+        node["Index Name"] for node in walk(plan)
+        if node.get("Relation Name", "").startswith("memories") and "Index Name" in node
+    } | set(arbiter_indexes(plan)))
+    return ", ".join(indexes) or "無"
+
+async def run_check() -> bool:
+    """
+    以 EXPLAIN 檢查熱門查詢是否使用索引
+
+    記憶表很小時（例如開發環境）規劃器會直接選擇循序掃描，
+    因此在交易中停用循序掃描，檢查的是索引「能否」被這些查詢使用；檢查結束後回滾。
+
+    返回:
+        所有查詢都通過時為 True
+    """
+    import asyncpg
+
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    ok = True
+    try:
+        sample = await conn.fetchrow("SELECT user_id, character_id FROM memories LIMIT 1")
+        user_id, character_id = (sample["user_id"], sample["character_id"]) if sample else ("check_user", "check_character")
+
+        for name, sql, args in hot_queries(user_id, character_id):
+            tr = conn.transaction()
+            await tr.start()
+            try:
+                await conn.execute("SET LOCAL enable_seqscan = off")
+                result = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args)
+            finally:
+                await tr.rollback()
+            plan = json.loads(result)[0]["Plan"]
+            problems = check_plan(plan)
+            if problems:
+                ok = False
+                print(f"[失敗] {name}: {'；'.join(problems)}")
+            else:
+                print(f"[通過] {name}: 使用索引 {describe(plan)}")
+    finally:
+        await conn.close()
+    return ok
+
+if __name__ == "__main__":
+    if not os.getenv("DATABASE_URL"):
+        print("請設定 DATABASE_URL")
+        sys.exit(1)
+    sys.exit(0 if asyncio.run(run_check()) else 1)
@@ -1,18 +1,53 @@
-import re
+import os
 import json
-import requests
-from typing import Dict, Any, List
+from typing import Dict, Any, List, AsyncIterator, Optional, Tuple
 from model_interface import ModelHandler
+from http_client import iter_sse_data
+from response_formatter import format_reply, clamp_affinity_change, StreamingReplyFormatter
+from affinity_evaluator import build_inline_affinity_instruction
+
+# 記憶段落的前後文字（與記憶文本分開估算 token，記憶文本的字元數已預先計算）
+MEMORY_PROMPT_HEADER = "與用戶的互動記憶：\n"
+MEMORY_PROMPT_FOOTER = "\n\n請根據這些記憶，以自然的方式在對話中體現你對用戶過去互動的記憶，但不要直接提及你記得用戶說過什麼。"
 
 class ClaudeHandler(ModelHandler):
     """Claude模型處理器"""
     
-    def __init__(self):
-        self.api_url = "https://api.anthropic.com/v1/messages"
-        self.model = "claude-3-sonnet-20240229"  # 默認模型
+    # 內嵌好感度模式使用的工具定義
+    AFFINITY_TOOL = {
+        "name": "reply_with_affinity",
+        "description": "以角色身份回覆用戶，並同時提供這次對話後的好感度變化",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "reply": {
+                    "type": "string",
+                    "description": "角色的完整回覆"
+                },
+                "affinity_change": {
+                    "type": "integer",
+                    "description": "好感度變化，介於 -5 到 +5 之間"
+                }
+            },
+            "required": ["reply", "affinity_change"]
+        }
+    }
+    
+    provider = "claude"
+    
+    def __init__(self, model: str = None, max_concurrency: int = None, input_token_budget: int = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("CLAUDE_MAX_CONCURRENCY", "0"))
+        super().__init__(model or "claude-3-sonnet-20240229", max_concurrency, input_token_budget)  # 默認模型
+        api_base = os.getenv("CLAUDE_API_BASE", "https://api.anthropic.com").rstrip("/")
+        self.api_url = f"{api_base}/v1/messages"
+        
+        # 滾動摘要等後台工作使用的低成本模型
+        self.summary_model = os.getenv("CLAUDE_SUMMARY_MODEL", "claude-3-haiku-20240307")
     
     async def generate_response(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
-                              character: Dict[str, Any], user_id: str = None, character_id: str = None) -> Dict[str, Any]:
+                              character: Dict[str, Any], user_id: str = None, character_id: str = None, 
+                              current_affinity: Optional[int] = None) -> Dict[str, Any]:
         """
         使用Claude API生成回應
         """
@@ -20,26 +55,36 @@ class ClaudeHandler(ModelHandler):
         try:
             memory_text = ""
             if user_id and character_id:
-                memory_text = await self._get_memory_text(user_id, character_id)
+                memory_text = await self._get_memory_text(user_id, character_id, user_message, chat_history)
                 print(f"已獲取記憶文本，長度: {len(memory_text)}")
             
-            # 創建Claude的系統提示詞
-            system_prompt = self.create_prompt(character, chat_history, user_message, memory_text)
-            print(f"已創建系統提示詞，長度: {len(system_prompt)}")
+            # 內嵌好感度模式：強制使用工具，以工具參數同時取得回覆和好感度變化
+            structured = current_affinity is not None
+            instruction = build_inline_affinity_instruction(character, current_affinity, "tool") if structured else ""
+            
+            # 創建Claude的系統提示詞（角色設定部分標記為可緩存）
+            summary_text = self._get_summary_text(user_id, character_id)
+            system_blocks = self._system_blocks(character, memory_text, summary_text, instruction)
+            print(f"已創建系統提示詞，長度: {sum(len(block['text']) for block in system_blocks)}")
             
             # 格式化消息
-            formatted_messages = self.format_messages(character, chat_history, user_message, memory_text)
+            formatted_messages = self.format_messages(character, chat_history, user_message, memory_text, summary_text,
+                                                     user_id=user_id, character_id=character_id)
             print(f"已格式化消息，數量: {len(formatted_messages)}")
             
             # 構建請求數據
             payload = {
                 "model": self.model,
-                "system": system_prompt,
+                "system": system_blocks,
                 "messages": formatted_messages,
                 "max_tokens": 1000,
                 "temperature": 0.7
             }
             
+            if structured:
+                payload["tools"] = [self.AFFINITY_TOOL]
+                payload["tool_choice"] = {"type": "tool", "name": self.AFFINITY_TOOL["name"]}
+            
             headers = {
                 "x-api-key": api_key,
                 "anthropic-version": "2023-06-01",
@@ -50,7 +95,7 @@ class ClaudeHandler(ModelHandler):
             
             try:
                 # 發送請求到Claude API
-                response = requests.post(self.api_url, headers=headers, json=payload)
+                response = await self._post(self.api_url, headers, payload)
                 
                 if response.status_code != 200:
                     error_details = response.text
@@ -74,17 +119,28 @@ class ClaudeHandler(ModelHandler):
                 
                 # 解析回應
                 result = response.json()
-                ai_reply = result["content"][0]["text"]
+                
+                # 以實際輸入 token 數校正估算器，並記錄提示詞緩存的命中情況
+                self._record_claude_usage(system_blocks, formatted_messages, result.get("usage") or {})
+                
+                affinity_change = None
+                if structured:
+                    ai_reply, affinity_change = self._parse_tool_reply(result)
+                else:
+                    ai_reply = result["content"][0]["text"]
                 
                 print(f"成功獲取 Claude API 回應，回覆長度: {len(ai_reply)}")
                 
                 # 處理回應
                 ai_reply = self.post_process_response(ai_reply, character)
                 
-                return {
+                reply_result = {
                     "success": True,
                     "reply": ai_reply
                 }
+                if structured:
+                    reply_result["affinity_change"] = affinity_change
+                return reply_result
                 
             except Exception as e:
                 print(f"呼叫 Claude API 時發生錯誤: {str(e)}")
@@ -107,10 +163,132 @@ class ClaudeHandler(ModelHandler):
                 "details": str(outer_e)
             }
     
-    def create_prompt(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                     user_message: str, memory_text: str = "") -> str:
+    async def generate_response_stream(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
+                                       character: Dict[str, Any], user_id: str = None, 
+                                       character_id: str = None, 
+                                       current_affinity: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
         """
-        創建Claude的系統提示詞
+        使用Claude Messages API串流事件生成回應
+        """
+        try:
+            # 獲取記憶文本（如果有）
+            memory_text = ""
+            if user_id and character_id:
+                memory_text = await self._get_memory_text(user_id, character_id, user_message, chat_history)
+            
+            # 工具呼叫無法以文字串流呈現，改為要求在結尾附加好感度標記
+            instruction = ""
+            if current_affinity is not None:
+                instruction = build_inline_affinity_instruction(character, current_affinity, "trailer")
+            summary_text = self._get_summary_text(user_id, character_id)
+            system_blocks = self._system_blocks(character, memory_text, summary_text, instruction)
+            
+            formatted_messages = self.format_messages(character, chat_history, user_message, memory_text, summary_text,
+                                                     user_id=user_id, character_id=character_id)
+            payload = {
+                "model": self.model,
+                "system": system_blocks,
+                "messages": formatted_messages,
+                "max_tokens": 1000,
+                "temperature": 0.7,
+                "stream": True
+            }
+            headers = {
+                "x-api-key": api_key,
+                "anthropic-version": "2023-06-01",
+                "content-type": "application/json"
+            }
+            
+            formatter = StreamingReplyFormatter(character, report_affinity_change=current_affinity is not None)
+            usage = {}
+            
+            async with self._stream(self.api_url, headers, payload) as response:
+                if response.status_code != 200:
+                    error_details = (await response.aread()).decode("utf-8", errors="replace")
+                    print(f"Claude 串流請求失敗，狀態碼: {response.status_code}")
+                    error_message = None
+                    try:
+                        error_json = json.loads(error_details)
+                        if "error" in error_json:
+                            error_message = error_json["error"].get("message")
+                    except Exception:
+                        pass
+                    
+                    yield {
+                        "type": "error",
+                        "error": "Claude API 請求失敗",
+                        "status_code": response.status_code,
+                        "details": error_message or error_details
+                    }
+                    return
+                
+                async for event in iter_sse_data(response):
+                    event_type = event.get("type")
+                    if event_type == "message_start":
+                        usage = event.get("message", {}).get("usage") or {}
+                    elif event_type == "content_block_delta":
+                        delta = event.get("delta", {})
+                        if delta.get("type") == "text_delta":
+                            text = formatter.feed(delta.get("text", ""))
+                            if text:
+                                yield {"type": "delta", "text": text}
+                    elif event_type == "error":
+                        error = event.get("error", {})
+                        yield {
+                            "type": "error",
+                            "error": "Claude API 串流錯誤",
+                            "details": error.get("message", str(error))
+                        }
+                        return
+                    elif event_type == "message_stop":
+                        break
+            
+            text = formatter.finish()
+            if text:
+                yield {"type": "delta", "text": text}
+            
+            self._record_claude_usage(system_blocks, formatted_messages, usage)
+            print(f"Claude 串流回應完成，回覆長度: {len(formatter.text)}")
+            yield {"type": "done", "reply": formatter.text, "affinity_change": formatter.affinity_change}
+            
+        except Exception as e:
+            print(f"Claude 串流請求時發生錯誤: {str(e)}")
+            import traceback
+            print(f"錯誤詳情:\n{traceback.format_exc()}")
+            
+            yield {
+                "type": "error",
+                "error": "呼叫 Claude API 時發生錯誤",
+                "details": str(e)
+            }
+    
+    def _parse_tool_reply(self, result: Dict[str, Any]) -> Tuple[str, Optional[int]]:
+        """
+        從工具呼叫結果中取出回覆和好感度變化
+        
+        返回:
+            (回覆文本, 好感度變化)
+        """
+        texts = []
+        for block in result.get("content", []):
+            if block.get("type") == "tool_use" and block.get("name") == self.AFFINITY_TOOL["name"]:
+                tool_input = block.get("input", {})
+                affinity_change = None
+                try:
+                    if tool_input.get("affinity_change") is not None:
+                        affinity_change = clamp_affinity_change(int(tool_input["affinity_change"]))
+                except (TypeError, ValueError):
+                    pass
+                return str(tool_input.get("reply", "")), affinity_change
+            if block.get("type") == "text":
+                texts.append(block.get("text", ""))
+        
+        # 模型沒有呼叫工具時退回一般文本
+        return "".join(texts), None
+    
+    def _build_character_prompt(self, character: Dict[str, Any]) -> str:
+        """
+        編譯系統提示詞中只由角色設定決定的部分（結果由 prompt_cache 緩存）
         """
         system_prompt = f"""你是 {character['name']}，一個虛擬角色。請完全按照以下設定行事：
 
@@ -185,40 +363,145 @@ class ClaudeHandler(ModelHandler):
    
 6. 請確保每次回覆都包含至少一段旁白描述，用 *()* 符號包圍，對話和文字之間要換行
 7. 請不要重複我的話"""
+        return system_prompt
+    
+    async def complete(self, api_key: str, prompt: str, model: Optional[str] = None, 
+                       max_output_tokens: int = 512) -> Dict[str, Any]:
+        """
+        以單一提示詞向Claude請求純文本回覆
+        """
+        payload = {
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_output_tokens,
+            "temperature": 0.3
+        }
+        headers = {
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json"
+        }
+        try:
+            response = await self._post(self.api_url, headers, payload)
+            if response.status_code != 200:
+                return {
+                    "success": False,
+                    "error": "Claude API 請求失敗",
+                    "status_code": response.status_code,
+                    "details": response.text
+                }
+            result = response.json()
+            text = "".join(block.get("text", "") for block in result.get("content", []) if block.get("type") == "text")
+            return {"success": True, "text": text}
+        except Exception as e:
+            return {
+                "success": False,
+                "error": "呼叫 Claude API 時發生錯誤",
+                "details": str(e)
+            }
+    
+    def create_prompt(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
+                     user_message: str, memory_text: str = "", summary_text: str = "") -> str:
+        """
+        創建Claude的系統提示詞
+        """
+        # 角色設定部分按角色版本緩存，只有記憶需要每次組裝
+        system_prompt = self.prompt_cache.get_or_build(character, self._build_character_prompt)
         
         # 如果有記憶文本，添加到提示詞中
         if memory_text:
-            memory_part = f"\n\n與用戶的互動記憶：\n{memory_text}\n\n請根據這些記憶，以自然的方式在對話中體現你對用戶過去互動的記憶，但不要直接提及你記得用戶說過什麼。"
-            system_prompt += memory_part
+            system_prompt += f"\n\n{self._memory_prompt(memory_text)}"
+        
+        # 如果有較早對話的摘要，添加到提示詞中
+        if summary_text:
+            system_prompt += f"\n\n{self._summary_prompt(summary_text)}"
         
         return system_prompt
     
+    def _memory_prompt(self, memory_text: str) -> str:
+        """將記憶文本包裝成提示詞段落"""
+        return f"{MEMORY_PROMPT_HEADER}{memory_text}{MEMORY_PROMPT_FOOTER}"
+    
+    def _summary_prompt(self, summary_text: str) -> str:
+        """將滾動摘要包裝成提示詞段落"""
+        return f"之前對話的摘要（更早的對話記錄已省略）：\n{summary_text}"
+    
+    def _system_blocks(self, character: Dict[str, Any], memory_text: str = "", summary_text: str = "", 
+                       extra_instructions: str = "") -> List[Dict[str, Any]]:
+        """
+        構建帶有緩存斷點的系統提示詞區塊
+        
+        角色設定部分在同一角色的所有用戶和回合間都相同，以 cache_control 標記後
+        Claude 會緩存到此為止的前綴；記憶、摘要和額外指示放在斷點之後的區塊中。
+        
+        參數:
+            character: 角色設定
+            memory_text: 記憶文本（可選）
+            summary_text: 較早對話的摘要（可選）
+            extra_instructions: 附加在最後的指示（例如內嵌好感度的輸出要求）
+            
+        返回:
+            Messages API 的 system 區塊列表
+        """
+        blocks = [{
+            "type": "text",
+            "text": self.prompt_cache.get_or_build(character, self._build_character_prompt),
+            "cache_control": {"type": "ephemeral"}
+        }]
+        
+        context_prompt = self._memory_prompt(memory_text) if memory_text else ""
+        if summary_text:
+            context_prompt = f"{context_prompt}\n\n{self._summary_prompt(summary_text)}".strip()
+        if extra_instructions:
+            context_prompt = f"{context_prompt}{extra_instructions}".strip()
+        if context_prompt:
+            blocks.append({"type": "text", "text": context_prompt})
+        return blocks
+    
+    def _record_claude_usage(self, system_blocks: List[Dict[str, Any]], messages: List[Dict[str, str]], 
+                             usage: Dict[str, Any]) -> None:
+        """從 usage 欄位記錄緩存用量並校正 token 估算（input_tokens 不包含緩存讀寫的部分）"""
+        cache_read = usage.get("cache_read_input_tokens") or 0
+        cache_write = usage.get("cache_creation_input_tokens") or 0
+        total = (usage.get("input_tokens") or 0) + cache_read + cache_write
+        
+        estimated = sum(self.token_estimator.estimate(block["text"]) for block in system_blocks)
+        estimated += self.token_estimator.estimate_messages(messages)
+        self._record_usage(estimated, total)
+        self._record_cache_usage(total, cache_read, cache_write)
+    
     def format_messages(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                       user_message: str, memory_text: str = "") -> List[Dict[str, str]]:
+                       user_message: str, memory_text: str = "", summary_text: str = "",
+                       user_id: str = None, character_id: str = None) -> List[Dict[str, str]]:
         """
         將對話歷史和當前消息格式化為Claude所需的消息格式
+        
+        參數:
+            user_id: 用戶ID（可選，提供時記錄摘要節省的 token）
+            character_id: 角色ID（可選）
         """
         # Claude使用簡單的消息格式，不需要角色標識
         formatted_messages = []
         
-        # 加入歷史消息（最多 10 條）
-        recent_messages = chat_history[-10:]  # 最近10條
+        # 在輸入 token 預算內加入歷史消息（系統提示詞另外送出，但同樣佔用預算）
+        # 各段分開估算：角色設定和前後文字的估算有緩存，記憶文本的字元數已預先計算
+        character_prompt = self.prompt_cache.get_or_build(character, self._build_character_prompt)
+        memory_parts = (MEMORY_PROMPT_HEADER, memory_text, MEMORY_PROMPT_FOOTER) if memory_text else ()
+        summary_prompt = self._summary_prompt(summary_text) if summary_text else ""
+        budget = self._history_budget(character_prompt, *memory_parts, summary_prompt, user_message)
+        recent_messages = self._select_history(chat_history, budget, user_message, summary_prompt, user_id, character_id)
         for msg in recent_messages:
-            if msg["role"] == "system":
-                continue  # 跳過系統消息
-                
             role = "user" if msg["role"] == "user" else "assistant"
             formatted_messages.append({
                 "role": role,
                 "content": msg["content"]
             })
         
-        # 添加最新的用戶消息（如果不在歷史中）
-        if not recent_messages or recent_messages[-1]["role"] != "user" or recent_messages[-1]["content"] != user_message:
-            formatted_messages.append({
-                "role": "user",
-                "content": user_message
-            })
+        # 添加最新的用戶消息
+        formatted_messages.append({
+            "role": "user",
+            "content": user_message
+        })
         
         return formatted_messages
     
@@ -226,47 +509,18 @@ class ClaudeHandler(ModelHandler):
         """
         處理Claude的回應
         """
-        # 清理回覆
-        ai_reply = response.strip()
-        
-        # 確保回覆中有旁白描述
-        if "*(" not in ai_reply and ")*" not in ai_reply and "**" not in ai_reply:
-            # 生成更自然的旁白
-            character_name = character['name']
-            personality = character.get('personality', '').lower()
-            
-            # 根據角色性格生成合適的旁白
-            if '害羞' in personality or '內向' in personality:
-                narration = f"*({character_name}輕聲說道，眼神略顯羞澀)*"
-            elif '活潑' in personality or '開朗' in personality or '熱情' in personality:
-                narration = f"*({character_name}精神抖擻地說，臉上掛著明朗的笑容)*"
-            elif '冷靜' in personality or '沉穩' in personality:
-                narration = f"*({character_name}沉穩地回應，表情平靜而專注)*"
-            elif '傲嬌' in personality or '高傲' in personality:
-                narration = f"*({character_name}微微揚起下巴，假裝不太在意地說)*"
-            elif '溫柔' in personality or '體貼' in personality:
-                narration = f"*({character_name}溫柔地微笑著，眼中流露出關切之情)*"
-            else:
-                narration = f"*({character_name}看著你，眼神中帶著一絲好奇)*"
-            
-            ai_reply = f"{narration}\n{ai_reply}"
-        
-        # 確保旁白和對話之間有換行
-        ai_reply = re.sub(r'\)\*([^\n])', r')*\n\1', ai_reply)
-        
-        # 確保對話和旁白之間有換行
-        ai_reply = re.sub(r'([^\n])\*\(', r'\1\n*(', ai_reply)
-        
-        return ai_reply
+        return format_reply(response, character)
     
-    async def _get_memory_text(self, user_id: str, character_id: str) -> str:
+    async def _get_memory_text(self, user_id: str, character_id: str, user_message: str = "",
+                               chat_history: List[Dict[str, str]] = None) -> str:
         """
-        獲取角色記憶文本
+        獲取角色記憶文本（記憶很多時按與當前消息的相關度挑選）
         """
         try:
             # 從記憶管理器獲取格式化的記憶文本
             from memory_manager import memory_manager
-            return await memory_manager.get_formatted_memory(user_id, character_id)
+            return await memory_manager.get_formatted_memory(user_id, character_id, user_message, chat_history,
+                                                             self.token_estimator)
         except Exception as e:
             print(f"獲取記憶時出錯: {str(e)}")
             return "" 
\ No newline at end of file
@@ -0,0 +1,140 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncIterator, Tuple
+
+class ConversationLocks:
+    """
+    每段對話一把鎖：同一對話的回合依序執行，不同對話之間完全並行
+
+    鎖只在有人持有或等待時存在，用完即移除，因此數量不會隨對話總數增長。
+    同時記錄每段對話的排隊等待時間。鎖只作用於本程序；使用多個 worker 時，
+    同一對話的請求應由負載平衡器按用戶分配到同一個 worker。
+    """
+
+    def __init__(self):
+        """初始化鎖管理器"""
+        # 保留等待統計的對話數上限（按最近使用淘汰）
+        self.max_tracked = int(os.getenv("CONVERSATION_QUEUE_STATS_MAX", "1000"))
+
+        self._locks = {}  # (範圍, 用戶ID, 角色ID) -> [asyncio.Lock, 持有和等待的數量]
+        self._conversation_stats = OrderedDict()  # (範圍, 用戶ID, 角色ID) -> 等待統計
+        self._stats = {
+            "acquired": 0,
+            "contended": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0
+        }
+
+    @asynccontextmanager
+    async def hold(self, user_id: str, character_id: str, scope: str = "turn") -> AsyncIterator[float]:
+        """
+        持有對話的鎖
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            scope: 鎖的範圍（"turn" 用於聊天回合，"memory" 用於後台記憶更新，互不阻塞）
+
+        返回:
+            async with 取得的值為排隊等待的毫秒數
+        """
+        key = (scope, user_id, character_id)
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        contended = entry[0].locked()
+        start = time.perf_counter()
+        try:
+            async with entry[0]:
+                wait_ms = (time.perf_counter() - start) * 1000
+                self._record(key, wait_ms, contended)
+                yield wait_ms
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+    def queued(self, user_id: str, character_id: str, scope: str = "turn") -> int:
+        """返回正在排隊等待該對話的請求數（不包括正在執行的）"""
+        entry = self._locks.get((scope, user_id, character_id))
+        if entry is None:
+            return 0
+        return entry[1] - (1 if entry[0].locked() else 0)
+
+    def _record(self, key: Tuple[str, str, str], wait_ms: float, contended: bool) -> None:
+        """記錄一次等待"""
+        self._stats["acquired"] += 1
+        self._stats["total_wait_ms"] += wait_ms
+        self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+        if contended:
+            self._stats["contended"] += 1
+
+        stats = self._conversation_stats.get(key)
+        if stats is None:
+            stats = self._conversation_stats[key] = {"acquired": 0, "contended": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+            if len(self._conversation_stats) > self.max_tracked:
+                self._conversation_stats.popitem(last=False)
+        else:
+            self._conversation_stats.move_to_end(key)
+        stats["acquired"] += 1
+        stats["total_wait_ms"] += wait_ms
+        stats["max_wait_ms"] = max(stats["max_wait_ms"], wait_ms)
+        if contended:
+            stats["contended"] += 1
+
+    @staticmethod
+    def _summarize(stats: Dict[str, Any]) -> Dict[str, Any]:
+        """計算平均等待時間並四捨五入"""
+        acquired = stats["acquired"]
+        return {
+            "acquired": acquired,
+            "contended": stats["contended"],
+            "avg_wait_ms": round(stats["total_wait_ms"] / acquired, 2) if acquired else 0.0,
+            "max_wait_ms": round(stats["max_wait_ms"], 2)
+        }
+
+    def get_conversation_stats(self, user_id: str, character_id: str) -> Dict[str, Any]:
+        """
+        獲取特定對話的排隊統計
+
+        返回:
+            各範圍的等待次數、平均和最長等待時間，以及目前排隊數
+        """
+        result = {}
+        for scope in ("turn", "memory"):
+            stats = self._conversation_stats.get((scope, user_id, character_id))
+            if stats is not None:
+                result[scope] = self._summarize(stats)
+        return {"queued": self.queued(user_id, character_id), **result}
+
+    def get_stats(self, top: int = 10) -> Dict[str, Any]:
+        """
+        獲取整體排隊統計
+
+        參數:
+            top: 返回平均等待時間最長的對話數量
+
+        返回:
+            包含整體等待統計、目前的鎖數量和等待最久的對話的字典
+        """
+        slowest = sorted(
+            self._conversation_stats.items(),
+            key=lambda item: item[1]["total_wait_ms"] / item[1]["acquired"],
+            reverse=True
+        )[:top]
+        return {
+            **self._summarize(self._stats),
+            "active_locks": len(self._locks),
+            "queued": sum(entry[1] - (1 if entry[0].locked() else 0) for entry in self._locks.values()),
+            "slowest_conversations": [
+                {"scope": scope, "user_id": user_id, "character_id": character_id, **self._summarize(stats)}
+                for (scope, user_id, character_id), stats in slowest
+            ]
+        }
+
+# 創建單例實例
+conversation_locks = ConversationLocks()
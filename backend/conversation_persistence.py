@@ -0,0 +1,543 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+from dotenv import load_dotenv
+from conversation_store import conversation_store, Conversation, Message
+
+# 載入環境變數
+load_dotenv()
+
+# PostgreSQL 建表語句（與記憶共用同一個資料庫）
+POSTGRES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        character_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS conversation_states (
+        user_id TEXT NOT NULL,
+        character_id TEXT NOT NULL,
+        affinity INTEGER NOT NULL,
+        turn_id INTEGER NOT NULL,
+        message_seq INTEGER NOT NULL,
+        summary TEXT,
+        memory_seq INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (user_id, character_id)
+    )
+    """
+]
+
+# SQLite 建表語句（本地開發用）
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        character_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS conversation_states (
+        user_id TEXT NOT NULL,
+        character_id TEXT NOT NULL,
+        affinity INTEGER NOT NULL,
+        turn_id INTEGER NOT NULL,
+        message_seq INTEGER NOT NULL,
+        summary TEXT,
+        memory_seq INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, character_id)
+    )
+    """
+]
+
+# 舊版本建立的 conversation_states 缺少的欄位：(欄位名稱, 定義)
+STATE_COLUMNS = [
+    ("memory_seq", "INTEGER NOT NULL DEFAULT 0")
+]
+
+# 同一對話的消息序號唯一；舊版本的索引不是唯一索引，建立前先移除重複的消息（保留最後寫入的一筆）
+MESSAGE_SEQ_INDEX = "idx_chat_messages_seq"
+MESSAGE_SEQ_MIGRATION = {
+    "postgresql": [
+        """
+        DELETE FROM chat_messages a USING chat_messages b
+        WHERE a.user_id = b.user_id AND a.character_id = b.character_id AND a.seq = b.seq AND a.id < b.id
+        """,
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {MESSAGE_SEQ_INDEX} ON chat_messages (user_id, character_id, seq)",
+        "DROP INDEX IF EXISTS idx_chat_messages_conversation"
+    ],
+    "sqlite": [
+        """
+        DELETE FROM chat_messages WHERE id NOT IN (
+            SELECT MAX(id) FROM chat_messages GROUP BY user_id, character_id, seq
+        )
+        """,
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {MESSAGE_SEQ_INDEX} ON chat_messages (user_id, character_id, seq)",
+        "DROP INDEX IF EXISTS idx_chat_messages_conversation"
+    ]
+}
+
+class ConversationLoadError(RuntimeError):
+    """
+    無法從資料庫讀取對話
+
+    與「資料庫中沒有記錄」不同：呼叫者不能把對話當成新對話建立，
+    否則之後的寫入會以默認狀態覆蓋資料庫中的記錄。
+    """
+
+class ConversationPersistence:
+    """
+    將對話歷史和好感度持久化到資料庫
+
+    - 讀取：對話第一次被存取（或被對話存儲淘汰後再次存取）時才由狀態後端從資料庫載入
+    - 寫入：請求路徑只把變更放進佇列，後台任務每隔一段時間或佇列達到批次大小時
+      在執行緒中一次寫入，請求不必等待資料庫
+    - 關閉應用時送出所有尚未寫入的變更
+
+    CONVERSATION_DB_URL 為 postgresql://... 時使用 PostgreSQL，為 sqlite:///路徑 時使用 SQLite；
+    未設定時沿用記憶使用的 DATABASE_URL，兩者都沒有時只保存在記憶體中。
+    """
+
+    def __init__(self):
+        """初始化持久化層（從環境變數讀取資料庫位址和批次設定）"""
+        self.db_url = os.getenv("CONVERSATION_DB_URL") or os.getenv("DATABASE_URL") or ""
+        self.enabled = (
+            os.getenv("CONVERSATION_PERSISTENCE_ENABLED", "true").lower() == "true" and bool(self.db_url)
+        )
+        self.is_sqlite = self.db_url.startswith("sqlite:///")
+
+        # 寫入批次設定
+        self.flush_interval = float(os.getenv("CONVERSATION_FLUSH_INTERVAL_SECONDS", "1.0"))
+        self.flush_batch_size = int(os.getenv("CONVERSATION_FLUSH_BATCH_SIZE", "500"))
+
+        self.conn = None
+        self._db_lock = threading.Lock()  # 資料庫連接只在一個執行緒中使用
+        self._flush_lock = asyncio.Lock()
+        self._flush_event = asyncio.Event()
+        self._flush_task = None
+
+        # 依序執行的寫入操作：("message", 用戶ID, 角色ID, 序號, 角色, 內容) 或 ("clear", 用戶ID, 角色ID)
+        self._ops = []
+        # 需要寫入的對話狀態快照（同一對話只保留最新的一份）
+        self._dirty_states = {}  # (用戶ID, 角色ID) -> (好感度, 回合ID, 消息序號, 摘要JSON, 記憶提取序號)
+        self._oldest_pending = None  # 最早一筆未寫入變更的時間
+
+        self._stats = {
+            "loads": 0,
+            "load_failures": 0,
+            "flushes": 0,
+            "flush_failures": 0,
+            "rows_written": 0,
+            "last_flush_ms": 0.0,
+            "max_lag_seconds": 0.0
+        }
+        self._last_error = None
+
+    def _sql(self, query: str) -> str:
+        """將 PostgreSQL 的佔位符轉換為目前資料庫的格式"""
+        return query.replace("%s", "?") if self.is_sqlite else query
+
+    def _connect(self) -> None:
+        """建立資料庫連接並確保資料表存在（在執行緒中呼叫）"""
+        if self.is_sqlite:
+            path = self.db_url[len("sqlite:///"):]
+            self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            schema = SQLITE_SCHEMA
+        else:
+            import psycopg2
+            self.conn = psycopg2.connect(self.db_url)
+            self.conn.autocommit = True
+            schema = POSTGRES_SCHEMA
+
+        cur = self.conn.cursor()
+        try:
+            if self.is_sqlite:
+                # 其他程序持有寫入鎖時等待，而不是立即失敗
+                cur.execute("PRAGMA busy_timeout=5000")
+            for statement in schema:
+                cur.execute(statement)
+            for name, definition in STATE_COLUMNS:
+                if not self._has_column(cur, "conversation_states", name):
+                    cur.execute(f"ALTER TABLE conversation_states ADD COLUMN {name} {definition}")
+            if not self._has_index(cur, MESSAGE_SEQ_INDEX):
+                for statement in MESSAGE_SEQ_MIGRATION["sqlite" if self.is_sqlite else "postgresql"]:
+                    cur.execute(statement)
+        finally:
+            cur.close()
+
+    def _has_index(self, cur, name: str) -> bool:
+        """資料庫中是否已有指定名稱的索引"""
+        if self.is_sqlite:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+            return cur.fetchone() is not None
+        cur.execute("SELECT to_regclass(%s)", (name,))
+        return cur.fetchone()[0] is not None
+
+    def _has_column(self, cur, table: str, name: str) -> bool:
+        """資料表中是否已有指定名稱的欄位"""
+        if self.is_sqlite:
+            cur.execute(f"PRAGMA table_info({table})")
+            return any(row[1] == name for row in cur.fetchall())
+        cur.execute(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+            (table, name)
+        )
+        return cur.fetchone() is not None
+
+    async def start(self) -> None:
+        """連接資料庫並啟動後台寫入任務（應用啟動時呼叫）"""
+        if not self.enabled:
+            print("未設定對話資料庫，對話歷史和好感度只保存在記憶體中")
+            return
+        try:
+            await asyncio.to_thread(self._connect)
+            print(f"成功連接到對話資料庫（{'SQLite' if self.is_sqlite else 'PostgreSQL'}）")
+        except Exception as e:
+            self.enabled = False
+            self.conn = None
+            print(f"連接對話資料庫時出錯，對話只保存在記憶體中: {str(e)}")
+            return
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    # ---- 讀取 ----
+
+    async def fetch_state(self, user_id: str, character_id: str) -> Optional[Dict[str, Any]]:
+        """
+        從資料庫讀取對話狀態
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+
+        返回:
+            可直接傳給 ConversationStore.restore 的狀態字典
+            {"messages", "affinity", "turn_id", "message_seq", "summary", "memory_seq"}；
+            未啟用持久化或沒有記錄時為 None
+
+        異常:
+            ConversationLoadError: 讀取失敗（呼叫者不能把對話當成新對話建立）
+        """
+        if not self.enabled:
+            return None
+        # 不等待後台寫入：持有寫入鎖期間讀取（不會有寫入進行到一半），
+        # 再套用佇列中該對話尚未寫入的變更（對話可能在變更寫入前就被淘汰）
+        async with self._flush_lock:
+            try:
+                row, messages = await asyncio.to_thread(self._load_rows, user_id, character_id)
+            except Exception as e:
+                self._stats["load_failures"] += 1
+                self._last_error = str(e)
+                print(f"從資料庫載入對話時出錯: {str(e)}")
+                raise ConversationLoadError(f"無法載入對話 {user_id}/{character_id}: {str(e)}") from e
+            row, messages = self._apply_pending(user_id, character_id, row, messages)
+
+        self._stats["loads"] += 1
+        if row is None:
+            return None
+        affinity, turn_id, message_seq, summary_json, memory_seq = row
+        return {
+            "messages": messages,
+            "affinity": affinity,
+            "turn_id": turn_id,
+            "message_seq": message_seq,
+            "summary": json.loads(summary_json) if summary_json else None,
+            "memory_seq": memory_seq
+        }
+
+    def _apply_pending(self, user_id: str, character_id: str, row: Optional[tuple],
+                       messages: List[Tuple[int, str, str]]) -> Tuple[Optional[tuple], List[Tuple[int, str, str]]]:
+        """依寫入時的順序，將佇列中該對話的變更套用到讀取結果（持有 _flush_lock 時呼叫）"""
+        for op in self._ops:
+            if op[0] == "message":
+                if op[1] == user_id and op[2] == character_id:
+                    messages.append(op[3:])
+            elif (op[1] is None or op[1] == user_id) and (op[2] is None or op[2] == character_id):
+                messages = []
+                if row is not None:
+                    row = row[:3] + (None,) + row[4:]
+        state = self._dirty_states.get((user_id, character_id))
+        if state is not None:
+            row = state
+
+        folded_seq = json.loads(row[3]).get("folded_seq", 0) if row is not None and row[3] else 0
+        latest = {}
+        for message in messages:
+            if message[0] > folded_seq:
+                latest[message[0]] = message
+        messages = [latest[seq] for seq in sorted(latest)][-conversation_store.message_capacity:]
+        return row, messages
+
+    def _ensure_connection(self) -> None:
+        """連接在出錯後被關閉時重新連接（在執行緒中、持有 _db_lock 時呼叫）"""
+        if self.conn is None:
+            self._connect()
+
+    def _drop_connection(self) -> None:
+        """關閉可能已失效的連接，下次使用時重新連接（持有 _db_lock 時呼叫）"""
+        try:
+            self.conn.close()
+        except Exception:
+            pass  # 忽略關閉錯誤
+        self.conn = None
+
+    def _load_rows(self, user_id: str, character_id: str) -> Tuple[Optional[tuple], List[Tuple[int, str, str]]]:
+        """讀取對話狀態和未摺疊的最新消息（在執行緒中呼叫）"""
+        with self._db_lock:
+            self._ensure_connection()
+            cur = self.conn.cursor()
+            try:
+                cur.execute(self._sql("""
+                    SELECT affinity, turn_id, message_seq, summary, memory_seq
+                    FROM conversation_states
+                    WHERE user_id = %s AND character_id = %s
+                """), (user_id, character_id))
+                row = cur.fetchone()
+
+                folded_seq = 0
+                if row is not None and row[3]:
+                    folded_seq = json.loads(row[3]).get("folded_seq", 0)
+
+                cur.execute(self._sql("""
+                    SELECT seq, role, content
+                    FROM chat_messages
+                    WHERE user_id = %s AND character_id = %s AND seq > %s
+                    ORDER BY seq DESC
+                    LIMIT %s
+                """), (user_id, character_id, folded_seq, conversation_store.message_capacity))
+                messages = [tuple(message) for message in reversed(cur.fetchall())]
+            except Exception:
+                cur.close()
+                self._drop_connection()
+                raise
+            cur.close()
+        return (tuple(row) if row is not None else None), messages
+
+    # ---- 寫入 ----
+
+    def _queued(self) -> None:
+        """記錄佇列中最早的變更時間，佇列達到批次大小時立即觸發寫入"""
+        if self._oldest_pending is None:
+            self._oldest_pending = time.monotonic()
+        if len(self._ops) + len(self._dirty_states) >= self.flush_batch_size:
+            self._flush_event.set()
+
+    def record_message(self, user_id: str, character_id: str, message: Message) -> None:
+        """
+        將新增的消息放進寫入佇列
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            message: 新增的消息
+        """
+        if not self.enabled:
+            return
+        self._ops.append(("message", user_id, character_id, message.seq, message.role, message.content))
+        self.mark_dirty(user_id, character_id)
+
+    def mark_dirty(self, user_id: str, character_id: str) -> None:
+        """
+        記錄對話狀態（好感度、回合ID、摘要、記憶提取序號）的最新快照，等待寫入
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+        """
+        if not self.enabled:
+            return
+        conversation = conversation_store.peek(user_id, character_id)
+        if conversation is None:
+            return
+        self._dirty_states[(user_id, character_id)] = self._snapshot(conversation)
+        self._queued()
+
+    def record_clear(self, user_id: Optional[str] = None, character_id: Optional[str] = None) -> None:
+        """
+        將清除對話消息和摘要的操作放進寫入佇列
+
+        參數:
+            user_id: 用戶ID（可選，不提供時清除所有對話）
+            character_id: 角色ID（可選，不提供時清除該用戶的所有對話）
+        """
+        if not self.enabled:
+            return
+        self._ops.append(("clear", user_id, character_id))
+        self._queued()
+
+    def _snapshot(self, conversation: Conversation) -> Tuple[int, int, int, Optional[str], int]:
+        """擷取對話狀態（對話之後可能被淘汰，因此不保留物件引用）"""
+        summary = json.dumps(conversation.summary, ensure_ascii=False) if conversation.summary else None
+        return (conversation.affinity, conversation.turn_id, conversation.message_seq, summary,
+                conversation.memory_seq)
+
+    async def _flush_loop(self) -> None:
+        """後台寫入任務：每隔 flush_interval 秒或佇列滿時寫入一次"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """將佇列中的所有變更寫入資料庫（失敗時保留，下次重試）"""
+        async with self._flush_lock:
+            if not self.enabled or not (self._ops or self._dirty_states):
+                return
+
+            ops, self._ops = self._ops, []
+            states, self._dirty_states = self._dirty_states, {}
+            oldest, self._oldest_pending = self._oldest_pending, None
+            if oldest is not None:
+                self._stats["max_lag_seconds"] = max(self._stats["max_lag_seconds"], time.monotonic() - oldest)
+
+            start = time.perf_counter()
+            try:
+                rows = await asyncio.to_thread(self._write_batch, ops, states)
+            except Exception as e:
+                # 放回佇列開頭，保留與之後變更的先後順序
+                self._ops = ops + self._ops
+                for key, state in states.items():
+                    self._dirty_states.setdefault(key, state)
+                self._oldest_pending = oldest
+                self._stats["flush_failures"] += 1
+                self._last_error = str(e)
+                print(f"寫入對話資料庫時出錯，稍後重試: {str(e)}")
+                return
+
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += rows
+            self._stats["last_flush_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    def _write_batch(self, ops: List[tuple], states: Dict[Tuple[str, str], tuple]) -> int:
+        """在一個交易中依序寫入一批變更（在執行緒中呼叫），返回寫入的列數"""
+        # 提交成功但連接隨後出錯時整批會重試，已寫入的消息略過
+        insert_message = self._sql("""
+            INSERT INTO chat_messages (user_id, character_id, seq, role, content)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (user_id, character_id, seq) DO NOTHING
+        """)
+        rows = 0
+        with self._db_lock:
+            self._ensure_connection()
+            cur = self.conn.cursor()
+            try:
+                cur.execute("BEGIN")
+                pending_messages = []
+                for op in ops:
+                    if op[0] == "message":
+                        pending_messages.append(op[1:])
+                        continue
+                    # 清除操作之前的消息必須先寫入
+                    if pending_messages:
+                        cur.executemany(insert_message, pending_messages)
+                        rows += len(pending_messages)
+                        pending_messages = []
+                    rows += self._write_clear(cur, op[1], op[2])
+                if pending_messages:
+                    cur.executemany(insert_message, pending_messages)
+                    rows += len(pending_messages)
+
+                if states:
+                    cur.executemany(self._sql("""
+                        INSERT INTO conversation_states
+                            (user_id, character_id, affinity, turn_id, message_seq, summary, memory_seq, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                        ON CONFLICT (user_id, character_id) DO UPDATE SET
+                            affinity = excluded.affinity,
+                            turn_id = excluded.turn_id,
+                            message_seq = excluded.message_seq,
+                            summary = excluded.summary,
+                            memory_seq = excluded.memory_seq,
+                            updated_at = excluded.updated_at
+                    """), [key + state for key, state in states.items()])
+                    rows += len(states)
+                cur.execute("COMMIT")
+            except Exception:
+                try:
+                    cur.execute("ROLLBACK")
+                except Exception:
+                    pass
+                cur.close()
+                self._drop_connection()
+                raise
+            cur.close()
+        return rows
+
+    def _write_clear(self, cur, user_id: Optional[str], character_id: Optional[str]) -> int:
+        """刪除對話消息並清除摘要，返回刪除的消息數"""
+        conditions = []
+        params = []
+        if user_id is not None:
+            conditions.append("user_id = %s")
+            params.append(user_id)
+        if character_id is not None:
+            conditions.append("character_id = %s")
+            params.append(character_id)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        cur.execute(self._sql(f"DELETE FROM chat_messages{where}"), params)
+        deleted = cur.rowcount
+        cur.execute(self._sql(f"UPDATE conversation_states SET summary = NULL{where}"), params)
+        return max(deleted, 0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        獲取持久化統計
+
+        返回:
+            包含佇列長度、目前延遲、寫入次數和失敗次數的字典
+        """
+        lag = time.monotonic() - self._oldest_pending if self._oldest_pending is not None else 0.0
+        return {
+            "enabled": self.enabled,
+            "backend": ("sqlite" if self.is_sqlite else "postgresql") if self.enabled else None,
+            "pending_ops": len(self._ops),
+            "pending_states": len(self._dirty_states),
+            "lag_seconds": round(lag, 3),
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self._stats.items()},
+            "last_error": self._last_error
+        }
+
+    async def close(self) -> None:
+        """停止後台任務、送出所有尚未寫入的變更並關閉連接（應用關閉時呼叫）"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if not self.enabled or self.conn is None:
+            return
+
+        await self.flush()
+        if self._ops or self._dirty_states:
+            print(f"警告：關閉時仍有 {len(self._ops) + len(self._dirty_states)} 筆對話變更未能寫入資料庫")
+        with self._db_lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        print("已斷開與對話資料庫的連接")
+
+# 創建單例實例
+conversation_persistence = ConversationPersistence()
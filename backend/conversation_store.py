@@ -0,0 +1,265 @@
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Any, Iterable, Iterator, Optional, Tuple
+
+class Message:
+    """
+    對話中的一條消息
+
+    使用 __slots__ 取代每條消息一個字典，並支援 msg["role"] / msg.get("content")
+    的讀取方式，讓處理器和記憶管理器不需要修改。
+    """
+
+    __slots__ = ("role", "content", "seq")
+
+    def __init__(self, role: str, content: str, seq: int = 0):
+        # 角色只有少數幾種取值，駐留後所有消息共用同一個字串物件
+        self.role = sys.intern(role)
+        self.content = content
+        self.seq = seq  # 對話內單調遞增的序號，用於持久化和標記已摺疊的位置
+
+    def __getitem__(self, key: str) -> str:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+    def to_dict(self) -> Dict[str, str]:
+        """轉換為 {"role", "content"} 字典"""
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self) -> str:
+        return f"Message(role={self.role!r}, content={self.content[:20]!r})"
+
+class Conversation:
+    """一段 (用戶, 角色) 對話在記憶體中的狀態"""
+
+    __slots__ = ("messages", "affinity", "turn_id", "message_seq", "affinity_updates", "summary", "memory_seq",
+                 "last_access")
+
+    def __init__(self, capacity: int, affinity: int, max_affinity_updates: int):
+        # 固定容量的環形緩衝區：超出容量時自動丟棄最舊的消息，不需要重新切片
+        self.messages = deque(maxlen=capacity)
+        self.affinity = affinity
+        self.turn_id = 0  # 最新的回合ID
+        self.message_seq = 0  # 最新消息的序號
+        self.affinity_updates = deque(maxlen=max_affinity_updates)  # 最近完成的好感度變化
+        self.summary = None  # 滾動摘要 {"text", "folded_messages", "folded_tokens", "summary_tokens", "recent_folded_chars", "folded_seq"}
+        self.memory_seq = 0  # 記憶提取已成功處理的最後一條消息的序號（隨對話狀態持久化）
+        self.last_access = time.monotonic()
+
+class ConversationStore:
+    """
+    有界的對話狀態存儲
+
+    以 (用戶ID, 角色ID) 為鍵保存 Conversation，按最近使用排序：
+    超過 max_conversations 時淘汰最久未使用的對話，超過 ttl 秒未使用的對話在存取時一併清除。
+    每段對話的消息保存在固定容量的環形緩衝區中，因此總記憶體有明確的上限。
+    """
+
+    def __init__(self):
+        """初始化存儲（從環境變數讀取容量設定）"""
+        self.message_capacity = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "50"))
+        self.max_conversations = int(os.getenv("CONVERSATION_STORE_MAX_CONVERSATIONS", "50000"))
+        self.ttl = float(os.getenv("CONVERSATION_STORE_TTL_SECONDS", "86400"))
+        self.default_affinity = 0  # 範圍為 0-100
+        self.max_affinity_updates = 20  # 每段對話保留最近的結果數量
+
+        self._conversations: "OrderedDict[Tuple[str, str], Conversation]" = OrderedDict()
+        self._content_chars = 0  # 所有消息內容的字元數，用於估算記憶體用量
+        self._stats = {
+            "created": 0,
+            "evicted_lru": 0,
+            "evicted_ttl": 0,
+            "replaced": 0
+        }
+
+    def get(self, user_id: str, character_id: str, create: bool = True) -> Optional[Conversation]:
+        """
+        獲取對話狀態
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            create: 不存在時是否建立
+
+        返回:
+            Conversation（create 為 False 且不存在時為 None）
+        """
+        key = (user_id, character_id)
+        now = time.monotonic()
+        conversation = self._conversations.get(key)
+        if conversation is not None:
+            if now - conversation.last_access > self.ttl:
+                self._remove(key, "evicted_ttl")
+                conversation = None
+            else:
+                conversation.last_access = now
+                self._conversations.move_to_end(key)
+                return conversation
+
+        self._expire(now)
+        if not create:
+            return None
+
+        conversation = Conversation(self.message_capacity, self.default_affinity, self.max_affinity_updates)
+        self._conversations[key] = conversation
+        self._stats["created"] += 1
+        while len(self._conversations) > self.max_conversations:
+            self._remove(next(iter(self._conversations)), "evicted_lru")
+        return conversation
+
+    def peek(self, user_id: str, character_id: str) -> Optional[Conversation]:
+        """獲取對話狀態但不更新最近使用時間，也不建立新對話"""
+        return self._conversations.get((user_id, character_id))
+
+    def append(self, user_id: str, character_id: str, role: str, content: str, seq: int = None) -> Message:
+        """
+        添加消息到對話
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            role: 消息角色（"user" 或 "assistant"）
+            content: 消息內容
+            seq: 消息序號（可選，由共享狀態後端分配時傳入，否則使用下一個序號）
+
+        返回:
+            新增的消息
+        """
+        conversation = self.get(user_id, character_id)
+        messages = conversation.messages
+        if len(messages) == messages.maxlen:
+            self._content_chars -= len(messages[0].content)
+        conversation.message_seq = seq if seq is not None else conversation.message_seq + 1
+        message = Message(role, content, conversation.message_seq)
+        messages.append(message)
+        self._content_chars += len(content)
+        return message
+
+    def restore(self, user_id: str, character_id: str, messages: Iterable[Tuple[int, str, str]],
+                affinity: int, turn_id: int, message_seq: int,
+                summary: Optional[Dict[str, Any]] = None, memory_seq: int = 0) -> Conversation:
+        """
+        以持久化的狀態建立對話（取代記憶體中同鍵的對話）
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            messages: 由舊到新的 (序號, 角色, 內容)，超出容量時只保留最新的部分
+            affinity: 好感度
+            turn_id: 最新的回合ID
+            message_seq: 最新消息的序號
+            summary: 滾動摘要（可選）
+            memory_seq: 記憶提取已處理的最後一條消息的序號
+
+        返回:
+            建立的 Conversation
+        """
+        key = (user_id, character_id)
+        if key in self._conversations:
+            self._remove(key, "replaced")
+        conversation = self.get(user_id, character_id)
+        for seq, role, content in messages:
+            if len(conversation.messages) == conversation.messages.maxlen:
+                self._content_chars -= len(conversation.messages[0].content)
+            conversation.messages.append(Message(role, content, seq))
+            self._content_chars += len(content)
+        conversation.affinity = affinity
+        conversation.turn_id = turn_id
+        conversation.message_seq = max(message_seq, conversation.messages[-1].seq if conversation.messages else 0)
+        conversation.summary = summary
+        conversation.memory_seq = memory_seq
+        return conversation
+
+    def drop_through(self, user_id: str, character_id: str, seq: int) -> int:
+        """
+        從對話開頭移除序號不大於 seq 的消息
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            seq: 要移除的最後一條消息的序號
+
+        返回:
+            實際移除的數量
+        """
+        conversation = self.peek(user_id, character_id)
+        if conversation is None:
+            return 0
+        count = 0
+        while conversation.messages and conversation.messages[0].seq <= seq:
+            self._content_chars -= len(conversation.messages.popleft().content)
+            count += 1
+        return count
+
+    def clear_messages(self, user_id: Optional[str] = None, character_id: Optional[str] = None) -> None:
+        """
+        清除對話的消息和摘要（保留好感度和回合ID）
+
+        參數:
+            user_id: 用戶ID（可選，不提供時清除所有對話）
+            character_id: 角色ID（可選，不提供時清除該用戶的所有對話）
+        """
+        for (uid, cid), conversation in self._conversations.items():
+            if (user_id is None or uid == user_id) and (character_id is None or cid == character_id):
+                self._content_chars -= sum(len(msg.content) for msg in conversation.messages)
+                conversation.messages.clear()
+                conversation.summary = None
+
+    def _expire(self, now: float) -> None:
+        """清除已超過 TTL 的對話（按最近使用排序，只需檢查開頭）"""
+        while self._conversations:
+            key, conversation = next(iter(self._conversations.items()))
+            if now - conversation.last_access <= self.ttl:
+                break
+            self._remove(key, "evicted_ttl")
+
+    def _remove(self, key: Tuple[str, str], reason: str) -> None:
+        """移除對話並更新統計"""
+        conversation = self._conversations.pop(key)
+        self._content_chars -= sum(len(msg.content) for msg in conversation.messages)
+        self._stats[reason] += 1
+
+    def keys(self) -> list:
+        """所有對話的 (用戶ID, 角色ID)"""
+        return list(self._conversations)
+
+    def values(self) -> Iterator[Conversation]:
+        """依最近使用順序（由舊到新）遍歷所有對話"""
+        return iter(self._conversations.values())
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        獲取存儲統計
+
+        返回:
+            包含對話數、消息數、估算的記憶體用量和淘汰次數的字典
+        """
+        message_count = sum(len(conversation.messages) for conversation in self._conversations.values())
+        # 估算：每條消息的 slots 物件 + deque 指標，內容以 UCS-2 計（中文字元為 2 位元組）
+        message_bytes = message_count * (sys.getsizeof(Message("user", "")) + 8) + self._content_chars * 2
+        conversation_bytes = len(self._conversations) * (
+            sys.getsizeof(Conversation(0, 0, 0)) + 2 * sys.getsizeof(deque()) + 100
+        )
+        return {
+            "conversations": len(self._conversations),
+            "messages": message_count,
+            "content_chars": self._content_chars,
+            "estimated_bytes": message_bytes + conversation_bytes,
+            "max_conversations": self.max_conversations,
+            "message_capacity": self.message_capacity,
+            "ttl_seconds": self.ttl,
+            **self._stats
+        }
+
+# 創建單例實例
+conversation_store = ConversationStore()
@@ -0,0 +1,269 @@
+import os
+import asyncio
+from itertools import islice
+from typing import Dict, Any, List, Sequence, Tuple
+from model_factory import ModelFactory
+from token_budget import TokenEstimator, count_characters, get_input_token_budget, DEFAULT_INPUT_TOKEN_BUDGETS, MESSAGE_OVERHEAD_TOKENS
+from conversation_store import conversation_store, Message
+from conversation_persistence import conversation_persistence
+from state_backend import state_backend
+
+class ConversationSummarizer:
+    """
+    將超出保留窗口的對話摺疊成每段對話的滾動摘要
+
+    對話中未摺疊的消息超過「保留數量 + K 回合」時，在後台以低成本模型把較早的消息
+    連同現有摘要合併成新摘要，完成後由狀態後端將這些消息從對話中移除；
+    處理器在提示詞中以摘要取代原本的舊消息。摘要保存在對話存儲的 Conversation 中，
+    隨對話一起淘汰或重置。
+    """
+
+    def __init__(self):
+        """初始化摘要器（從環境變數讀取保留數量和觸發間隔）"""
+        self.enabled = os.getenv("CHAT_SUMMARY_ENABLED", "true").lower() == "true"
+
+        # 歷史中保留的原始消息數（不摺疊）
+        self.keep_messages = int(os.getenv("CHAT_SUMMARY_KEEP_MESSAGES", "12"))
+
+        # 窗口每前進 K 回合（2K 條消息）才摘要一次，避免每回合都呼叫模型
+        self.trigger_turns = int(os.getenv("CHAT_SUMMARY_TRIGGER_TURNS", "5"))
+
+        # 摘要長度上限
+        self.max_summary_chars = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", "1200"))
+        self.max_output_tokens = int(os.getenv("CHAT_SUMMARY_MAX_OUTPUT_TOKENS", "600"))
+
+        self._tasks = {}  # (用戶ID, 角色ID) -> 執行中的摘要任務
+
+        # 只用於統計節省量，不需要跟隨各供應商校正
+        self._estimator = TokenEstimator("")
+
+        # 每個摘要保存最近被摺疊的消息的字元數，用來估算它們原本能否放進處理器的歷史預算；
+        # 估算器的校正比例最低為 0.5，保存到任何供應商預算的兩倍即足夠
+        self.recent_folded_token_limit = 2 * max(
+            get_input_token_budget(provider) for provider in DEFAULT_INPUT_TOKEN_BUDGETS
+        )
+
+        self._stats = {
+            "summaries": 0,
+            "failures": 0,
+            "folded_messages": 0,
+            "requests_with_summary": 0,
+            "tokens_saved": 0
+        }
+
+    @property
+    def trigger_messages(self) -> int:
+        """觸發摘要所需的未摺疊消息數"""
+        return self.keep_messages + self.trigger_turns * 2
+
+    def _get_entry(self, user_id: str, character_id: str) -> Dict[str, Any]:
+        """獲取對話的摘要記錄（不存在時為 None）"""
+        conversation = conversation_store.peek(user_id, character_id)
+        return conversation.summary if conversation is not None else None
+
+    def get_summary(self, user_id: str, character_id: str) -> str:
+        """
+        獲取對話的摘要
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+
+        返回:
+            摘要文本（沒有時為空字串）
+        """
+        entry = self._get_entry(user_id, character_id)
+        return entry["text"] if entry else ""
+
+    def get_summary_info(self, user_id: str, character_id: str) -> Dict[str, Any]:
+        """
+        獲取對話的摘要、摺疊的消息數和 token 數
+
+        每次請求實際節省的 token 數取決於處理器的歷史預算，見 record_request 和 get_stats。
+        """
+        entry = self._get_entry(user_id, character_id)
+        if not entry:
+            return {"summary": "", "folded_messages": 0, "folded_tokens": 0, "summary_tokens": 0}
+        return {
+            "summary": entry["text"],
+            "folded_messages": entry["folded_messages"],
+            "folded_tokens": entry["folded_tokens"],
+            "summary_tokens": entry["summary_tokens"]
+        }
+
+    def record_request(self, user_id: str, character_id: str, free_tokens: int, summary_tokens: int,
+                       estimator: TokenEstimator) -> int:
+        """
+        記錄一次使用摘要的請求
+
+        沒有摘要時，被摺疊的消息也只有從最新往前、能放進歷史預算剩餘空間的部分會被送出，
+        因此只計算這部分消息的 token 數，再扣除摘要本身的 token 數。
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            free_tokens: 不使用摘要時，保留的歷史之外還能放入的 token 數
+            summary_tokens: 這次請求中摘要佔用的 token 數
+            estimator: 處理器的 token 估算器
+
+        返回:
+            這次請求節省的輸入 token 數（估算，不小於 0）
+        """
+        entry = self._get_entry(user_id, character_id)
+        if not entry:
+            return 0
+        replaced = 0
+        for cjk, other in entry.get("recent_folded_chars", ()):
+            cost = estimator.estimate_counts(cjk, other) + MESSAGE_OVERHEAD_TOKENS
+            if replaced + cost > free_tokens:
+                break
+            replaced += cost
+        saved = max(0, replaced - summary_tokens)
+        self._stats["requests_with_summary"] += 1
+        self._stats["tokens_saved"] += saved
+        return saved
+
+    def maybe_schedule(self, api_key: str, user_id: str, character_id: str, character: Dict[str, Any],
+                       chat_history: Sequence[Message], model_type: str) -> bool:
+        """
+        未摺疊的消息達到觸發數量時，在後台開始摘要
+
+        參數:
+            api_key: API密鑰
+            user_id: 用戶ID
+            character_id: 角色ID
+            character: 角色設定
+            chat_history: 對話歷史
+            model_type: 模型類型（使用同一供應商的低成本模型）
+
+        返回:
+            是否已開始摘要
+        """
+        key = (user_id, character_id)
+        if not self.enabled or len(chat_history) < self.trigger_messages:
+            return False
+        if key in self._tasks:
+            return False
+
+        # 保留最近的消息，其餘的摺疊進摘要（保留部分從用戶消息開始）
+        fold_count = len(chat_history) - self.keep_messages
+        for msg in islice(chat_history, fold_count, None):
+            if msg["role"] == "user":
+                break
+            fold_count += 1
+        to_fold = list(islice(chat_history, fold_count))
+        if not to_fold:
+            return False
+
+        task = asyncio.create_task(self._summarize(api_key, key, character, to_fold, model_type))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return True
+
+    def _build_prompt(self, character: Dict[str, Any], previous_summary: str,
+                      messages: List[Dict[str, str]]) -> str:
+        """構建摘要提示詞"""
+        lines = []
+        for msg in messages:
+            speaker = "用戶" if msg["role"] == "user" else character.get("name", "角色")
+            lines.append(f"{speaker}: {msg['content']}")
+        conversation = "\n".join(lines)
+
+        prompt = f"""你是對話摘要助手。請將用戶與角色「{character.get('name', '角色')}」之間較早的對話整理成簡潔的摘要，
+供角色在之後的對話中保持前後一致。
+
+要求：
+1. 保留重要的事實、約定、情感變化和未完成的話題
+2. 省略寒暄和重複的內容，不要加入對話中沒有的資訊
+3. 使用繁體中文，以第三人稱敘述，不超過 {self.max_summary_chars} 個字
+4. 只輸出摘要本身，不要任何標題或說明
+"""
+        if previous_summary:
+            prompt += f"\n現有摘要（請把新的對話合併進去）：\n{previous_summary}\n"
+        prompt += f"\n需要摘要的對話：\n{conversation}\n"
+        return prompt
+
+    async def _summarize(self, api_key: str, key: Tuple[str, str], character: Dict[str, Any],
+                         to_fold: List[Message], model_type: str) -> None:
+        """在後台產生新摘要並移除已摺疊的消息"""
+        user_id, character_id = key
+        try:
+            handler = ModelFactory.get_model_handler(model_type)
+            previous = self._get_entry(user_id, character_id)
+            prompt = self._build_prompt(character, previous["text"] if previous else "", to_fold)
+
+            result = await handler.complete(api_key, prompt, model=handler.summary_model,
+                                            max_output_tokens=self.max_output_tokens)
+            if not result["success"] or not result["text"].strip():
+                self._stats["failures"] += 1
+                print(f"產生對話摘要失敗: {result.get('error', '空白摘要')} {result.get('details', '')}")
+                return
+
+            summary = result["text"].strip()[:self.max_summary_chars]
+            folded_tokens = sum(self._estimator.estimate(msg["content"]) for msg in to_fold)
+            entry = {
+                "text": summary,
+                "folded_messages": (previous["folded_messages"] if previous else 0) + len(to_fold),
+                "folded_tokens": (previous["folded_tokens"] if previous else 0) + folded_tokens,
+                "summary_tokens": self._estimator.estimate(summary),
+                "recent_folded_chars": self._recent_folded_chars(to_fold, previous),
+                "folded_seq": to_fold[-1].seq  # 從資料庫載入時跳過此序號之前的消息
+            }
+
+            # 對話在摘要期間被重置時，被摺疊的消息已不在開頭，丟棄結果
+            if not await state_backend.set_summary(user_id, character_id, entry, to_fold[0].seq):
+                return
+            conversation_persistence.mark_dirty(user_id, character_id)
+            self._stats["summaries"] += 1
+            self._stats["folded_messages"] += len(to_fold)
+
+            print(f"已將 {len(to_fold)} 條消息摺疊進 {user_id} 與 {character_id} 的對話摘要")
+
+        except Exception as e:
+            self._stats["failures"] += 1
+            print(f"產生對話摘要時出錯: {str(e)}")
+
+    def _recent_folded_chars(self, to_fold: List[Message], previous: Dict[str, Any]) -> List[List[int]]:
+        """
+        最近被摺疊的消息的 [中日韓字元數, 其他字元數]，由新到舊排列
+
+        參數:
+            to_fold: 這次摺疊的消息（由舊到新）
+            previous: 原本的摘要記錄（可選，其中的消息都比這次摺疊的舊）
+
+        返回:
+            估算 token 數合計不超過 recent_folded_token_limit 的部分
+        """
+        counts = [list(count_characters(msg["content"])) for msg in reversed(to_fold)]
+        if previous:
+            counts.extend(previous.get("recent_folded_chars", ()))
+        total = 0
+        for index, (cjk, other) in enumerate(counts):
+            total += self._estimator.estimate_counts(cjk, other) + MESSAGE_OVERHEAD_TOKENS
+            if total > self.recent_folded_token_limit:
+                return counts[:index + 1]
+        return counts
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        獲取摘要統計
+
+        返回:
+            包含摘要次數、摺疊的消息數和節省的輸入 token 數的字典
+        """
+        stats = dict(self._stats)
+        requests = stats["requests_with_summary"]
+        stats["avg_tokens_saved_per_request"] = round(stats["tokens_saved"] / requests, 1) if requests else 0.0
+        stats["conversations"] = sum(
+            1 for conversation in conversation_store.values() if conversation.summary
+        )
+        stats["pending"] = len(self._tasks)
+        return stats
+
+    async def close(self) -> None:
+        """等待進行中的摘要完成（應用關閉時呼叫）"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+# 創建單例實例
+conversation_summarizer = ConversationSummarizer()
@@ -0,0 +1,172 @@
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncIterator
+from dotenv import load_dotenv
+
+# 載入環境變數
+load_dotenv()
+
+class DatabasePool:
+    """
+    記憶資料庫的非同步連接池
+
+    以 asyncpg 連接池取代單一共用的同步連接：查詢不再阻塞事件循環，
+    不同對話的記憶讀寫可以同時使用不同的連接。
+
+    - 連接數介於 DB_POOL_MIN_SIZE 和 DB_POOL_MAX_SIZE 之間，取用連接最多等待 DB_POOL_ACQUIRE_TIMEOUT 秒
+    - 只在取出閒置超過 DB_POOL_HEALTH_CHECK_IDLE_SECONDS 的連接時檢查連接是否有效，而不是每次查詢前都檢查
+    - 每條語句受伺服器端 statement_timeout 限制，避免慢查詢長時間佔用連接
+
+    需要安裝 asyncpg 套件 (pip install asyncpg)。
+    """
+
+    def __init__(self):
+        """初始化連接池設定（從環境變數讀取）"""
+        self.db_url = os.getenv("DATABASE_URL") or ""
+        self.min_size = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+        self.max_size = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+        self.acquire_timeout = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))
+        self.statement_timeout_ms = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+        self.max_idle = float(os.getenv("DB_POOL_MAX_IDLE_SECONDS", "300"))  # 閒置超過此時間的連接會被關閉
+        self.health_check_idle = float(os.getenv("DB_POOL_HEALTH_CHECK_IDLE_SECONDS", "30"))
+
+        self.pool = None
+        self._errors = ()  # 表示連接失效的例外類型（載入 asyncpg 後設定）
+        self._last_used: Dict[int, float] = {}  # 伺服器程序ID -> 最後歸還時間
+        self._backend_pids = set()  # 連接池中各連接的伺服器程序ID
+        self._stats = {
+            "acquired": 0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0
+        }
+
+    @property
+    def available(self) -> bool:
+        """連接池是否已建立"""
+        return self.pool is not None
+
+    async def start(self) -> None:
+        """建立連接池（未設定 DATABASE_URL 或連接失敗時記憶只保存在記憶體中）"""
+        if not self.db_url:
+            print("未設定 DATABASE_URL，記憶只保存在記憶體中")
+            return
+        try:
+            import asyncpg
+        except ImportError:
+            print("警告：未安裝 asyncpg 套件 (pip install asyncpg)，記憶只保存在記憶體中")
+            return
+
+        self._errors = (OSError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+        try:
+            self.pool = await asyncpg.create_pool(
+                self.db_url,
+                min_size=self.min_size,
+                max_size=self.max_size,
+                max_inactive_connection_lifetime=self.max_idle,
+                init=self._on_connect,
+                # 用戶端超時略長於伺服器端，讓伺服器先取消語句並回報錯誤
+                command_timeout=self.statement_timeout_ms / 1000 + 1,
+                server_settings={
+                    "statement_timeout": str(self.statement_timeout_ms),
+                    # 每段對話的記憶數量差異很大，通用計劃會按少量資料估算（例如以巢狀迴圈比對整個陣列），
+                    # 每次以實際參數規劃的成本遠低於選錯計劃
+                    "plan_cache_mode": "force_custom_plan"
+                }
+            )
+            print(f"成功建立記憶資料庫連接池（{self.min_size}-{self.max_size} 個連接）")
+        except Exception as e:
+            self.pool = None
+            print(f"建立記憶資料庫連接池時出錯: {str(e)}")
+
+    async def _on_connect(self, conn: Any) -> None:
+        """記錄新連接的伺服器程序ID，連接關閉時移除"""
+        pid = conn.get_server_pid()
+        self._backend_pids.add(pid)
+        conn.add_termination_listener(lambda _: self._backend_pids.discard(pid))
+
+    def owns_backend(self, pid: int) -> bool:
+        """伺服器程序ID是否屬於本程序的連接池（用於忽略自己發出的通知）"""
+        return pid in self._backend_pids
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Any]:
+        """
+        從連接池取出一個連接，離開時歸還
+
+        返回:
+            async with 取得的值為 asyncpg 連接
+
+        連接池未建立時拋出 RuntimeError。
+        """
+        if self.pool is None:
+            raise RuntimeError("記憶資料庫連接池未建立")
+        conn = await self._checkout()
+        try:
+            yield conn
+        finally:
+            self._last_used[conn.get_server_pid()] = time.monotonic()
+            await self.pool.release(conn)
+
+    async def _checkout(self) -> Any:
+        """取出連接；閒置過久的連接先檢查，失效時關閉並改取另一個"""
+        start = time.perf_counter()
+        conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        pid = conn.get_server_pid()
+        last_used = self._last_used.get(pid)
+        if last_used is not None and time.monotonic() - last_used > self.health_check_idle:
+            self._stats["health_checks"] += 1
+            try:
+                await conn.execute("SELECT 1")
+            except self._errors as e:
+                print(f"記憶資料庫連接已失效，重新連接: {str(e)}")
+                self._stats["health_check_failures"] += 1
+                self._last_used.pop(pid, None)
+                # 終止後歸還，連接池會在下次取出時建立新的連接
+                conn.terminate()
+                await self.pool.release(conn)
+                conn = await self.pool.acquire(timeout=self.acquire_timeout)
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        self._stats["acquired"] += 1
+        self._stats["total_wait_ms"] += wait_ms
+        self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+        # 已關閉的連接留下的記錄不會再被使用，數量超出連接池大小時整批清除
+        if len(self._last_used) > self.max_size * 4:
+            self._last_used.clear()
+        return conn
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        獲取連接池統計
+
+        返回:
+            包含連接數、取用次數、等待時間和健康檢查次數的字典
+        """
+        acquired = self._stats["acquired"]
+        stats = {
+            "available": self.available,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "statement_timeout_ms": self.statement_timeout_ms,
+            **self._stats,
+            "total_wait_ms": round(self._stats["total_wait_ms"], 2),
+            "avg_wait_ms": round(self._stats["total_wait_ms"] / acquired, 2) if acquired else 0.0,
+            "max_wait_ms": round(self._stats["max_wait_ms"], 2)
+        }
+        if self.pool is not None:
+            stats["size"] = self.pool.get_size()
+            stats["idle"] = self.pool.get_idle_size()
+        return stats
+
+    async def close(self) -> None:
+        """關閉連接池（等待借出的連接歸還）"""
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+            print("已關閉記憶資料庫連接池")
+
+# 創建單例實例
+db_pool = DatabasePool()
@@ -1,17 +1,51 @@
-import re
+import os
 import json
-import requests
-from typing import Dict, Any, List
+import time
+import asyncio
+import hashlib
+from typing import Dict, Any, List, AsyncIterator, Optional, Tuple
 from model_interface import ModelHandler
+from http_client import iter_sse_data
+from response_formatter import format_reply, parse_structured_reply, StreamingReplyFormatter
+from affinity_evaluator import build_inline_affinity_instruction
+from prompt_cache import character_version
+
+# 強調格式重要性的結尾提示
+FINAL_CHECK_PROMPT = "\n\n最終檢查：確保你的回覆包含：\n1. 至少一段用 *()* 包圍的旁白描述\n2. 符合角色特性的對話內容\n3. 旁白和對話間有換行\n4. 生動且不重複的表達方式"
 
 class GeminiHandler(ModelHandler):
     """Gemini模型處理器"""
     
-    def __init__(self):
-        self.api_url = "https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:generateContent"
+    provider = "gemini"
+    
+    def __init__(self, model: str = None, max_concurrency: int = None, input_token_budget: int = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("GEMINI_MAX_CONCURRENCY", "0"))
+        super().__init__(model or "gemini-1.5-flash", max_concurrency, input_token_budget)
+        self.api_base = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+        self.api_url = f"{self.api_base}/v1/models/{self.model}:generateContent"
+        self.stream_api_url = f"{self.api_base}/v1/models/{self.model}:streamGenerateContent"
+        
+        # 緩存內容（cachedContents）只在 v1beta 提供，使用時改用 v1beta 的生成端點
+        self.cache_api_url = f"{self.api_base}/v1beta/cachedContents"
+        self.cached_api_url = f"{self.api_base}/v1beta/models/{self.model}:generateContent"
+        self.cached_stream_api_url = f"{self.api_base}/v1beta/models/{self.model}:streamGenerateContent"
+        
+        # 滾動摘要等後台工作使用的低成本模型
+        self.summary_model = os.getenv("GEMINI_SUMMARY_MODEL", "gemini-1.5-flash-8b")
+        
+        # 角色設定部分達到最低 token 數時，為它建立緩存內容
+        self.context_cache_enabled = os.getenv("GEMINI_CONTEXT_CACHE", "true").lower() == "true"
+        self.context_cache_min_tokens = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "32768"))
+        self.context_cache_ttl = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+        
+        # 緩存內容屬於建立它的 API 密鑰所在的專案，因此以密鑰摘要區分
+        self._context_caches = {}  # (密鑰摘要, 角色ID, 角色版本) -> (緩存名稱或 None, 過期時間)
+        self._context_cache_locks = {}  # 同上鍵 -> asyncio.Lock，避免同時重複建立
     
     async def generate_response(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
-                              character: Dict[str, Any], user_id: str = None, character_id: str = None) -> Dict[str, Any]:
+                              character: Dict[str, Any], user_id: str = None, character_id: str = None, 
+                              current_affinity: Optional[int] = None) -> Dict[str, Any]:
         """
         使用Gemini API生成回應
         """
@@ -19,58 +53,36 @@ class GeminiHandler(ModelHandler):
             # 獲取記憶文本（如果有）
             memory_text = ""
             if user_id and character_id:
-                memory_text = await self._get_memory_text(user_id, character_id)
+                memory_text = await self._get_memory_text(user_id, character_id, user_message, chat_history)
                 print(f"已獲取記憶文本，長度: {len(memory_text)}")
             
             # 創建提示詞
-            prompt = self.create_prompt(character, chat_history, user_message, memory_text)
+            summary_text = self._get_summary_text(user_id, character_id)
+            static_prompt, dynamic_prompt = self._prompt_parts(character, chat_history, user_message, 
+                                                               memory_text, summary_text, user_id, character_id)
+            
+            # 內嵌好感度模式：以 responseSchema 要求同時輸出回覆和好感度變化
+            structured = current_affinity is not None
+            if structured:
+                dynamic_prompt += build_inline_affinity_instruction(character, current_affinity, "json")
+            prompt = f"{static_prompt}\n\n{dynamic_prompt}"
             print(f"已創建提示詞，長度: {len(prompt)}")
             
+            # 角色設定部分夠長時使用緩存內容，請求中只送出之後的部分
+            cached_content = await self._get_context_cache(api_key, character, static_prompt)
+            
             # 構建請求數據
-            payload = {
-                "contents": [
-                    {
-                        "parts": [
-                            {
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 0.85,
-                    "topP": 0.92,
-                    "topK": 40,
-                    "maxOutputTokens": 1024,
-                },
-                "safetySettings": [
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    }
-                ]
-            }
+            payload = self._build_payload(dynamic_prompt if cached_content else prompt, 
+                                          structured=structured, cached_content=cached_content)
             
             headers = {"Content-Type": "application/json"}
             
-            print(f"準備發送請求到 Gemini API，使用模型: gemini-1.5-flash")
+            print(f"準備發送請求到 Gemini API，使用模型: {self.model}")
             
             try:
                 # 發送請求到Gemini API
-                api_url = f"{self.api_url}?key={api_key}"
-                response = requests.post(api_url, headers=headers, json=payload)
+                api_url = f"{self.cached_api_url if cached_content else self.api_url}?key={api_key}"
+                response = await self._post(api_url, headers, payload)
                 
                 if response.status_code != 200:
                     error_details = response.text
@@ -96,7 +108,7 @@ class GeminiHandler(ModelHandler):
                             
                             # 重新發送請求
                             print("使用更寬鬆的設置重新發送請求")
-                            response = requests.post(api_url, headers=headers, json=payload)
+                            response = await self._post(api_url, headers, payload)
                             
                             if response.status_code == 200:
                                 print("使用更寬鬆的安全設置成功獲取回應")
@@ -126,6 +138,9 @@ class GeminiHandler(ModelHandler):
                 # 解析回應
                 result = response.json()
                 
+                # 以實際輸入 token 數校正估算器，並記錄緩存的命中情況
+                self._record_gemini_usage(prompt, result.get("usageMetadata") or {})
+                
                 if "candidates" not in result or len(result["candidates"]) == 0:
                     print("Gemini API 返回的回應中沒有 candidates")
                     return {
@@ -146,13 +161,20 @@ class GeminiHandler(ModelHandler):
                 
                 print(f"成功獲取 Gemini API 回應，回覆長度: {len(ai_reply)}")
                 
+                affinity_change = None
+                if structured:
+                    ai_reply, affinity_change = parse_structured_reply(ai_reply)
+                
                 # 處理回應
                 ai_reply = self.post_process_response(ai_reply, character)
                 
-                return {
+                reply_result = {
                     "success": True,
                     "reply": ai_reply
                 }
+                if structured:
+                    reply_result["affinity_change"] = affinity_change
+                return reply_result
                 
             except Exception as e:
                 print(f"呼叫 Gemini API 時發生錯誤: {str(e)}")
@@ -175,15 +197,257 @@ class GeminiHandler(ModelHandler):
                 "details": str(outer_e)
             }
     
-    def create_prompt(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                     user_message: str, memory_text: str = "") -> str:
+    async def complete(self, api_key: str, prompt: str, model: Optional[str] = None, 
+                       max_output_tokens: int = 512) -> Dict[str, Any]:
         """
-        創建Gemini的提示詞
+        以單一提示詞向Gemini請求純文本回覆
+        """
+        api_url = f"{self.api_base}/v1/models/{model or self.model}:generateContent?key={api_key}"
+        payload = {
+            "contents": [{"parts": [{"text": prompt}]}],
+            "generationConfig": {
+                "temperature": 0.3,
+                "maxOutputTokens": max_output_tokens
+            }
+        }
+        try:
+            response = await self._post(api_url, {"Content-Type": "application/json"}, payload)
+            if response.status_code != 200:
+                return {
+                    "success": False,
+                    "error": "Gemini API 請求失敗",
+                    "status_code": response.status_code,
+                    "details": response.text
+                }
+            result = response.json()
+            parts = result["candidates"][0]["content"]["parts"]
+            return {"success": True, "text": "".join(part.get("text", "") for part in parts)}
+        except Exception as e:
+            return {
+                "success": False,
+                "error": "呼叫 Gemini API 時發生錯誤",
+                "details": str(e)
+            }
+    
+    async def _get_context_cache(self, api_key: str, character: Dict[str, Any], static_prompt: str) -> Optional[str]:
+        """
+        獲取（必要時建立）角色設定部分的緩存內容
+        
+        參數:
+            api_key: API密鑰
+            character: 角色設定
+            static_prompt: 角色設定部分的提示詞
+            
+        返回:
+            緩存內容名稱（cachedContents/...）；未啟用、內容太短或建立失敗時為 None
+        """
+        if not self.context_cache_enabled:
+            return None
+        if self.token_estimator.estimate(static_prompt) < self.context_cache_min_tokens:
+            return None
+        
+        key_digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        cache_key = (key_digest, character.get("id") or character.get("name"), character_version(character))
+        
+        entry = self._context_caches.get(cache_key)
+        # 保留一分鐘的餘量，避免請求途中緩存過期
+        if entry and entry[1] > time.time() + 60:
+            return entry[0]
+        
+        lock = self._context_cache_locks.setdefault(cache_key, asyncio.Lock())
+        async with lock:
+            entry = self._context_caches.get(cache_key)
+            if entry and entry[1] > time.time() + 60:
+                return entry[0]
+            
+            name = await self._create_context_cache(api_key, static_prompt)
+            # 建立失敗時在較短時間內不再重試
+            ttl = self.context_cache_ttl if name else min(300, self.context_cache_ttl)
+            self._context_caches[cache_key] = (name, time.time() + ttl)
+            self._prune_context_caches()
+            return name
+    
+    async def _create_context_cache(self, api_key: str, static_prompt: str) -> Optional[str]:
+        """呼叫 cachedContents API 建立緩存內容，返回緩存名稱"""
+        payload = {
+            "model": f"models/{self.model}",
+            "systemInstruction": {"parts": [{"text": static_prompt}]},
+            "ttl": f"{self.context_cache_ttl}s"
+        }
+        try:
+            response = await self._post(f"{self.cache_api_url}?key={api_key}",
+                                        {"Content-Type": "application/json"}, payload)
+            if response.status_code != 200:
+                print(f"建立 Gemini 緩存內容失敗，狀態碼: {response.status_code}, 詳情: {response.text[:200]}")
+                return None
+            name = response.json().get("name")
+            print(f"已建立 Gemini 緩存內容: {name}")
+            return name
+        except Exception as e:
+            print(f"建立 Gemini 緩存內容時發生錯誤: {str(e)}")
+            return None
+    
+    def _prune_context_caches(self) -> None:
+        """移除已過期的緩存內容記錄"""
+        now = time.time()
+        expired = [key for key, (_, expires_at) in self._context_caches.items() if expires_at <= now]
+        for key in expired:
+            del self._context_caches[key]
+            self._context_cache_locks.pop(key, None)
+    
+    def _record_gemini_usage(self, prompt: str, usage: Dict[str, Any]) -> None:
+        """從 usageMetadata 記錄緩存用量並校正 token 估算（promptTokenCount 包含緩存的部分）"""
+        prompt_tokens = usage.get("promptTokenCount")
+        self._record_usage(self.token_estimator.estimate(prompt), prompt_tokens)
+        self._record_cache_usage(prompt_tokens, usage.get("cachedContentTokenCount"))
+    
+    def _build_payload(self, prompt: str, structured: bool = False, 
+                       cached_content: Optional[str] = None) -> Dict[str, Any]:
         """
-        # 只使用最近的N條消息，避免提示詞過長
-        recent_history = chat_history[-15:]
+        構建Gemini請求數據
+        
+        參數:
+            prompt: 提示詞（使用緩存內容時只包含緩存之後的部分）
+            structured: 是否要求 JSON 結構化輸出
+            cached_content: 緩存內容名稱（可選）
+        """
+        payload = {
+            "contents": [
+                {
+                    "parts": [
+                        {
+                            "text": prompt
+                        }
+                    ]
+                }
+            ],
+            "generationConfig": {
+                "temperature": 0.85,
+                "topP": 0.92,
+                "topK": 40,
+                "maxOutputTokens": 1024,
+            },
+            "safetySettings": [
+                {
+                    "category": "HARM_CATEGORY_HARASSMENT",
+                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                },
+                {
+                    "category": "HARM_CATEGORY_HATE_SPEECH",
+                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                },
+                {
+                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                },
+                {
+                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                }
+            ]
+        }
+        
+        if cached_content:
+            payload["cachedContent"] = cached_content
         
-        # 設定角色提示詞
+        if structured:
+            # 以 JSON 結構化輸出回覆和好感度變化
+            payload["generationConfig"]["responseMimeType"] = "application/json"
+            payload["generationConfig"]["responseSchema"] = {
+                "type": "OBJECT",
+                "properties": {
+                    "reply": {"type": "STRING"},
+                    "affinity_change": {"type": "INTEGER"}
+                },
+                "required": ["reply", "affinity_change"]
+            }
+        
+        return payload
+    
+    async def generate_response_stream(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
+                                       character: Dict[str, Any], user_id: str = None, 
+                                       character_id: str = None, 
+                                       current_affinity: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        使用Gemini streamGenerateContent API以串流方式生成回應
+        """
+        try:
+            # 獲取記憶文本（如果有）
+            memory_text = ""
+            if user_id and character_id:
+                memory_text = await self._get_memory_text(user_id, character_id, user_message, chat_history)
+            
+            summary_text = self._get_summary_text(user_id, character_id)
+            static_prompt, dynamic_prompt = self._prompt_parts(character, chat_history, user_message, 
+                                                               memory_text, summary_text, user_id, character_id)
+            
+            # 串流時無法使用 JSON 模式，改為要求在結尾附加好感度標記
+            inline_affinity = current_affinity is not None
+            if inline_affinity:
+                dynamic_prompt += build_inline_affinity_instruction(character, current_affinity, "trailer")
+            prompt = f"{static_prompt}\n\n{dynamic_prompt}"
+            
+            cached_content = await self._get_context_cache(api_key, character, static_prompt)
+            payload = self._build_payload(dynamic_prompt if cached_content else prompt, cached_content=cached_content)
+            headers = {"Content-Type": "application/json"}
+            stream_api_url = self.cached_stream_api_url if cached_content else self.stream_api_url
+            api_url = f"{stream_api_url}?alt=sse&key={api_key}"
+            
+            formatter = StreamingReplyFormatter(character, report_affinity_change=inline_affinity)
+            usage = {}
+            
+            async with self._stream(api_url, headers, payload) as response:
+                if response.status_code != 200:
+                    error_details = (await response.aread()).decode("utf-8", errors="replace")
+                    print(f"Gemini 串流請求失敗，狀態碼: {response.status_code}")
+                    error_message = None
+                    try:
+                        error_json = json.loads(error_details)
+                        if "error" in error_json:
+                            error_message = error_json["error"].get("message")
+                    except Exception:
+                        pass
+                    
+                    yield {
+                        "type": "error",
+                        "error": "Gemini API 請求失敗",
+                        "status_code": response.status_code,
+                        "details": error_message or error_details
+                    }
+                    return
+                
+                async for event in iter_sse_data(response):
+                    if "usageMetadata" in event:
+                        usage = event["usageMetadata"]
+                    for candidate in event.get("candidates", [])[:1]:
+                        for part in candidate.get("content", {}).get("parts", []):
+                            text = formatter.feed(part.get("text", ""))
+                            if text:
+                                yield {"type": "delta", "text": text}
+            
+            text = formatter.finish()
+            if text:
+                yield {"type": "delta", "text": text}
+            
+            self._record_gemini_usage(prompt, usage)
+            print(f"Gemini 串流回應完成，回覆長度: {len(formatter.text)}")
+            yield {"type": "done", "reply": formatter.text, "affinity_change": formatter.affinity_change}
+            
+        except Exception as e:
+            print(f"Gemini 串流請求時發生錯誤: {str(e)}")
+            import traceback
+            print(f"錯誤詳情:\n{traceback.format_exc()}")
+            
+            yield {
+                "type": "error",
+                "error": "呼叫 Gemini API 時發生錯誤",
+                "details": str(e)
+            }
+    
+    def _build_character_prompt(self, character: Dict[str, Any]) -> str:
+        """
+        編譯角色提示詞中只由角色設定決定的部分（結果由 prompt_cache 緩存）
+        """
         character_prompt = f"""角色扮演指南：
 你是 {character['name']}，以下是你的基本設定：
 
@@ -244,38 +508,61 @@ class GeminiHandler(ModelHandler):
    很高興認識你。今天過得如何？
    *(眼神友善)*
 """
+        return character_prompt
+    
+    def create_prompt(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
+                     user_message: str, memory_text: str = "", summary_text: str = "") -> str:
+        """
+        創建Gemini的提示詞
+        """
+        static_prompt, dynamic_prompt = self._prompt_parts(character, chat_history, user_message, 
+                                                           memory_text, summary_text)
+        return f"{static_prompt}\n\n{dynamic_prompt}"
+    
+    def _prompt_parts(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
+                      user_message: str, memory_text: str = "", summary_text: str = "",
+                      user_id: str = None, character_id: str = None) -> Tuple[str, str]:
+        """
+        分別構建提示詞的固定前綴和每回合變動的部分（提供用戶和角色ID時記錄摘要節省的 token）
+        
+        返回:
+            (角色設定部分, 記憶 + 對話歷史 + 當前問題)；前者在同一角色的所有請求間相同，
+            可以放入 Gemini 的緩存內容（cachedContents）
+        """
+        # 角色設定部分按角色版本緩存，只有記憶和對話歷史需要每次組裝
+        static_prompt = self.prompt_cache.get_or_build(character, self._build_character_prompt)
+        
+        # 當前問題
+        question = f"\n用戶剛剛說: {user_message}\n\n請以 {character['name']} 的身份回應，遵循上述格式要求，確保回覆包含自然的對話和生動的旁白描述。"
         
-        # 如果有記憶文本，添加到提示詞中
-        if memory_text:
-            character_prompt = character_prompt.replace("角色扮演指南：", f"角色扮演指南：\n\n{memory_text}\n")
+        # 在輸入 token 預算內，從最新到最舊挑選對話歷史
+        budget = self._history_budget(static_prompt, memory_text, summary_text, question, FINAL_CHECK_PROMPT)
+        recent_history = self._select_history(chat_history, budget, user_message, summary_text, user_id, character_id)
         
-        # 構建對話歷史
-        user_messages = []
-        for msg in recent_history:
-            if msg["role"] == "user":
-                user_messages.append(f"用戶: {msg['content']}")
-            elif msg["role"] == "assistant" and len(user_messages) > 0:
-                user_messages.append(f"{character['name']}: {msg['content']}")
+        # 如果有記憶文本，放在角色設定之後，讓角色設定保持為固定前綴
+        dynamic_prompt = f"{memory_text}\n" if memory_text else ""
         
-        # 構建最終提示詞
-        final_prompt = f"{character_prompt}\n\n"
+        # 較早的對話已摺疊成摘要，放在保留的對話記錄之前
+        if summary_text:
+            dynamic_prompt += f"之前對話的摘要（更早的對話記錄已省略）:\n{summary_text}\n\n"
         
         # 加入部分對話歷史（如果有）
-        if len(user_messages) > 1:
-            final_prompt += "以下是之前的對話記錄（請參考以保持一致性）:\n"
-            for i, msg in enumerate(user_messages[:-1]):
-                final_prompt += f"{msg}\n"
+        if recent_history:
+            dynamic_prompt += "以下是之前的對話記錄（請參考以保持一致性）:\n"
+            for msg in recent_history:
+                speaker = "用戶" if msg["role"] == "user" else character['name']
+                dynamic_prompt += f"{speaker}: {msg['content']}\n"
         
         # 加入當前問題
-        final_prompt += f"\n用戶剛剛說: {user_message}\n\n請以 {character['name']} 的身份回應，遵循上述格式要求，確保回覆包含自然的對話和生動的旁白描述。"
+        dynamic_prompt += question
         
         # 強調格式重要性
-        final_prompt += "\n\n最終檢查：確保你的回覆包含：\n1. 至少一段用 *()* 包圍的旁白描述\n2. 符合角色特性的對話內容\n3. 旁白和對話間有換行\n4. 生動且不重複的表達方式"
+        dynamic_prompt += FINAL_CHECK_PROMPT
         
-        return final_prompt
+        return static_prompt, dynamic_prompt
     
     def format_messages(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                       user_message: str, memory_text: str = "") -> List[Dict[str, str]]:
+                       user_message: str, memory_text: str = "", summary_text: str = "") -> List[Dict[str, str]]:
         """
         格式化消息（對Gemini不適用，但需要實現接口）
         """
@@ -286,47 +573,18 @@ class GeminiHandler(ModelHandler):
         """
         處理Gemini的回應
         """
-        # 清理回覆
-        ai_reply = response.strip()
-        
-        # 確保回覆中有旁白描述
-        if "*(" not in ai_reply and ")*" not in ai_reply and "**" not in ai_reply:
-            # 生成更自然的旁白
-            character_name = character['name']
-            personality = character.get('personality', '').lower()
-            
-            # 根據角色性格生成合適的旁白
-            if '害羞' in personality or '內向' in personality:
-                narration = f"*({character_name}輕聲說道，眼神略顯羞澀)*"
-            elif '活潑' in personality or '開朗' in personality or '熱情' in personality:
-                narration = f"*({character_name}精神抖擻地說，臉上掛著明朗的笑容)*"
-            elif '冷靜' in personality or '沉穩' in personality:
-                narration = f"*({character_name}沉穩地回應，表情平靜而專注)*"
-            elif '傲嬌' in personality or '高傲' in personality:
-                narration = f"*({character_name}微微揚起下巴，假裝不太在意地說)*"
-            elif '溫柔' in personality or '體貼' in personality:
-                narration = f"*({character_name}溫柔地微笑著，眼中流露出關切之情)*"
-            else:
-                narration = f"*({character_name}看著你，眼神中帶著一絲好奇)*"
-            
-            ai_reply = f"{narration}\n{ai_reply}"
-        
-        # 確保旁白和對話之間有換行
-        ai_reply = re.sub(r'\)\*([^\n])', r')*\n\1', ai_reply)
-        
-        # 確保對話和旁白之間有換行
-        ai_reply = re.sub(r'([^\n])\*\(', r'\1\n*(', ai_reply)
-        
-        return ai_reply
+        return format_reply(response, character)
     
-    async def _get_memory_text(self, user_id: str, character_id: str) -> str:
+    async def _get_memory_text(self, user_id: str, character_id: str, user_message: str = "",
+                               chat_history: List[Dict[str, str]] = None) -> str:
         """
-        獲取角色記憶文本
+        獲取角色記憶文本（記憶很多時按與當前消息的相關度挑選）
         """
         try:
             # 從記憶管理器獲取格式化的記憶文本
             from memory_manager import memory_manager
-            return await memory_manager.get_formatted_memory(user_id, character_id)
+            return await memory_manager.get_formatted_memory(user_id, character_id, user_message, chat_history,
+                                                             self.token_estimator)
         except Exception as e:
             print(f"獲取記憶時出錯: {str(e)}")
             return "" 
\ No newline at end of file
@@ -0,0 +1,177 @@
+import os
+import json
+from typing import Dict, Any, Optional, AsyncIterator
+from urllib.parse import urlsplit
+import httpx
+
+# 各模型供應商的主機，啟動時預先建立連接池（可用 *_API_BASE 指向代理或本地模擬服務）
+PROVIDER_HOSTS = [
+    os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com"),
+    os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1"),
+    os.getenv("CLAUDE_API_BASE", "https://api.anthropic.com"),
+]
+
+class HttpClientPool:
+    """
+    進程級共用的非同步 HTTP 客戶端池
+
+    每個供應商主機維護一個獨立的 httpx.AsyncClient（keep-alive 連接池），
+    讓不同對話的 API 請求可以在同一個事件循環中真正並行。
+    """
+
+    def __init__(self):
+        """初始化客戶端池（從環境變數讀取連接限制和超時設定）"""
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+        # 連接池限制
+        self.max_connections = int(os.getenv("HTTP_MAX_CONNECTIONS", "200"))
+        self.max_keepalive_connections = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "50"))
+        self.keepalive_expiry = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+        # 超時設定（秒）
+        self.connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+        self.read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+        self.write_timeout = float(os.getenv("HTTP_WRITE_TIMEOUT", "30"))
+        self.pool_timeout = float(os.getenv("HTTP_POOL_TIMEOUT", "30"))
+
+        # 是否啟用 HTTP/2（需要安裝 h2 套件）
+        self.http2 = os.getenv("HTTP_ENABLE_HTTP2", "false").lower() == "true"
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                print("警告：未安裝 h2 套件，HTTP/2 已停用")
+                self.http2 = False
+
+    def _host_key(self, url: str) -> str:
+        """取得URL對應的主機鍵（scheme://netloc）"""
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _create_client(self, base_url: str) -> httpx.AsyncClient:
+        """為指定主機建立新的客戶端"""
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+        timeout = httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.write_timeout,
+            pool=self.pool_timeout
+        )
+        return httpx.AsyncClient(
+            base_url=base_url,
+            limits=limits,
+            timeout=timeout,
+            http2=self.http2
+        )
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        """
+        獲取URL所屬主機的客戶端，不存在時延遲建立
+
+        參數:
+            url: 請求的完整URL
+
+        返回:
+            該主機共用的 httpx.AsyncClient
+        """
+        key = self._host_key(url)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = self._create_client(key)
+            self._clients[key] = client
+        return client
+
+    async def start(self) -> None:
+        """在應用啟動時預先建立各供應商主機的客戶端"""
+        for host in PROVIDER_HOSTS:
+            self.get_client(host)
+        print(f"HTTP 客戶端池已啟動: {len(self._clients)} 個主機, "
+              f"最大連接數 {self.max_connections}, HTTP/2 {'啟用' if self.http2 else '停用'}")
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None,
+                   json: Any = None, **kwargs) -> httpx.Response:
+        """
+        發送 POST 請求
+
+        參數:
+            url: 請求URL
+            headers: 請求標頭
+            json: JSON 請求主體
+
+        返回:
+            httpx.Response
+        """
+        client = self.get_client(url)
+        return await client.post(url, headers=headers, json=json, **kwargs)
+
+    def stream(self, url: str, headers: Optional[Dict[str, str]] = None,
+               json: Any = None, **kwargs):
+        """
+        發送串流 POST 請求
+
+        參數:
+            url: 請求URL
+            headers: 請求標頭
+            json: JSON 請求主體
+
+        返回:
+            async context manager，進入後得到尚未讀取主體的 httpx.Response
+        """
+        client = self.get_client(url)
+        return client.stream("POST", url, headers=headers, json=json, **kwargs)
+
+    async def close(self) -> None:
+        """關閉所有客戶端及其連接"""
+        clients = list(self._clients.values())
+        self._clients = {}
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                print(f"關閉 HTTP 客戶端時出錯: {str(e)}")
+        print("HTTP 客戶端池已關閉")
+
+async def iter_sse_data(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+    """
+    逐一解析 Server-Sent Events 回應中的 data 欄位
+
+    參數:
+        response: 串流中的 httpx.Response
+
+    返回:
+        每個事件 data 解析後的 JSON 物件（忽略 [DONE] 和無法解析的行）
+    """
+    data_lines = []
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data_lines.append(line[5:].strip())
+            continue
+        if line.strip() or not data_lines:
+            # event:/id: 等其他欄位不需要處理
+            continue
+
+        # 空行表示一個事件結束
+        data = "\n".join(data_lines)
+        data_lines = []
+        if data == "[DONE]":
+            continue
+        try:
+            yield json.loads(data)
+        except ValueError:
+            print(f"無法解析串流事件: {data[:100]}")
+
+    # 處理沒有以空行結尾的最後一個事件
+    if data_lines:
+        data = "\n".join(data_lines)
+        if data != "[DONE]":
+            try:
+                yield json.loads(data)
+            except ValueError:
+                print(f"無法解析串流事件: {data[:100]}")
+
+# 進程級單例，所有模型處理器和好感度評估器共用
+http_client_pool = HttpClientPool()
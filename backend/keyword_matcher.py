@@ -0,0 +1,160 @@
+import os
+import re
+import json
+from typing import Dict, Any, List, Tuple
+
+# 默認詞庫（與本檔案放在同一目錄）
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_lexicon.json")
+
+# 擷取片段的結束位置：遇到句子或子句的分隔符號即停止
+SPAN_DELIMITERS = re.compile(r"[。！？!?；;，,\n]|\.(?:\s|$)")
+
+def load_lexicon(path: str = None) -> Dict[str, Any]:
+    """
+    讀取詞庫檔案
+
+    格式為 {類別: {"template": "…{span}…", "patterns": {語言: [關鍵詞, ...]}}}，
+    template 決定寫入記憶的文字，{span} 會替換為從關鍵詞開始到子句結尾的片段。
+
+    參數:
+        path: 詞庫檔案路徑（可選，默認使用 MEMORY_LEXICON_PATH 或內建的 memory_lexicon.json）
+
+    返回:
+        詞庫字典
+    """
+    path = path or os.getenv("MEMORY_LEXICON_PATH") or DEFAULT_LEXICON_PATH
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+class KeywordMatcher:
+    """
+    多關鍵詞匹配器（Aho-Corasick 自動機）
+
+    將所有類別、所有語言的關鍵詞編譯成一個自動機，每條消息只需掃描一遍，
+    耗時與消息長度和匹配數成正比，與關鍵詞數量無關。匹配不區分大小寫；
+    以英文字母或數字開頭結尾的關鍵詞需要完整的單詞邊界（避免 "i am" 匹配到 "hi am"）。
+    """
+
+    def __init__(self, lexicon: Dict[str, Any], max_span: int = 60):
+        """
+        編譯詞庫
+
+        參數:
+            lexicon: load_lexicon 返回的詞庫
+            max_span: 擷取片段的最大字元數
+        """
+        self.max_span = max_span
+        self.templates: Dict[str, str] = {}
+        # 狀態以列表的下標表示：goto[狀態][字元] -> 下一個狀態
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._outputs: List[List[Tuple[int, str, bool]]] = [[]]  # 在此狀態結束的 (長度, 類別, 是否檢查單詞邊界)
+        self.pattern_count = 0
+
+        for category, config in lexicon.items():
+            self.templates[category] = config.get("template", "{span}")
+            for patterns in config.get("patterns", {}).values():
+                for pattern in patterns:
+                    self._add(pattern.lower(), category)
+        self._build()
+
+    def _add(self, pattern: str, category: str) -> None:
+        """加入一個關鍵詞到字典樹"""
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+            state = next_state
+        word = pattern[0].isascii() and pattern[0].isalnum() and pattern[-1].isascii() and pattern[-1].isalnum()
+        self._outputs[state].append((len(pattern), category, word))
+        self.pattern_count += 1
+
+    def _build(self) -> None:
+        """以廣度優先建立失敗連結，並把後綴狀態的輸出合併進來"""
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+                queue.append(next_state)
+
+    def find(self, text: str) -> List[Tuple[int, int, str]]:
+        """
+        找出文本中所有關鍵詞的位置
+
+        參數:
+            text: 文本
+
+        返回:
+            (開始位置, 結束位置, 類別) 列表，按結束位置排序
+        """
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # 少數字元轉小寫後長度改變，改為逐字轉換以保持位置對應
+            lowered = "".join(char.lower()[0] for char in text)
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        matches = []
+        state = 0
+        for index, char in enumerate(lowered):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                end = index + 1
+                for length, category, word in outputs[state]:
+                    start = end - length
+                    if word and not self._is_word_boundary(lowered, start, end):
+                        continue
+                    matches.append((start, end, category))
+        return matches
+
+    @staticmethod
+    def _is_word_boundary(text: str, start: int, end: int) -> bool:
+        """檢查匹配的前後是否不是英文字母或數字"""
+        before = text[start - 1] if start > 0 else " "
+        after = text[end] if end < len(text) else " "
+        return not (before.isascii() and before.isalnum()) and not (after.isascii() and after.isalnum())
+
+    def extract(self, text: str) -> List[Tuple[str, str]]:
+        """
+        擷取文本中符合關鍵詞的片段
+
+        每個匹配從關鍵詞開始，到子句結尾或 max_span 個字元為止；
+        同一類別中落在已擷取片段內的匹配會被略過。
+
+        參數:
+            text: 文本
+
+        返回:
+            (類別, 片段) 列表，按出現順序排列
+        """
+        results = []
+        covered: Dict[str, int] = {}  # 類別 -> 已擷取片段的結束位置
+        for start, end, category in sorted(self.find(text), key=lambda match: (match[0], -match[1])):
+            if start < covered.get(category, -1):
+                continue
+            limit = min(len(text), start + self.max_span)
+            delimiter = SPAN_DELIMITERS.search(text, end, limit)
+            span_end = delimiter.start() if delimiter else limit
+            span = text[start:span_end].strip()
+            if span:
+                covered[category] = span_end
+                results.append((category, span))
+        return results
+
+    def format(self, category: str, span: str) -> str:
+        """以類別的模板把片段轉換成記憶文字"""
+        return self.templates.get(category, "{span}").format(span=span)
+
+# 創建單例實例
+keyword_matcher = KeywordMatcher(load_lexicon())
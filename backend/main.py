@@ -6,20 +6,73 @@ from typing import Optional, List, Dict, Any
 import os
 from dotenv import load_dotenv
 import uuid
-from fastapi.responses import JSONResponse
-import atexit
+from fastapi.responses import JSONResponse, StreamingResponse
+import json
+from contextlib import asynccontextmanager
 
 # 導入新的模組
 from db import get_all_characters, get_character_by_id
 from chat_manager import chat_manager
 from model_factory import ModelFactory
 from memory_manager import memory_manager
+from affinity_evaluator import affinity_evaluator
+from conversation_summarizer import conversation_summarizer
+from conversation_store import conversation_store
+from conversation_persistence import conversation_persistence
+from state_backend import state_backend
+from conversation_locks import conversation_locks
+from db_pool import db_pool
+from migrate import run_migrations
+from memory_cache import memory_cache
+from memory_compaction import memory_compactor
+from http_client import http_client_pool
 
 # 載入環境變數
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """應用生命週期：啟動時建立共用資源，關閉時釋放"""
+    await http_client_pool.start()
+    # 建立記憶資料庫連接池並套用尚未套用的資料庫遷移
+    await db_pool.start()
+    await run_migrations()
+    # 監聽其他 worker 的記憶變更通知
+    await memory_cache.start()
+    # 定期淘汰超過容量上限或重要性過低的記憶
+    await memory_compactor.start()
+    # 建立所有模型處理器（整個應用共用同一組實例）
+    ModelFactory.startup()
+    # 連接對話資料庫並啟動後台寫入
+    await conversation_persistence.start()
+    # 連接狀態後端（使用 Redis 時多個 worker 共享對話狀態）
+    await state_backend.start()
+    yield
+    # 等待進行中的對話摘要（需要使用模型處理器）
+    await conversation_summarizer.close()
+    # 等待進行中的記憶更新（需要使用模型處理器）
+    await chat_manager.wait_memory_updates()
+    # 關閉模型處理器
+    await ModelFactory.close()
+    # 送出尚未評估的好感度批次
+    await affinity_evaluator.close()
+    # 等待後台好感度評估套用結果
+    await chat_manager.close()
+    await state_backend.close()
+    # 寫入尚未送出的對話歷史和好感度（必須在所有會修改對話的後台任務結束之後）
+    await conversation_persistence.close()
+    # 關閉共用的 HTTP 連接池
+    await http_client_pool.close()
+    # 停止監聽記憶變更通知並關閉記憶資料庫連接池
+    try:
+        await memory_compactor.close()
+        await memory_cache.close()
+        await db_pool.close()
+    except Exception as e:
+        print(f"關閉資料庫連接池時出錯: {str(e)}")
+
 # 初始化 FastAPI 應用程式
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 加入 CORS 中間件，允許前端的跨域請求
 app.add_middleware(
@@ -65,6 +118,44 @@ class ChatRequest(BaseModel):
     preserve_markdown: bool = True  # 是否保留 Markdown 格式
     model_type: str = "gemini"  # 模型類型，可選 "gemini", "openai", "claude"
 
+def resolve_character(character_id: str) -> Dict[str, Any]:
+    """獲取角色設定（緩存 -> API -> 臨時默認角色），並移除角色自帶的系統提示詞"""
+    character = None
+    if character_id in CHARACTER_SETTINGS:
+        character = CHARACTER_SETTINGS[character_id]
+        print(f"使用緩存的角色: {character['name']}")
+    else:
+        # 嘗試從API獲取
+        try:
+            character = get_character_by_id(character_id)
+            if character:
+                CHARACTER_SETTINGS[character_id] = character
+                print(f"從API動態載入角色: {character['name']} (ID: {character_id})")
+        except Exception as e:
+            print(f"從API載入角色時出錯: {str(e)}")
+    
+    # 如果找不到角色設定，創建默認設定
+    if not character:
+        character = {
+            "name": f"Character {character_id}",
+            "gender": "未指定",
+            "job": "虛擬助手",
+            "personality": "友善、樂於幫助",
+            "speakingStyle": "正式但親切"
+        }
+        CHARACTER_SETTINGS[character_id] = character
+        print(f"建立臨時默認角色: {character['name']}")
+    
+    # 確保不使用來自角色數據的系統提示詞
+    if "system" in character:
+        # 移除系統提示詞，防止覆蓋後端的標準提示詞
+        character_copy = character.copy()
+        character_copy.pop("system", None)
+        character = character_copy
+        print(f"已移除角色的自定義系統提示詞")
+    
+    return character
+
 @app.post("/chat")
 async def chat(request: ChatRequest):
     """處理聊天請求"""
@@ -72,39 +163,7 @@ async def chat(request: ChatRequest):
     
     try:
         # 獲取角色設定
-        character = None
-        if request.character_id in CHARACTER_SETTINGS:
-            character = CHARACTER_SETTINGS[request.character_id]
-            print(f"使用緩存的角色: {character['name']}")
-        else:
-            # 嘗試從API獲取
-            try:
-                character = get_character_by_id(request.character_id)
-                if character:
-                    CHARACTER_SETTINGS[request.character_id] = character
-                    print(f"從API動態載入角色: {character['name']} (ID: {request.character_id})")
-            except Exception as e:
-                print(f"從API載入角色時出錯: {str(e)}")
-        
-        # 如果找不到角色設定，創建默認設定
-        if not character:
-            character = {
-                "name": f"Character {request.character_id}",
-                "gender": "未指定",
-                "job": "虛擬助手",
-                "personality": "友善、樂於幫助",
-                "speakingStyle": "正式但親切"
-            }
-            CHARACTER_SETTINGS[request.character_id] = character
-            print(f"建立臨時默認角色: {character['name']}")
-        
-        # 確保不使用來自角色數據的系統提示詞
-        if "system" in character:
-            # 移除系統提示詞，防止覆蓋後端的標準提示詞
-            character_copy = character.copy()
-            character_copy.pop("system", None)
-            character = character_copy
-            print(f"已移除角色的自定義系統提示詞")
+        character = resolve_character(request.character_id)
         
         # 使用聊天管理器處理請求
         result = await chat_manager.process_chat(
@@ -150,6 +209,38 @@ async def chat(request: ChatRequest):
             }
         )
 
+def _sse_event(event: Dict[str, Any]) -> str:
+    """將事件字典編碼為 Server-Sent Events 格式"""
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """以 Server-Sent Events 串流返回聊天回應"""
+    print(f"收到串流聊天請求: character_id={request.character_id}, user_id={request.user_id}, model_type={request.model_type}")
+    
+    character = resolve_character(request.character_id)
+    
+    async def event_stream():
+        async for event in chat_manager.process_chat_stream(
+            api_key=request.api_key,
+            character_id=request.character_id,
+            message=request.message,
+            user_id=request.user_id,
+            reset_context=request.reset_context,
+            model_type=request.model_type,
+            character=character
+        ):
+            yield _sse_event(event)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # 避免反向代理緩衝串流
+        }
+    )
+
 @app.get("/supported_models")
 async def get_supported_models():
     """獲取支持的模型列表"""
@@ -177,16 +268,100 @@ async def get_character_list():
     
     return {"characters": characters_details}
 
+async def refresh_characters(character_id: str = None) -> int:
+    """
+    重新載入角色設定並使已編譯的角色提示詞失效（也在收到其他 worker 的通知時呼叫）
+    
+    返回:
+        失效的提示詞數量
+    """
+    if character_id:
+        CHARACTER_SETTINGS.pop(character_id, None)
+        try:
+            character = await asyncio.to_thread(get_character_by_id, character_id)
+            if character:
+                CHARACTER_SETTINGS[character_id] = character
+        except Exception as e:
+            print(f"從API載入角色時出錯: {str(e)}")
+    else:
+        settings = await asyncio.to_thread(load_character_settings)
+        CHARACTER_SETTINGS.clear()
+        CHARACTER_SETTINGS.update(settings)
+    
+    return ModelFactory.invalidate_character(character_id)
+
+state_backend.subscribe("characters", refresh_characters)
+
+@app.post("/characters/reload")
+async def reload_characters(character_id: str = None):
+    """重新載入角色設定，並使已編譯的角色提示詞失效（通知所有 worker）"""
+    removed = await refresh_characters(character_id)
+    await state_backend.publish("characters", character_id)
+    return {
+        "status": "success",
+        "loaded_characters": len(CHARACTER_SETTINGS),
+        "invalidated_prompts": removed
+    }
+
+@app.get("/models/cache_stats")
+async def get_model_cache_stats():
+    """獲取各模型的提示詞緩存統計（供應商端緩存命中率、已編譯模板、token 估算校正）"""
+    return {"models": ModelFactory.get_cache_stats()}
+
+@app.get("/summary/stats")
+async def get_summary_stats():
+    """獲取滾動摘要統計（摘要次數、摺疊的消息數、每次請求節省的輸入 token 數）"""
+    return conversation_summarizer.get_stats()
+
+@app.get("/summary/{user_id}/{character_id}")
+async def get_conversation_summary(user_id: str, character_id: str):
+    """獲取對話的滾動摘要"""
+    await chat_manager.load_conversation(user_id, character_id)
+    return conversation_summarizer.get_summary_info(user_id, character_id)
+
+@app.get("/conversations/stats")
+async def get_conversation_stats():
+    """獲取對話存儲統計（對話數、消息數、估算的記憶體用量和淘汰次數）"""
+    return {**conversation_store.get_stats(), "state_backend": state_backend.get_stats()}
+
+@app.get("/conversations/queue_stats")
+async def get_conversation_queue_stats():
+    """獲取對話排隊統計（同一對話的回合依序執行時的等待時間）"""
+    return conversation_locks.get_stats()
+
+@app.get("/conversations/{user_id}/{character_id}/queue_stats")
+async def get_single_conversation_queue_stats(user_id: str, character_id: str):
+    """獲取特定對話的排隊統計"""
+    return conversation_locks.get_conversation_stats(user_id, character_id)
+
+@app.get("/conversations/persistence")
+async def get_conversation_persistence_stats():
+    """獲取對話持久化統計（佇列長度、寫入延遲、寫入和失敗次數）"""
+    return conversation_persistence.get_stats()
+
+@app.get("/affinity/stats")
+async def get_affinity_stats():
+    """獲取好感度評估統計（本地評分解決的回合比例）"""
+    return affinity_evaluator.get_stats()
+
 @app.get("/affinity/{user_id}/{character_id}")
-async def get_character_affinity(user_id: str, character_id: str):
-    """獲取角色好感度"""
+async def get_character_affinity(user_id: str, character_id: str, since: Optional[int] = None):
+    """獲取角色好感度；提供 since 時一併返回該回合之後完成的好感度變化"""
+    await chat_manager.load_conversation(user_id, character_id)
     affinity = chat_manager.get_affinity(user_id, character_id)
-    return {"affinity": affinity}
+    if since is None:
+        return {"affinity": affinity}
+    
+    return {
+        "affinity": affinity,
+        **(await chat_manager.get_affinity_updates(user_id, character_id, since))
+    }
 
 @app.post("/affinity/{user_id}/{character_id}")
 async def set_character_affinity(user_id: str, character_id: str, value: int):
     """設置角色好感度"""
-    new_affinity = chat_manager.set_affinity(user_id, character_id, value)
+    await chat_manager.load_conversation(user_id, character_id)
+    new_affinity = await chat_manager.set_affinity(user_id, character_id, value)
     return {"affinity": new_affinity}
 
 @app.get("/characters")
@@ -199,18 +374,33 @@ async def get_characters():
 @app.post("/reset_chat")
 async def reset_chat(user_id: str, character_id: str):
     """重置特定角色的聊天歷史"""
-    chat_manager.reset_chat(user_id, character_id)
+    await chat_manager.reset_chat(user_id, character_id)
     return {"status": "success", "message": f"已重置 {user_id} 與 {character_id} 的對話"}
 
 @app.post("/reset_all_chats")
 async def reset_all_chats(user_id: str = None):
     """重置所有聊天歷史"""
-    chat_manager.reset_all_chats(user_id)
+    await chat_manager.reset_all_chats(user_id)
     if user_id:
         return {"status": "success", "message": f"已重置用戶 {user_id} 的所有對話"}
     else:
         return {"status": "success", "message": "已重置所有對話"}
 
+@app.get("/memory/pool_stats")
+async def get_memory_pool_stats():
+    """獲取記憶資料庫連接池統計（連接數、取用等待時間、健康檢查次數）"""
+    return db_pool.get_stats()
+
+@app.get("/memory/cache_stats")
+async def get_memory_cache_stats():
+    """獲取記憶緩存統計（條目數、位元組數、命中率、失效通知次數）"""
+    return memory_cache.get_stats()
+
+@app.get("/memory/compaction_stats")
+async def get_memory_compaction_stats():
+    """獲取記憶壓縮統計（執行次數、處理的對話數、淘汰的記憶數）"""
+    return memory_compactor.get_stats()
+
 @app.get("/memory/{user_id}/{character_id}")
 async def get_memory(user_id: str, character_id: str):
     """獲取角色記憶"""
@@ -229,18 +419,6 @@ async def get_formatted_memory(user_id: str, character_id: str):
     memory_text = await memory_manager.get_formatted_memory(user_id, character_id)
     return {"memory_text": memory_text}
 
-# 在程序退出時關閉記憶資料庫連接
-@atexit.register
-def shutdown_db():
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            loop.create_task(memory_manager.disconnect())
-        else:
-            loop.run_until_complete(memory_manager.disconnect())
-    except Exception as e:
-        print(f"關閉資料庫連接時出錯: {str(e)}")
-
 # 添加根路由
 @app.get("/")
 async def root():
@@ -258,6 +436,7 @@ async def root():
         "supported_models": list(model_handlers.keys()),
         "endpoints": [
             "/chat", 
+            "/chat/stream", 
             "/memory", 
             "/models",
             "/characters"
@@ -0,0 +1,307 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+from db_pool import db_pool
+
+# 記憶表的觸發器在資料變更時透過此頻道通知（見 migrations/003_memory_notify.sql）
+NOTIFY_CHANNEL = "memory_invalidate"
+
+class CacheEntry:
+    """一段對話的緩存記憶"""
+
+    __slots__ = ("memory", "version", "expires_at", "size", "negative", "formatted", "index", "retrieval", "near_duplicates")
+
+    def __init__(self, memory: Dict[str, List[str]], version: int, expires_at: float, size: int, negative: bool):
+        self.memory = memory
+        self.version = version  # 每次寫入緩存都分配新的版本號，版本號相同表示內容未變
+        self.expires_at = expires_at
+        self.size = size  # 估算的位元組數
+        self.negative = negative  # 資料庫讀取失敗時的空結果，只保留很短的時間
+        self.formatted = None  # 此版本記憶格式化後的提示詞文本（第一次使用時生成）
+        self.index = None  # 記憶類型 -> 內容集合，用於增量新增時去重（第一次使用時建立）
+        self.retrieval = None  # 相關度檢索索引（記憶超過提示詞預算時才建立，見 memory_index.py）
+        self.near_duplicates = None  # 近似重複索引，用於新增時合併相似的記憶（見 memory_dedup.py）
+
+class MemoryCache:
+    """
+    有界的記憶緩存
+
+    - 以 (用戶ID, 角色ID) 為鍵，按最近使用排序，超過條目數或位元組預算時淘汰最久未使用的對話
+    - 正常結果保留 MEMORY_CACHE_TTL_SECONDS 秒；資料庫讀取失敗的空結果只保留 MEMORY_CACHE_NEGATIVE_TTL_SECONDS 秒
+    - 透過 PostgreSQL LISTEN/NOTIFY 接收其他 worker 的寫入通知並移除對應條目；
+      監聽連接中斷期間不使用緩存，重新連接後清空（中斷期間的通知已遺失）
+    - 讀取資料庫期間若該對話被失效，讀到的結果不寫入緩存，避免以舊資料覆蓋
+    """
+
+    def __init__(self):
+        """初始化緩存（從環境變數讀取容量設定）"""
+        self.max_entries = int(os.getenv("MEMORY_CACHE_MAX_ENTRIES", "10000"))
+        self.max_bytes = int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.ttl = float(os.getenv("MEMORY_CACHE_TTL_SECONDS", "3600"))
+        self.negative_ttl = float(os.getenv("MEMORY_CACHE_NEGATIVE_TTL_SECONDS", "5"))
+
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._clock = 0  # 版本號和失效時間點共用的遞增計數
+        self._loading: Dict[Tuple[str, str], int] = {}  # 正在讀取資料庫的對話 -> 讀取中的請求數
+        self._invalidated: Dict[Tuple[str, str], int] = {}  # 讀取期間被失效的對話 -> 失效時的計數
+
+        self._listener = None  # LISTEN 專用的連接
+        self._reconnect_task = None
+        self._closing = False
+        self.coherent = True  # 監聽中斷時為 False，此時不讀寫緩存
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "negative_hits": 0,
+            "stale_loads_discarded": 0,
+            "evicted_lru": 0,
+            "evicted_bytes": 0,
+            "expired": 0,
+            "notifications": 0,
+            "reconnects": 0
+        }
+
+    @staticmethod
+    def _estimate_size(memory: Dict[str, List[str]]) -> int:
+        """估算記憶佔用的位元組數（字串以 UCS-2 計，另加物件和列表指標的開銷）"""
+        return 200 + sum(100 + sum(len(item) * 2 + 60 for item in items) for items in memory.values())
+
+    def get(self, user_id: str, character_id: str) -> Optional[CacheEntry]:
+        """
+        獲取緩存條目
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+
+        返回:
+            未過期的條目，不存在、已過期或緩存暫停使用時為 None
+        """
+        key = (user_id, character_id)
+        entry = self._entries.get(key)
+        if entry is None or not self.coherent:
+            self._stats["misses"] += 1
+            return None
+        if time.monotonic() > entry.expires_at:
+            self._remove(key)
+            self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self._stats["negative_hits" if entry.negative else "hits"] += 1
+        return entry
+
+    def begin_load(self, user_id: str, character_id: str) -> int:
+        """
+        標記開始從資料庫讀取
+
+        返回:
+            讀取開始時的計數，完成時傳給 finish_load
+        """
+        key = (user_id, character_id)
+        self._loading[key] = self._loading.get(key, 0) + 1
+        return self._clock
+
+    def finish_load(self, user_id: str, character_id: str, token: int,
+                    memory: Dict[str, List[str]], negative: bool = False) -> Optional[CacheEntry]:
+        """
+        寫入從資料庫讀取的結果（讀取期間對話被失效或被寫入時捨棄）
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            token: begin_load 返回的計數
+            memory: 讀取到的記憶
+            negative: 是否為資料庫讀取失敗時的空結果
+
+        返回:
+            寫入的條目，捨棄時為 None
+        """
+        key = (user_id, character_id)
+        remaining = self._loading.get(key, 1) - 1
+        if remaining:
+            self._loading[key] = remaining
+        else:
+            self._loading.pop(key, None)
+        stale = self._invalidated.get(key, 0) > token
+        if not remaining:
+            self._invalidated.pop(key, None)
+        if stale:
+            self._stats["stale_loads_discarded"] += 1
+            return None
+        return self._store(key, memory, negative)
+
+    def set(self, user_id: str, character_id: str, memory: Dict[str, List[str]]) -> CacheEntry:
+        """
+        寫入本程序更新後的記憶（分配新的版本號，並使進行中的讀取結果失效）
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            memory: 新的記憶
+
+        返回:
+            寫入的條目
+        """
+        key = (user_id, character_id)
+        self._mark_invalidated(key)
+        return self._store(key, memory, False)
+
+    def add_size(self, user_id: str, character_id: str, entry: CacheEntry, extra: int) -> None:
+        """
+        把條目上附加的資料（例如檢索索引）計入位元組預算
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            entry: 條目（已被替換或移除時只更新條目本身）
+            extra: 增加的位元組數
+        """
+        entry.size += extra
+        key = (user_id, character_id)
+        if self._entries.get(key) is not entry:
+            return
+        self._bytes += extra
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self._stats["evicted_bytes"] += 1
+
+    def invalidate(self, user_id: str, character_id: str) -> None:
+        """移除特定對話的緩存"""
+        key = (user_id, character_id)
+        self._mark_invalidated(key)
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        """清空緩存"""
+        self._clock += 1
+        for key in self._loading:
+            self._invalidated[key] = self._clock
+        self._entries.clear()
+        self._bytes = 0
+
+    def _mark_invalidated(self, key: Tuple[str, str]) -> None:
+        """記錄失效時間點（只為正在讀取的對話保留，讀取完成後移除）"""
+        self._clock += 1
+        if key in self._loading:
+            self._invalidated[key] = self._clock
+
+    def _store(self, key: Tuple[str, str], memory: Dict[str, List[str]], negative: bool) -> CacheEntry:
+        """寫入條目並按條目數和位元組預算淘汰"""
+        self._clock += 1
+        # 沒有資料庫時緩存是唯一的副本，不按時間過期
+        ttl = self.negative_ttl if negative else (self.ttl if db_pool.available else float("inf"))
+        entry = CacheEntry(memory, self._clock, time.monotonic() + ttl, self._estimate_size(memory), negative)
+        if not self.coherent:
+            return entry
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self._stats["evicted_lru"] += 1
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self._stats["evicted_bytes"] += 1
+        return entry
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        """移除條目"""
+        self._bytes -= self._entries.pop(key).size
+
+    async def start(self) -> None:
+        """連接資料庫並開始監聽記憶變更通知（沒有資料庫時不需要）"""
+        if not db_pool.available:
+            return
+        self._closing = False
+        try:
+            await self._connect()
+            print("已開始監聽記憶變更通知")
+        except Exception as e:
+            print(f"監聽記憶變更通知時出錯: {str(e)}")
+            self._on_listener_lost(None)
+
+    async def _connect(self) -> None:
+        """建立監聽連接"""
+        import asyncpg
+
+        listener = await asyncpg.connect(db_pool.db_url)
+        listener.add_termination_listener(self._on_listener_lost)
+        await listener.add_listener(NOTIFY_CHANNEL, self._on_notification)
+        self._listener = listener
+        # 未監聽期間可能錯過了通知，舊的條目都不可信
+        self.clear()
+        self.coherent = True
+
+    def _on_listener_lost(self, connection: Any) -> None:
+        """監聽連接中斷：停用緩存並在背景重新連接"""
+        self._listener = None
+        self.coherent = False
+        if self._closing or (self._reconnect_task and not self._reconnect_task.done()):
+            return
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        """按指數退避重新建立監聽連接"""
+        delay = 1.0
+        while not self._closing and self._listener is None:
+            await asyncio.sleep(delay)
+            self._stats["reconnects"] += 1
+            try:
+                await self._connect()
+                print("已重新監聽記憶變更通知")
+            except Exception as e:
+                delay = min(delay * 2, 30.0)
+                print(f"重新監聽記憶變更通知失敗，{delay:.0f} 秒後重試: {str(e)}")
+
+    def _on_notification(self, connection: Any, pid: int, channel: str, payload: str) -> None:
+        """
+        處理記憶變更通知
+
+        參數:
+            pid: 執行寫入的資料庫程序ID（本程序連接池發出的寫入已更新過緩存，直接忽略）
+            payload: "用戶ID\\x1f角色ID"
+        """
+        self._stats["notifications"] += 1
+        if db_pool.owns_backend(pid):
+            return
+        user_id, _, character_id = payload.partition("\x1f")
+        self.invalidate(user_id, character_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        獲取緩存統計
+
+        返回:
+            包含條目數、位元組數、命中率和失效次數的字典
+        """
+        lookups = self._stats["hits"] + self._stats["negative_hits"] + self._stats["misses"]
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "negative_ttl_seconds": self.negative_ttl,
+            "coherent": self.coherent,
+            "listening": self._listener is not None,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+            **self._stats
+        }
+
+    async def close(self) -> None:
+        """停止監聽"""
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            await listener.close()
+
+# 創建單例實例
+memory_cache = MemoryCache()
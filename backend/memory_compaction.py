@@ -0,0 +1,140 @@
+import os
+import time
+import asyncio
+from typing import Dict, Any
+from db_pool import db_pool
+from memory_manager import memory_manager, IMPORTANCE_SCORE
+
+# 多個 worker 同時執行時，只讓一個進行壓縮
+COMPACTION_LOCK_ID = 726354902
+
+# 按 (user_id, character_id) 順序讀取下一批對話，並標出需要壓縮的對話：
+# 超過每段對話或每個類型的上限，或有重要性低於下限的推斷記憶。
+# 以上一批最後一段對話為起點（鍵集分頁），沿 memories_content_key 索引只讀取這一批對話的記憶，
+# 每條語句的耗時與批次大小成正比，不受連接池 statement_timeout 和記憶表大小影響。
+# 參數: $1 每段對話的上限, $2 每個類型的上限, $3 半衰期（秒）, $4 重要性下限,
+#       $5 $6 上一批最後的用戶ID和角色ID（第一批為 NULL）, $7 每批的對話數
+COMPACTION_PAGE = f"""
+WITH page AS (
+    SELECT DISTINCT user_id, character_id
+    FROM memories
+    WHERE $5::text IS NULL OR (user_id, character_id) > ($5::text, $6::text)
+    ORDER BY user_id, character_id
+    LIMIT $7
+)
+SELECT p.user_id, p.character_id, c.needs_pruning
+FROM page p
+CROSS JOIN LATERAL (
+    SELECT coalesce(sum(entries) > $1 OR max(entries) > $2 OR bool_or(has_expired), false) AS needs_pruning
+    FROM (
+        SELECT count(*) AS entries,
+               bool_or(source = 'inferred' AND {IMPORTANCE_SCORE.format(half_life="$3")} < $4) AS has_expired
+        FROM memories m
+        WHERE m.user_id = p.user_id AND m.character_id = p.character_id
+        GROUP BY m.memory_type
+    ) per_type
+) c
+ORDER BY p.user_id, p.character_id
+"""
+
+class MemoryCompactor:
+    """
+    定期壓縮記憶表
+
+    寫入時只檢查該對話的數量上限；長時間沒有新對話的記憶仍會隨時間衰減，
+    由此任務定期找出超過上限或重要性過低的對話，逐一以 MemoryManager.prune_memory 淘汰。
+    """
+
+    def __init__(self):
+        """初始化壓縮任務（從環境變數讀取執行間隔）"""
+        self.interval = float(os.getenv("MEMORY_COMPACTION_INTERVAL_SECONDS", "3600"))
+        self.batch_size = int(os.getenv("MEMORY_COMPACTION_BATCH_SIZE", "500"))
+        self._task = None
+        self._stats = {
+            "runs": 0,
+            "skipped_locked": 0,
+            "scanned": 0,
+            "conversations": 0,
+            "pruned": 0,
+            "errors": 0,
+            "last_run_seconds": 0.0
+        }
+
+    async def start(self) -> None:
+        """開始定期壓縮（沒有資料庫或間隔為 0 時不執行）"""
+        if not db_pool.available or self.interval <= 0:
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self) -> None:
+        """每隔 interval 秒壓縮一次"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(f"壓縮記憶時出錯: {str(e)}")
+
+    async def run_once(self) -> int:
+        """
+        執行一次壓縮（其他 worker 正在壓縮時略過）
+
+        返回:
+            淘汰的項目數
+        """
+        start = time.perf_counter()
+        pruned = 0
+        async with db_pool.acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", COMPACTION_LOCK_ID):
+                self._stats["skipped_locked"] += 1
+                return 0
+            try:
+                last_user_id = last_character_id = None
+                while True:
+                    page = await conn.fetch(
+                        COMPACTION_PAGE, memory_manager.max_entries, memory_manager.max_entries_per_type,
+                        memory_manager.half_life_seconds, memory_manager.min_importance,
+                        last_user_id, last_character_id, self.batch_size
+                    )
+                    candidates = [row for row in page if row["needs_pruning"]]
+                    for row in candidates:
+                        pruned += await memory_manager.prune_memory(row["user_id"], row["character_id"], conn)
+                    self._stats["scanned"] += len(page)
+                    self._stats["conversations"] += len(candidates)
+                    # 不足一批表示已掃描到最後一段對話
+                    if len(page) < self.batch_size:
+                        break
+                    last_user_id, last_character_id = page[-1]["user_id"], page[-1]["character_id"]
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", COMPACTION_LOCK_ID)
+        self._stats["runs"] += 1
+        self._stats["pruned"] += pruned
+        self._stats["last_run_seconds"] = round(time.perf_counter() - start, 3)
+        if pruned:
+            print(f"記憶壓縮完成，淘汰 {pruned} 條記憶")
+        return pruned
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取壓縮統計"""
+        return {
+            "interval_seconds": self.interval,
+            "batch_size": self.batch_size,
+            "running": self._task is not None and not self._task.done(),
+            **self._stats
+        }
+
+    async def close(self) -> None:
+        """停止定期壓縮"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+# 創建單例實例
+memory_compactor = MemoryCompactor()
@@ -0,0 +1,352 @@
+import os
+import re
+import sys
+import asyncio
+import hashlib
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from keyword_matcher import keyword_matcher
+
+# 載入環境變數
+load_dotenv()
+
+# 相似度（詞元雙字組的 Jaccard 係數）達到此值的同類型記憶視為重複
+SIMILARITY_THRESHOLD = float(os.getenv("MEMORY_DEDUP_THRESHOLD", "0.65"))
+
+# MinHash 簽名：64 個雜湊函數各取最小值的低 16 位（低位碰撞機率可忽略），共 128 位元組。
+# 以簽名估算的相似度誤差約 ±0.06，只用來篩選候選項目，再以正規化後的文本計算實際相似度確認。
+# 簽名保存在資料庫中，雜湊參數必須在所有程序和版本間保持不變
+NUM_PERMUTATIONS = 64
+CANDIDATE_MARGIN = 0.15
+# 每個新項目最多確認的候選數（按估算相似度排序），讓大量相似記憶時的耗時保持有界
+MAX_CANDIDATES = 8
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_PERMUTATIONS = np.random.RandomState(726354903).randint(1, 1 << 32, size=(2, NUM_PERMUTATIONS), dtype=np.uint64)
+
+# 不影響記憶含義的語氣詞和程度詞，比對前移除（英文按完整單詞比對）
+FILLER_WORDS = re.compile(r"真的|其實|非常|有點|好像|一下|就是|[了啊呢吧啦呀喔哦]|\b(?:really|very|just|so|actually)\b")
+
+# 否定詞：只差在否定詞上的兩條記憶意思相反（「我喜歡」與「我不喜歡」），不能合併。
+# 「特別」「分別」等詞和「別人」中的「別」不是否定
+NEGATORS = re.compile(
+    r"不|沒|没|未|(?<![特分區区差告離离類类級级])[別别](?!人)"
+    r"|\b(?:not|no|never|don't|doesn't|didn't|isn't|aren't|wasn't|won't|can't|cannot)\b"
+)
+
+def _template_prefixes() -> List[str]:
+    """記憶模板中片段之前的固定文字（例如「用戶提到的事件：」），各類型共用，不應計入相似度"""
+    prefixes = {
+        unicodedata.normalize("NFKC", template.split("{span}")[0]).casefold()
+        for template in keyword_matcher.templates.values()
+    }
+    return sorted((prefix for prefix in prefixes if prefix), key=len, reverse=True)
+
+TEMPLATE_PREFIXES = _template_prefixes()
+
+# 英文和數字以整個單詞為一個詞元，其他文字（中日韓文字）每個字一個詞元；標點、符號和空白不計
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[^\W_a-z0-9]")
+
+def normalize(text: str) -> List[str]:
+    """
+    正規化記憶文本：統一全形半形和大小寫，移除模板前綴和語氣詞後切分成詞元
+
+    參數:
+        text: 記憶文本
+
+    返回:
+        詞元列表
+    """
+    return TOKEN_PATTERN.findall(FILLER_WORDS.sub("", _strip_template(text)))
+
+def _strip_template(text: str) -> str:
+    """統一全形半形和大小寫，並移除模板前綴"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    for prefix in TEMPLATE_PREFIXES:
+        if text.startswith(prefix):
+            return text[len(prefix):]
+    return text
+
+def polarity(text: str) -> Tuple[Tuple[str, ...], frozenset]:
+    """
+    記憶文本中的否定詞和詞庫關鍵詞
+
+    兩條記憶的否定詞或關鍵詞不同時（例如「我喜歡」與「我不喜歡」、「我愛」與「我討厭」），
+    即使其餘文字幾乎相同，意思也不同，不視為重複。
+
+    參數:
+        text: 記憶文本
+
+    返回:
+        (排序後的否定詞, 關鍵詞集合)
+    """
+    text = FILLER_WORDS.sub("", _strip_template(text).replace("\u2019", "'"))
+    triggers = frozenset(text[start:end] for start, end, _ in keyword_matcher.find(text))
+    return tuple(sorted(NEGATORS.findall(text))), triggers
+
+def shingles(text: str) -> set:
+    """記憶文本的詞元雙字組集合（只有一個詞元時為該詞元）"""
+    tokens = normalize(text)
+    return {" ".join(tokens[i:i + 2]) for i in range(len(tokens) - 1)} or set(tokens)
+
+def jaccard(a: set, b: set) -> float:
+    """兩個集合的 Jaccard 係數"""
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+def minhash(text: str) -> Optional[bytes]:
+    """
+    計算記憶文本的 MinHash 簽名
+
+    參數:
+        text: 記憶文本
+
+    返回:
+        128 位元組的簽名；正規化後沒有內容時為 None（只能做完全相同的比對）
+    """
+    features = shingles(text)
+    if not features:
+        return None
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest(), "little") for feature in features),
+        dtype=np.uint64, count=len(features)
+    )
+    # (a * x + b) mod p：a、x、b 都小於 2^32，乘積加常數不會超出 uint64
+    values = (hashes[:, None] * _PERMUTATIONS[0] + _PERMUTATIONS[1]) % _MERSENNE_PRIME
+    return (values.min(axis=0) & np.uint64(0xFFFF)).astype("<u2").tobytes()
+
+class _TypeSignatures:
+    """一個記憶類型的簽名矩陣（預留容量，新增和移除都不需要重建矩陣）"""
+
+    __slots__ = ("texts", "rows", "matrix")
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.matrix = np.empty((8, NUM_PERMUTATIONS), dtype="<u2")
+
+class NearDuplicateIndex:
+    """
+    一段對話的近似重複索引：按記憶類型保存簽名矩陣，一次比對新項目與同類型的所有記憶
+    """
+
+    def __init__(self, threshold: float = SIMILARITY_THRESHOLD):
+        """建立空索引"""
+        self.threshold = threshold
+        self._types: Dict[str, _TypeSignatures] = {}
+
+    @classmethod
+    def build(cls, memory: Dict[str, List[str]]) -> "NearDuplicateIndex":
+        """以記憶字典建立索引（計算所有項目的簽名）"""
+        index = cls()
+        for memory_type, items in memory.items():
+            for item in items:
+                index.add(memory_type, item, minhash(item))
+        return index
+
+    def add(self, memory_type: str, text: str, signature: Optional[bytes]) -> None:
+        """加入一條記憶（沒有簽名的項目不參與近似比對）"""
+        if not signature:
+            return
+        signatures = self._types.setdefault(memory_type, _TypeSignatures())
+        row = signatures.rows.get(text)
+        if row is None:
+            row = len(signatures.texts)
+            if row == len(signatures.matrix):
+                signatures.matrix = np.concatenate([signatures.matrix, np.empty_like(signatures.matrix)])
+            signatures.texts.append(text)
+            signatures.rows[text] = row
+        signatures.matrix[row] = np.frombuffer(signature, dtype="<u2")
+
+    def remove(self, memory_type: str, text: str) -> None:
+        """移除一條記憶（以最後一列填補空位）"""
+        signatures = self._types.get(memory_type)
+        row = signatures.rows.pop(text, None) if signatures else None
+        if row is None:
+            return
+        last = len(signatures.texts) - 1
+        if row != last:
+            moved = signatures.texts[last]
+            signatures.texts[row] = moved
+            signatures.rows[moved] = row
+            signatures.matrix[row] = signatures.matrix[last]
+        signatures.texts.pop()
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        memory_type, text = key
+        signatures = self._types.get(memory_type)
+        return signatures is not None and text in signatures.rows
+
+    def keys(self) -> List[Tuple[str, str]]:
+        """所有項目的 (記憶類型, 內容)"""
+        return [(memory_type, text) for memory_type, signatures in self._types.items() for text in signatures.texts]
+
+    def signature_of(self, memory_type: str, text: str) -> Optional[bytes]:
+        """已保存的簽名（不存在時為 None）"""
+        signatures = self._types.get(memory_type)
+        row = signatures.rows.get(text) if signatures else None
+        return None if row is None else signatures.matrix[row].tobytes()
+
+    def find(self, memory_type: str, text: str, signature: Optional[bytes]) -> Optional[str]:
+        """
+        找出與新項目近似重複的同類型記憶
+
+        先以簽名矩陣一次估算與所有記憶的相似度，再對估算值最高的幾個候選項目計算實際相似度；
+        否定詞或詞庫關鍵詞不同的候選項目意思不同，不會被選中。
+
+        參數:
+            memory_type: 記憶類型
+            text: 新項目的內容
+            signature: 新項目的簽名
+
+        返回:
+            相似度達到門檻的現有記憶內容（多個時取最相似的），沒有時為 None
+        """
+        signatures = self._types.get(memory_type)
+        if not signature or not signatures or not signatures.texts:
+            return None
+        count = len(signatures.texts)
+        estimates = (signatures.matrix[:count] == np.frombuffer(signature, dtype="<u2")).mean(axis=1)
+        candidates = np.flatnonzero(estimates >= self.threshold - CANDIDATE_MARGIN)
+        if not len(candidates):
+            return None
+        features = shingles(text)
+        signs = None
+        best, best_score = None, self.threshold
+        for i in candidates[np.argsort(-estimates[candidates])][:MAX_CANDIDATES]:
+            score = jaccard(features, shingles(signatures.texts[i]))
+            if score < best_score:
+                continue
+            if signs is None:
+                signs = polarity(text)
+            if polarity(signatures.texts[i]) == signs:
+                best, best_score = signatures.texts[i], score
+        return best
+
+    @property
+    def nbytes(self) -> int:
+        """估算索引佔用的位元組數"""
+        return sum(signatures.matrix.nbytes + 100 * len(signatures.texts) for signatures in self._types.values())
+
+async def backfill_signatures(conn, batch_size: int = 1000) -> int:
+    """
+    為尚未計算簽名的記憶計算並保存簽名（沒有內容可比對的項目保存空值，避免重複計算）
+
+    參數:
+        conn: asyncpg 連接
+        batch_size: 每批處理的行數
+
+    返回:
+        更新的行數
+    """
+    updated = 0
+    while True:
+        rows = await conn.fetch(
+            "SELECT user_id, id, content FROM memories WHERE minhash IS NULL LIMIT $1", batch_size
+        )
+        if not rows:
+            return updated
+        await conn.execute(
+            """
+            UPDATE memories m SET minhash = v.minhash
+            FROM unnest($1::text[], $2::int[], $3::bytea[]) AS v(user_id, id, minhash)
+            WHERE m.user_id = v.user_id AND m.id = v.id
+            """,
+            [row["user_id"] for row in rows], [row["id"] for row in rows],
+            [minhash(row["content"]) or b"" for row in rows]
+        )
+        updated += len(rows)
+
+async def collapse_duplicates(conn, dry_run: bool = False) -> Tuple[int, int]:
+    """
+    合併記憶表中已存在的近似重複項目
+
+    每段對話、每個類型按建立順序比對，保留最早的一條，
+    並把重複項目的提及次數、最後提到的時間和明確來源合併到保留的項目上。
+
+    參數:
+        conn: asyncpg 連接
+        dry_run: 只統計，不修改資料
+
+    返回:
+        (有重複的對話數, 刪除的項目數)
+    """
+    conversations = await conn.fetch("SELECT DISTINCT user_id, character_id FROM memories")
+    affected = 0
+    removed_total = 0
+    for conversation in conversations:
+        rows = await conn.fetch(
+            """
+            SELECT id, memory_type, content, minhash, source, mention_count, last_seen_at
+            FROM memories WHERE user_id = $1 AND character_id = $2 ORDER BY id
+            """,
+            conversation["user_id"], conversation["character_id"]
+        )
+        index = NearDuplicateIndex()
+        kept: Dict[Tuple[str, str], dict] = {}
+        removed_ids = []
+        for row in rows:
+            signature = row["minhash"] if row["minhash"] is not None else minhash(row["content"])
+            duplicate = index.find(row["memory_type"], row["content"], signature)
+            if duplicate is None:
+                index.add(row["memory_type"], row["content"], signature)
+                kept[(row["memory_type"], row["content"])] = dict(row, merged=False)
+                continue
+            target = kept[(row["memory_type"], duplicate)]
+            target["mention_count"] += row["mention_count"]
+            target["last_seen_at"] = max(target["last_seen_at"], row["last_seen_at"])
+            if row["source"] == "explicit":
+                target["source"] = "explicit"
+            target["merged"] = True
+            removed_ids.append(row["id"])
+        if not removed_ids:
+            continue
+        affected += 1
+        removed_total += len(removed_ids)
+        if dry_run:
+            continue
+        merged = [target for target in kept.values() if target["merged"]]
+        async with conn.transaction():
+            await conn.execute(
+                "DELETE FROM memories WHERE user_id = $1 AND id = ANY($2::int[])",
+                conversation["user_id"], removed_ids
+            )
+            await conn.execute(
+                """
+                UPDATE memories m
+                SET mention_count = v.mention_count, last_seen_at = v.last_seen_at, source = v.source
+                FROM unnest($2::int[], $3::int[], $4::timestamptz[], $5::text[])
+                     AS v(id, mention_count, last_seen_at, source)
+                WHERE m.user_id = $1 AND m.id = v.id
+                """,
+                conversation["user_id"], [target["id"] for target in merged],
+                [target["mention_count"] for target in merged], [target["last_seen_at"] for target in merged],
+                [target["source"] for target in merged]
+            )
+    return affected, removed_total
+
+async def main(args: List[str]) -> None:
+    """命令列入口：回填簽名並合併已存在的近似重複記憶"""
+    import asyncpg
+    from migrate import apply_migrations
+
+    if not os.getenv("DATABASE_URL"):
+        print("請設定 DATABASE_URL")
+        sys.exit(1)
+    if args and args != ["--dry-run"]:
+        print("用法: python memory_dedup.py [--dry-run]")
+        sys.exit(1)
+    dry_run = bool(args)
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    try:
+        await apply_migrations(conn)
+        if not dry_run:
+            print(f"已回填 {await backfill_signatures(conn)} 條記憶的簽名")
+        affected, removed = await collapse_duplicates(conn, dry_run)
+        action = "將刪除" if dry_run else "已刪除"
+        print(f"{affected} 段對話有近似重複的記憶，{action} {removed} 條")
+    finally:
+        await conn.close()
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
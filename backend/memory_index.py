@@ -0,0 +1,173 @@
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+# 以雜湊把字元 n-gram 映射到固定數量的維度（不需要保存詞表）；索引只存在於本程序，
+# 因此直接使用 Python 內建的字串雜湊。維度以 uint16 保存，不能超過 65536
+HASH_DIM = 1 << 15
+
+# 中文以單字和雙字為主，英文靠三字元片段區分單詞
+NGRAM_SIZES = (1, 2, 3)
+
+# 最近幾回合對話的權重（當前用戶消息為 1）
+CONTEXT_WEIGHT = 0.5
+
+def _features(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    把文本轉換成雜湊 n-gram 的稀疏向量
+
+    參數:
+        text: 文本
+
+    返回:
+        (維度下標 uint16, 對數詞頻 float16)，下標不重複
+    """
+    text = " ".join(text.lower().split())
+    counts: Dict[int, int] = {}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            bucket = hash(text[i:i + n]) % HASH_DIM
+            counts[bucket] = counts.get(bucket, 0) + 1
+    indices = np.fromiter(counts.keys(), dtype=np.uint16, count=len(counts))
+    tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    return indices, (1 + np.log(tf)).astype(np.float16)
+
+class MemoryIndex:
+    """
+    一段對話的記憶檢索索引（字元 n-gram TF-IDF，以 NumPy 計算）
+
+    每條記憶只在加入時計算一次稀疏向量；新增或移除記憶時只處理變動的項目，
+    IDF 和向量長度在下一次查詢時以整批陣列運算重新計算（記憶未變時沿用）。
+    """
+
+    def __init__(self):
+        """建立空索引"""
+        self.items: List[Optional[Tuple[str, str]]] = []  # 位置 -> (記憶類型, 內容)，已移除的為 None
+        self._features: List[Optional[Tuple[np.ndarray, np.ndarray]]] = []
+        self._positions: Dict[Tuple[str, str], int] = {}
+        self._removed = 0
+        self._prepared = None  # 查詢用的合併陣列，記憶變動時清除
+
+    @classmethod
+    def build(cls, memory: Dict[str, List[str]]) -> "MemoryIndex":
+        """以記憶字典建立索引"""
+        index = cls()
+        index.sync(memory)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def add(self, memory_type: str, text: str) -> bool:
+        """
+        加入一條記憶
+
+        返回:
+            是否為新項目
+        """
+        key = (memory_type, text)
+        if key in self._positions:
+            return False
+        self._positions[key] = len(self.items)
+        self.items.append(key)
+        self._features.append(_features(text))
+        self._prepared = None
+        return True
+
+    def remove(self, memory_type: str, text: str) -> bool:
+        """
+        移除一條記憶（移除的項目超過一半時壓縮）
+
+        返回:
+            項目是否存在
+        """
+        position = self._positions.pop((memory_type, text), None)
+        if position is None:
+            return False
+        self.items[position] = None
+        self._features[position] = None
+        self._removed += 1
+        self._prepared = None
+        if self._removed > len(self._positions):
+            self._compact()
+        return True
+
+    def sync(self, memory: Dict[str, List[str]]) -> Tuple[int, int]:
+        """
+        讓索引與記憶字典一致，只處理新增和移除的項目
+
+        參數:
+            memory: 新的記憶
+
+        返回:
+            (新增數, 移除數)
+        """
+        wanted = {(memory_type, text) for memory_type, items in memory.items() for text in items}
+        removed = sum(self.remove(*key) for key in [key for key in self._positions if key not in wanted])
+        added = sum(self.add(memory_type, text) for memory_type, items in memory.items() for text in items)
+        return added, removed
+
+    def _compact(self) -> None:
+        """移除已刪除項目留下的空位（保持加入順序）"""
+        kept = [position for position, item in enumerate(self.items) if item is not None]
+        self.items = [self.items[position] for position in kept]
+        self._features = [self._features[position] for position in kept]
+        self._positions = {item: position for position, item in enumerate(self.items)}
+        self._removed = 0
+
+    @property
+    def nbytes(self) -> int:
+        """估算索引佔用的位元組數（包含查詢時建立的合併陣列，每個 n-gram 約 10 位元組）"""
+        grams = sum(len(features[0]) for features in self._features if features is not None)
+        return 100 * len(self.items) + grams * 10
+
+    def _prepare(self) -> Optional[tuple]:
+        """合併所有項目的向量，計算 IDF 權重和向量長度"""
+        positions = [position for position, features in enumerate(self._features)
+                     if features is not None and len(features[0])]
+        if not positions:
+            return None
+        indices = np.concatenate([self._features[position][0] for position in positions])
+        tf = np.concatenate([self._features[position][1] for position in positions]).astype(np.float32)
+        lengths = np.fromiter((len(self._features[position][0]) for position in positions), dtype=np.int64, count=len(positions))
+        offsets = np.zeros(len(positions), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+
+        # 每個項目內的下標不重複，因此下標出現次數就是文件頻率
+        buckets, df = np.unique(indices, return_counts=True)
+        idf = (np.log((1 + len(positions)) / (1 + df)) + 1).astype(np.float32)
+        weights = tf * idf[np.searchsorted(buckets, indices)]
+        norms = np.sqrt(np.add.reduceat(weights * weights, offsets))
+        self._prepared = (np.array(positions, dtype=np.int64), indices, weights, offsets, norms, buckets, idf)
+        return self._prepared
+
+    def search(self, query: str, context: str = "", top_k: int = 30) -> List[Tuple[Tuple[str, str], float]]:
+        """
+        按與查詢的相關度排列記憶
+
+        參數:
+            query: 當前用戶消息
+            context: 最近幾回合的對話（權重較低）
+            top_k: 最多返回的項目數
+
+        返回:
+            ((記憶類型, 內容), 相關度分數) 列表，相關度相同時較新的記憶在前
+        """
+        prepared = self._prepared or self._prepare()
+        if prepared is None:
+            return []
+        positions, indices, weights, offsets, norms, buckets, idf = prepared
+
+        query_vector = np.zeros(HASH_DIM, dtype=np.float32)
+        for text, weight in ((query, 1.0), (context, CONTEXT_WEIGHT)):
+            if not text:
+                continue
+            query_indices, query_tf = _features(text)
+            # 只有記憶中出現過的維度會影響分數
+            found = np.minimum(np.searchsorted(buckets, query_indices), len(buckets) - 1)
+            known = buckets[found] == query_indices
+            query_vector[query_indices[known]] += weight * query_tf[known].astype(np.float32) * idf[found[known]]
+
+        # 查詢向量的長度對所有項目相同，不影響排序，因此不做正規化
+        scores = np.add.reduceat(weights * query_vector[indices], offsets) / norms
+        order = np.lexsort((-positions, -scores))[:top_k]
+        return [(self.items[positions[i]], float(scores[i])) for i in order]
@@ -1,18 +1,103 @@
 from typing import Dict, List, Any, Optional
-import requests
-import json
 import os
-import sys
 import asyncio
-import psycopg2
-import psycopg2.extras
+from itertools import islice
 from dotenv import load_dotenv
+from db_pool import db_pool
+from memory_cache import memory_cache, CacheEntry
+from token_budget import CountedText, TokenEstimator
+from memory_index import MemoryIndex
+from memory_dedup import NearDuplicateIndex, minhash
+from keyword_matcher import keyword_matcher
 
 # 載入環境變數
 load_dotenv()
 
-# 資料庫設定
-DB_URL = os.getenv("DATABASE_URL")
+# 表結構和索引由 migrations/ 中的遷移建立（見 migrate.py），check_indexes.py 檢查以下查詢是否使用索引
+
+# 讀取一段對話的所有記憶（按建立順序）
+MEMORY_SELECT = """
+SELECT memory_type, content, minhash
+FROM memories
+WHERE user_id = $1 AND character_id = $2
+ORDER BY id
+"""
+
+# 清除一段對話的所有記憶
+MEMORY_CLEAR = """
+DELETE FROM memories
+WHERE user_id = $1 AND character_id = $2
+"""
+
+# 新增記憶；已存在的項目增加提及次數並更新最後提到的時間（明確新增時同時標記為 explicit）。
+# 參數同 MEMORY_SYNC 的 $1-$4 和 $6（陣列中不能有重複項目），$5 來源（explicit / inferred）
+MEMORY_ADD = """
+INSERT INTO memories (user_id, character_id, memory_type, content, source, minhash)
+SELECT $1, $2, memory_type, content, $5, minhash
+FROM unnest($3::text[], $4::text[], $6::bytea[]) WITH ORDINALITY AS t(memory_type, content, minhash, ord)
+ORDER BY ord
+ON CONFLICT (user_id, character_id, memory_type, content_hash) DO UPDATE
+SET mention_count = memories.mention_count + 1,
+    last_seen_at = now(),
+    source = CASE WHEN EXCLUDED.source = 'explicit' THEN 'explicit' ELSE memories.source END,
+    minhash = COALESCE(memories.minhash, EXCLUDED.minhash)
+"""
+
+# 記憶的重要性：明確新增的記憶權重加倍，每多提到一次按對數增加，
+# 並按最後提到的時間以半衰期（{half_life} 秒）指數衰減（限制指數下限，避免浮點下溢報錯）
+IMPORTANCE_SCORE = """
+(CASE WHEN source = 'explicit' THEN 2.0 ELSE 1.0 END)
+* (1 + ln(mention_count))
+* exp(GREATEST(-ln(2) * extract(epoch FROM now() - last_seen_at) / {half_life}, -700))
+"""
+
+# 淘汰一段對話中價值最低的記憶：每個類型和整段對話只保留重要性最高的項目，
+# 並刪除重要性低於下限的推斷記憶（明確新增的記憶只受數量上限限制）。
+# 參數: $1 用戶ID, $2 角色ID, $3 每個類型的上限, $4 每段對話的上限, $5 半衰期（秒）, $6 重要性下限
+MEMORY_PRUNE = f"""
+WITH scored AS (
+    SELECT id, memory_type, source, {IMPORTANCE_SCORE.format(half_life="$5")} AS importance
+    FROM memories
+    WHERE user_id = $1 AND character_id = $2
+), ranked AS (
+    SELECT id, source, importance,
+           row_number() OVER (PARTITION BY memory_type ORDER BY importance DESC, id DESC) AS type_rank
+    FROM scored
+), kept AS (
+    SELECT id, row_number() OVER (ORDER BY importance DESC, id DESC) AS total_rank
+    FROM ranked
+    WHERE type_rank <= $3 AND NOT (source = 'inferred' AND importance < $6)
+)
+DELETE FROM memories m
+WHERE m.user_id = $1 AND m.character_id = $2
+  AND m.id NOT IN (SELECT id FROM kept WHERE total_rank <= $4)
+RETURNING m.memory_type, m.content
+"""
+
+# 以一條語句同步一段對話的記憶：
+# 刪除資料庫中有、新記憶中沒有的項目，插入新記憶中有、資料庫中沒有的項目（已存在的由唯一索引跳過）。
+# 參數: $1 用戶ID, $2 角色ID, $3 記憶類型陣列, $4 內容陣列（與 $3 一一對應）, $5 要同步的記憶類型,
+#       $6 MinHash 簽名陣列（與 $3 一一對應，見 memory_dedup.py）, $7 新增項目的來源（explicit / inferred）
+MEMORY_SYNC = """
+WITH incoming AS (
+    SELECT memory_type, content, md5(content) AS content_hash, minhash, ord
+    FROM unnest($3::text[], $4::text[], $6::bytea[]) WITH ORDINALITY AS t(memory_type, content, minhash, ord)
+), removed AS (
+    DELETE FROM memories m
+    WHERE m.user_id = $1 AND m.character_id = $2 AND m.memory_type = ANY($5::text[])
+      AND NOT EXISTS (
+          SELECT 1 FROM incoming i
+          WHERE i.memory_type = m.memory_type AND i.content_hash = m.content_hash
+      )
+    RETURNING 1
+), added AS (
+    INSERT INTO memories (user_id, character_id, memory_type, content, source, minhash)
+    SELECT $1, $2, memory_type, content, $7, minhash FROM incoming ORDER BY ord
+    ON CONFLICT (user_id, character_id, memory_type, content_hash) DO NOTHING
+    RETURNING 1
+)
+SELECT (SELECT count(*) FROM added) AS added, (SELECT count(*) FROM removed) AS removed
+"""
 
 class MemoryManager:
     """
@@ -21,40 +106,24 @@ class MemoryManager:
     
     def __init__(self):
         """初始化記憶管理器"""
-        # 存儲不同用戶和角色的記憶
-        self._memories = {}  # 用戶ID -> 角色ID -> 記憶數據
-        self._memories_cache = {}  # 用於緩存記憶的字典
-        self._connected = False
-        self.conn = None
-    
-    async def ensure_connected(self):
-        """確保與數據庫的連接已建立"""
-        if self._connected and self.conn:
-            # 檢查連接是否仍然有效
-            try:
-                with self.conn.cursor() as cur:
-                    cur.execute("SELECT 1")
-                return  # 連接有效，直接返回
-            except Exception:
-                # 連接已斷開，需要重新連接
-                self._connected = False
-                try:
-                    self.conn.close()
-                except:
-                    pass  # 忽略關閉錯誤
-                self.conn = None
-        
-        # 嘗試連接數據庫
-        try:
-            self.conn = psycopg2.connect(DB_URL)
-            self.conn.autocommit = True
-            self._connected = True
-            print("成功連接到記憶數據庫")
-        except Exception as e:
-            self._connected = False
-            self.conn = None
-            print(f"連接記憶數據庫時出錯: {str(e)}")
-            raise
+        # 記憶緩存（有界、帶版本號，其他 worker 寫入時透過資料庫通知失效，見 memory_cache.py）
+        self.cache = memory_cache
+        # 記憶提取用的關鍵詞匹配器（詞庫見 memory_lexicon.json）
+        self.matcher = keyword_matcher
+        
+        # 記憶文本超過此 token 數時，改為按與當前對話的相關度挑選記憶
+        self.prompt_token_budget = int(os.getenv("MEMORY_PROMPT_TOKEN_BUDGET", "600"))
+        self.retrieval_top_k = int(os.getenv("MEMORY_RETRIEVAL_TOP_K", "30"))
+        self.retrieval_context_turns = int(os.getenv("MEMORY_RETRIEVAL_CONTEXT_TURNS", "4"))
+        # 這些類型的記憶（例如用戶的名字）優先放入，最多使用一半的預算
+        self.pinned_types = [t.strip() for t in os.getenv("MEMORY_PINNED_TYPES", "personal_info").split(",") if t.strip()]
+        self.estimator = TokenEstimator("default")
+        
+        # 記憶容量：超過上限時淘汰重要性最低的項目（見 IMPORTANCE_SCORE 和 memory_compaction.py）
+        self.max_entries = int(os.getenv("MAX_MEMORY_ENTRIES", "100"))
+        self.max_entries_per_type = int(os.getenv("MAX_MEMORY_ENTRIES_PER_TYPE", "50"))
+        self.half_life_seconds = float(os.getenv("MEMORY_RETENTION_DAYS", "30")) * 86400
+        self.min_importance = float(os.getenv("MEMORY_MIN_IMPORTANCE", "0.25"))
     
     async def get_memory(self, user_id: str, character_id: str) -> Dict[str, List[str]]:
         """
@@ -67,10 +136,14 @@ class MemoryManager:
         返回:
             包含個人信息、偏好和重要事件的記憶字典
         """
+        return (await self._get_entry(user_id, character_id)).memory
+    
+    async def _get_entry(self, user_id: str, character_id: str) -> CacheEntry:
+        """獲取記憶的緩存條目，不在緩存中時從資料庫讀取（結果不能緩存時返回臨時條目）"""
         # 如果有緩存，直接返回
-        cache_key = f"{user_id}_{character_id}"
-        if cache_key in self._memories_cache:
-            return self._memories_cache[cache_key]
+        entry = self.cache.get(user_id, character_id)
+        if entry is not None:
+            return entry
         
         # 初始化空記憶結構
         memory = {
@@ -79,115 +152,308 @@ class MemoryManager:
             "important_events": []
         }
         
-        # 嘗試確保資料庫連接
-        try:
-            await self.ensure_connected()
-        except Exception as e:
-            print(f"確保資料庫連接時出錯: {str(e)}")
-            # 資料庫連接失敗，返回空記憶
-            self._memories_cache[cache_key] = memory
-            return memory
-        
-        # 如果沒有數據庫連接，返回空記憶
-        if not self._connected or not self.conn:
-            print("無法連接到資料庫，返回空記憶")
-            self._memories_cache[cache_key] = memory
-            return memory
-        
-        # 從資料庫獲取記憶
+        # 如果沒有數據庫連接池，返回空記憶
+        if not db_pool.available:
+            return self.cache.set(user_id, character_id, memory)
+        
+        # 從資料庫獲取記憶（讀取期間被其他寫入失效時，結果不會寫入緩存）
+        token = self.cache.begin_load(user_id, character_id)
         try:  
-            with self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            async with db_pool.acquire() as conn:
                 print(f"查詢用戶 {user_id} 與角色 {character_id} 的記憶")
-                cur.execute("""
-                    SELECT memory_type, content
-                    FROM memories
-                    WHERE user_id = %s AND character_id = %s
-                """, (user_id, character_id))
-                
-                for row in cur.fetchall():
-                    if row['memory_type'] in memory:
-                        memory[row['memory_type']].append(row['content'])
-                
-                print(f"從資料庫找到 {sum(len(items) for items in memory.values())} 條記憶項目")
+                rows = await conn.fetch(MEMORY_SELECT, user_id, character_id)
+            
+            # 近似重複索引使用資料庫中保存的簽名（尚未回填的舊記憶在此計算）
+            near_duplicates = NearDuplicateIndex()
+            for row in rows:
+                if row['memory_type'] in memory:
+                    memory[row['memory_type']].append(row['content'])
+                    signature = row['minhash'] if row['minhash'] is not None else minhash(row['content'])
+                    near_duplicates.add(row['memory_type'], row['content'], signature)
+            
+            print(f"從資料庫找到 {sum(len(items) for items in memory.values())} 條記憶項目")
             
             # 緩存記憶
-            self._memories_cache[cache_key] = memory
-            return memory
+            entry = self.cache.finish_load(user_id, character_id, token, memory)
+            entry = entry or CacheEntry(memory, 0, 0, 0, False)
+            self._attach_index(user_id, character_id, entry, "near_duplicates", near_duplicates)
+            return entry
         
         except Exception as e:
             print(f"從數據庫獲取記憶時出錯: {str(e)}")
             import traceback
             print(traceback.format_exc())
             
-            # 發生錯誤，返回空記憶
-            self._memories_cache[cache_key] = memory
-            return memory
+            # 發生錯誤，返回空記憶（只短暫緩存，資料庫恢復後重新讀取）
+            entry = self.cache.finish_load(user_id, character_id, token, memory, negative=True)
+            return entry or CacheEntry(memory, 0, 0, 0, True)
     
-    async def update_memory(self, user_id: str, character_id: str, memory: Dict[str, List[str]]) -> None:
+    async def update_memory(self, user_id: str, character_id: str, memory: Dict[str, List[str]],
+                            source: str = "explicit") -> None:
         """
         更新特定用戶和角色的記憶
         
+        同類型中近似重複的項目只保留先出現的一條；
+        寫入後超過容量上限時，淘汰重要性最低的記憶（見 prune_memory）。
+        
         參數:
             user_id: 用戶ID
             character_id: 角色ID
             memory: 新的記憶數據
+            source: 新增項目的來源，explicit（用戶或 API 明確設定）或 inferred（從對話推斷）
         """
-        # 更新內存緩存
-        cache_key = f"{user_id}_{character_id}"
-        self._memories_cache[cache_key] = memory
+        previous = self.cache.get(user_id, character_id)
+        memory, near_duplicates = self._merge_near_duplicates(
+            memory, previous.near_duplicates if previous is not None else None
+        )
+        
+        # 沒有資料庫時沒有評分欄位，超過上限時只保留最新的記憶
+        if not db_pool.available and self._over_capacity(memory):
+            memory = self._trim_by_recency(memory)
+            near_duplicates = None
         
-        # 如果沒有數據庫連接，只更新緩存
-        if not self._connected or not self.conn:
+        # 更新內存緩存（已建立的檢索索引只處理新增和移除的項目，沿用到新條目）
+        entry = self.cache.set(user_id, character_id, memory)
+        if previous is not None and previous.retrieval is not None:
+            previous.retrieval.sync(memory)
+            self._attach_index(user_id, character_id, entry, "retrieval", previous.retrieval)
+        if near_duplicates is not None:
+            self._attach_index(user_id, character_id, entry, "near_duplicates", near_duplicates)
+        
+        # 如果沒有數據庫連接池，只更新緩存
+        if not db_pool.available:
             print("警告：沒有數據庫連接，記憶只保存在內存中")
             return
         
+        # 展開成平行的陣列參數，整個同步只需一次往返
+        memory_types = []
+        contents = []
+        signatures = []
+        for memory_type, items in memory.items():
+            memory_types.extend([memory_type] * len(items))
+            contents.extend(items)
+            signatures.extend(near_duplicates.signature_of(memory_type, item) or b"" for item in items)
+        
         try:
-            await self.ensure_connected()
+            async with db_pool.acquire() as conn:
+                row = await conn.fetchrow(MEMORY_SYNC, user_id, character_id, memory_types, contents,
+                                          list(memory), signatures, source)
+                pruned = await self.prune_memory(user_id, character_id, conn) if self._over_capacity(memory) else 0
             
-            # 獲取當前數據庫中的記憶
-            current_db_memories = {}
-            
-            with self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                cur.execute("""
-                    SELECT id, memory_type, content
-                    FROM memories
-                    WHERE user_id = %s AND character_id = %s
-                """, (user_id, character_id))
-                
-                for row in cur.fetchall():
-                    if row['memory_type'] not in current_db_memories:
-                        current_db_memories[row['memory_type']] = {}
-                    current_db_memories[row['memory_type']][row['content']] = row['id']
-            
-            # 處理每種記憶類型
-            with self.conn.cursor() as cur:
-                for memory_type, items in memory.items():
-                    existing_items = current_db_memories.get(memory_type, {})
-                    
-                    # 添加新項目
-                    for item in items:
-                        if item not in existing_items:
-                            cur.execute("""
-                                INSERT INTO memories (user_id, character_id, memory_type, content)
-                                VALUES (%s, %s, %s, %s)
-                            """, (user_id, character_id, memory_type, item))
-                    
-                    # 刪除移除的項目
-                    db_items = set(existing_items.keys())
-                    current_items = set(items)
-                    items_to_delete = db_items - current_items
-                    
-                    for item in items_to_delete:
-                        item_id = existing_items[item]
-                        cur.execute("DELETE FROM memories WHERE id = %s", (item_id,))
-            
-            print(f"已更新用戶 {user_id} 與角色 {character_id} 的記憶到數據庫")
+            print(f"已更新用戶 {user_id} 與角色 {character_id} 的記憶到數據庫（新增 {row['added']} 條，刪除 {row['removed']} 條，淘汰 {pruned} 條）")
             
         except Exception as e:
             print(f"更新記憶到數據庫時出錯: {str(e)}")
             import traceback
             print(traceback.format_exc())
     
+    async def add_memories(self, user_id: str, character_id: str, new_memory: Dict[str, List[str]],
+                           source: str = "explicit") -> Optional[int]:
+        """
+        把新記憶合併到現有記憶中（跳過已存在的項目）
+        
+        以集合去重並只寫入新增的項目，耗時與新項目數成正比，與現有記憶數量無關。
+        已存在或與同類型記憶近似重複的項目不會加入，而是增加該記憶在資料庫中的提及次數，
+        作為重要性評分的依據；新增後超過容量上限時，淘汰重要性最低的記憶。
+        
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            new_memory: 記憶類型 -> 新項目列表
+            source: 記憶來源，explicit（用戶或 API 明確新增）或 inferred（從對話推斷）
+            
+        返回:
+            實際新增的項目數；寫入資料庫失敗時為 None
+        """
+        entry = await self._get_entry(user_id, character_id)
+        memory = entry.memory
+        index = entry.index
+        if index is None:
+            index = {memory_type: set(items) for memory_type, items in memory.items()}
+        
+        near_duplicates = self._near_duplicates(user_id, character_id, entry)
+        
+        memory_types = []
+        contents = []
+        signatures = []
+        # 再次提到的已存在項目（同一批中的重複項目只計一次）
+        mentioned_types = []
+        mentioned = []
+        batch = set()
+        for memory_type, items in new_memory.items():
+            seen = index.setdefault(memory_type, set())
+            existing = memory.setdefault(memory_type, [])
+            for item in items:
+                if (memory_type, item) in batch:
+                    continue
+                batch.add((memory_type, item))
+                if item not in seen:
+                    signature = minhash(item)
+                    duplicate = near_duplicates.find(memory_type, item, signature)
+                    if duplicate is None:
+                        seen.add(item)
+                        existing.append(item)
+                        near_duplicates.add(memory_type, item, signature)
+                        memory_types.append(memory_type)
+                        contents.append(item)
+                        signatures.append(signature or b"")
+                        continue
+                    # 與現有記憶近似重複：合併為再次提到該記憶
+                    if (memory_type, duplicate) in batch:
+                        continue
+                    batch.add((memory_type, duplicate))
+                    item = duplicate
+                mentioned_types.append(memory_type)
+                mentioned.append(item)
+        if not contents and not mentioned:
+            return 0
+        
+        if contents and entry.negative:
+            # 資料庫讀取失敗時的空記憶並不完整，只寫入新項目，下次重新讀取完整記憶
+            self.cache.invalidate(user_id, character_id)
+        elif contents:
+            # 以新的版本號寫入緩存，去重用的集合和索引沿用到新條目
+            retrieval = entry.retrieval
+            trimmed = not db_pool.available and self._over_capacity(memory)
+            if trimmed:
+                # 沒有資料庫時沒有評分欄位，超過上限時只保留最新的記憶（近似重複索引下次使用時重建）
+                memory = self._trim_by_recency(memory)
+                index = {memory_type: set(items) for memory_type, items in memory.items()}
+            entry = self.cache.set(user_id, character_id, memory)
+            entry.index = index
+            if not trimmed:
+                self._attach_index(user_id, character_id, entry, "near_duplicates", near_duplicates)
+            if retrieval is not None:
+                if trimmed:
+                    retrieval.sync(memory)
+                else:
+                    for memory_type, content in zip(memory_types, contents):
+                        retrieval.add(memory_type, content)
+                self._attach_index(user_id, character_id, entry, "retrieval", retrieval)
+        
+        if not db_pool.available:
+            return len(contents)
+        
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute(MEMORY_ADD, user_id, character_id, memory_types + mentioned_types,
+                                   contents + mentioned, source, signatures + [None] * len(mentioned))
+                if contents and self._over_capacity(memory):
+                    await self.prune_memory(user_id, character_id, conn)
+        except Exception as e:
+            print(f"新增記憶到數據庫時出錯: {str(e)}")
+            # 緩存中的新項目沒有寫入資料庫，下次重新讀取
+            self.cache.invalidate(user_id, character_id)
+            return None
+        return len(contents)
+    
+    async def prune_memory(self, user_id: str, character_id: str, conn) -> int:
+        """
+        淘汰一段對話中重要性最低的記憶，並從本程序的緩存中移除
+        
+        本程序連接池的寫入不會觸發本程序的緩存失效通知，因此直接更新緩存；
+        其他 worker 透過資料庫通知移除各自的緩存。
+        
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            conn: asyncpg 連接
+            
+        返回:
+            淘汰的項目數
+        """
+        rows = await conn.fetch(
+            MEMORY_PRUNE, user_id, character_id, self.max_entries_per_type, self.max_entries,
+            self.half_life_seconds, self.min_importance
+        )
+        if rows:
+            self._remove_from_cache(user_id, character_id, [(row["memory_type"], row["content"]) for row in rows])
+        return len(rows)
+    
+    def _remove_from_cache(self, user_id: str, character_id: str, removed: List[tuple]) -> None:
+        """以新的版本號寫入移除指定項目後的記憶（沿用去重集合和索引）"""
+        entry = self.cache.get(user_id, character_id)
+        if entry is None or entry.negative:
+            return
+        removed_set = set(removed)
+        memory = {
+            memory_type: [item for item in items if (memory_type, item) not in removed_set]
+            for memory_type, items in entry.memory.items()
+        }
+        new_entry = self.cache.set(user_id, character_id, memory)
+        if entry.index is not None:
+            for memory_type, item in removed_set:
+                entry.index.get(memory_type, set()).discard(item)
+            new_entry.index = entry.index
+        if entry.retrieval is not None:
+            for memory_type, item in removed_set:
+                entry.retrieval.remove(memory_type, item)
+            self._attach_index(user_id, character_id, new_entry, "retrieval", entry.retrieval)
+        if entry.near_duplicates is not None:
+            for memory_type, item in removed_set:
+                entry.near_duplicates.remove(memory_type, item)
+            self._attach_index(user_id, character_id, new_entry, "near_duplicates", entry.near_duplicates)
+    
+    def _merge_near_duplicates(self, memory: Dict[str, List[str]],
+                               previous: Optional[NearDuplicateIndex]) -> tuple:
+        """
+        合併記憶中同類型、彼此近似重複的項目
+        
+        原本索引中的項目寫入時已經去重，直接沿用；索引就地移除不再存在的項目，
+        只有新項目需要計算簽名並與其他項目比對，耗時與變動的項目數成正比。新項目之間按出現順序保留先出現的一條。
+        
+        參數:
+            memory: 記憶
+            previous: 原本的近似重複索引（可選，會被就地更新）
+            
+        返回:
+            (合併後的記憶, 對應的近似重複索引)
+        """
+        near_duplicates = previous if previous is not None else NearDuplicateIndex()
+        wanted = {(memory_type, item) for memory_type, items in memory.items() for item in items}
+        for key in near_duplicates.keys():
+            if key not in wanted:
+                near_duplicates.remove(*key)
+        kept = set()
+        for memory_type, items in memory.items():
+            for item in items:
+                key = (memory_type, item)
+                if key in near_duplicates:
+                    kept.add(key)
+                elif key not in kept:
+                    signature = minhash(item)
+                    if near_duplicates.find(memory_type, item, signature) is None:
+                        kept.add(key)
+                        near_duplicates.add(memory_type, item, signature)
+        
+        # 保持原本的順序，完全相同的項目只保留一條
+        merged = {}
+        for memory_type, items in memory.items():
+            merged[memory_type] = []
+            for item in items:
+                if (memory_type, item) in kept:
+                    kept.discard((memory_type, item))
+                    merged[memory_type].append(item)
+        return merged, near_duplicates
+    
+    def _over_capacity(self, memory: Dict[str, List[str]]) -> bool:
+        """記憶是否超過每段對話或每個類型的數量上限"""
+        return (sum(len(items) for items in memory.values()) > self.max_entries
+                or any(len(items) > self.max_entries_per_type for items in memory.values()))
+    
+    def _trim_by_recency(self, memory: Dict[str, List[str]]) -> Dict[str, List[str]]:
+        """只保留每個類型最新的記憶，整段對話仍超過上限時從項目最多的類型刪除最舊的項目"""
+        trimmed = {
+            memory_type: items[-self.max_entries_per_type:] if self.max_entries_per_type > 0 else []
+            for memory_type, items in memory.items()
+        }
+        excess = sum(len(items) for items in trimmed.values()) - self.max_entries
+        while excess > 0:
+            longest = max(trimmed, key=lambda memory_type: len(trimmed[memory_type]))
+            trimmed[longest] = trimmed[longest][1:]
+            excess -= 1
+        return trimmed
+    
     async def add_personal_info(self, user_id: str, character_id: str, info: str) -> None:
         """
         添加用戶個人信息到記憶
@@ -197,10 +463,7 @@ class MemoryManager:
             character_id: 角色ID
             info: 要添加的個人信息
         """
-        memory = await self.get_memory(user_id, character_id)
-        if info not in memory["personal_info"]:
-            memory["personal_info"].append(info)
-            await self.update_memory(user_id, character_id, memory)
+        await self.add_memories(user_id, character_id, {"personal_info": [info]})
     
     async def add_preference(self, user_id: str, character_id: str, preference: str) -> None:
         """
@@ -211,10 +474,7 @@ class MemoryManager:
             character_id: 角色ID
             preference: 要添加的偏好
         """
-        memory = await self.get_memory(user_id, character_id)
-        if preference not in memory["preferences"]:
-            memory["preferences"].append(preference)
-            await self.update_memory(user_id, character_id, memory)
+        await self.add_memories(user_id, character_id, {"preferences": [preference]})
     
     async def add_important_event(self, user_id: str, character_id: str, event: str) -> None:
         """
@@ -225,24 +485,93 @@ class MemoryManager:
             character_id: 角色ID
             event: 要添加的重要事件
         """
-        memory = await self.get_memory(user_id, character_id)
-        if event not in memory["important_events"]:
-            memory["important_events"].append(event)
-            await self.update_memory(user_id, character_id, memory)
+        await self.add_memories(user_id, character_id, {"important_events": [event]})
     
-    async def get_formatted_memory(self, user_id: str, character_id: str) -> str:
+    async def get_formatted_memory(self, user_id: str, character_id: str, user_message: str = "",
+                                   chat_history: List[Dict[str, str]] = None,
+                                   estimator: TokenEstimator = None) -> str:
         """
         獲取格式化的記憶文本，用於添加到提示詞中
         
+        同一版本的記憶只格式化一次：結果保存在緩存條目上，記憶更新或清除時隨條目一起替換。
+        返回的文本附帶預先計算的字元數，處理器估算 token 預算時不需要重新掃描。
+        
+        全部記憶超過 MEMORY_PROMPT_TOKEN_BUDGET 且提供了用戶消息時，只放入固定類型的記憶
+        和與當前消息及最近幾回合最相關的記憶（見 _select_memory）。
+        
         參數:
             user_id: 用戶ID
             character_id: 角色ID
+            user_message: 當前用戶消息（可選，用於挑選相關記憶）
+            chat_history: 對話歷史（可選，最近幾回合作為挑選的上下文）
+            estimator: 供應商的 token 估算器（可選）
             
         返回:
             格式化的記憶文本
         """
-        memory = await self.get_memory(user_id, character_id)
+        entry = await self._get_entry(user_id, character_id)
+        if entry.formatted is None:
+            entry.formatted = self._format_memory(entry.memory)
+        estimator = estimator or self.estimator
+        if not user_message or estimator.estimate(entry.formatted) <= self.prompt_token_budget:
+            return entry.formatted
+        
+        # 對話歷史可能不是列表（任何可以 reversed() 的序列），從結尾取最近幾條
+        recent = islice(reversed(chat_history), self.retrieval_context_turns) if chat_history else ()
+        context = "\n".join(msg["content"] for msg in recent if msg["content"] and msg["content"] != user_message)
+        return self._select_memory(user_id, character_id, entry, user_message, context, estimator)
+    
+    def _select_memory(self, user_id: str, character_id: str, entry: CacheEntry,
+                       user_message: str, context: str, estimator: TokenEstimator) -> str:
+        """
+        在 token 預算內挑選記憶並格式化
         
+        先放入固定類型的記憶（按建立順序，最多使用一半預算），
+        再按相關度放入其他記憶，放不下的項目跳過；輸出時保持原本的類型和順序。
+        """
+        if entry.retrieval is None:
+            self._attach_index(user_id, character_id, entry, "retrieval", MemoryIndex.build(entry.memory))
+        
+        # 扣除標題和分段標籤的開銷（以每類一條空項目的格式化結果估算）
+        skeleton = self._format_memory({"personal_info": [""], "preferences": [""], "important_events": [""]})
+        budget = self.prompt_token_budget - estimator.estimate(skeleton)
+        used = 0
+        chosen = set()
+        for memory_type in self.pinned_types:
+            for item in entry.memory.get(memory_type, []):
+                cost = estimator.estimate(item) + 1
+                if used + cost > budget // 2:
+                    break
+                used += cost
+                chosen.add((memory_type, item))
+        
+        for key, _ in entry.retrieval.search(user_message, context, self.retrieval_top_k):
+            if key in chosen:
+                continue
+            cost = estimator.estimate(key[1]) + 1
+            if used + cost <= budget:
+                used += cost
+                chosen.add(key)
+        
+        selected = {
+            memory_type: [item for item in items if (memory_type, item) in chosen]
+            for memory_type, items in entry.memory.items()
+        }
+        return self._format_memory(selected)
+    
+    def _attach_index(self, user_id: str, character_id: str, entry: CacheEntry, attribute: str, index: Any) -> None:
+        """把檢索索引或近似重複索引附加到緩存條目，並計入緩存的位元組預算"""
+        setattr(entry, attribute, index)
+        self.cache.add_size(user_id, character_id, entry, index.nbytes)
+    
+    def _near_duplicates(self, user_id: str, character_id: str, entry: CacheEntry) -> NearDuplicateIndex:
+        """獲取條目的近似重複索引（沒有時以記憶內容建立）"""
+        if entry.near_duplicates is None:
+            self._attach_index(user_id, character_id, entry, "near_duplicates", NearDuplicateIndex.build(entry.memory))
+        return entry.near_duplicates
+    
+    def _format_memory(self, memory: Dict[str, List[str]]) -> str:
+        """將記憶字典格式化為提示詞段落"""
         # 如果沒有任何記憶，返回空字符串
         if not any([memory["personal_info"], memory["preferences"], memory["important_events"]]):
             return ""
@@ -258,7 +587,7 @@ class MemoryManager:
         if memory["important_events"]:
             memory_text += "重要對話或事件:\n" + "\n".join([f"- {event}" for event in memory["important_events"]]) + "\n\n"
         
-        return memory_text
+        return CountedText(memory_text)
     
     async def clear_memory(self, user_id: str, character_id: str) -> None:
         """
@@ -269,22 +598,15 @@ class MemoryManager:
             character_id: 角色ID
         """
         # 清除內存緩存
-        cache_key = f"{user_id}_{character_id}"
-        if cache_key in self._memories_cache:
-            del self._memories_cache[cache_key]
+        self.cache.invalidate(user_id, character_id)
         
-        # 如果沒有數據庫連接，只清除緩存
-        if not self._connected or not self.conn:
+        # 如果沒有數據庫連接池，只清除緩存
+        if not db_pool.available:
             return
         
         try:
-            await self.ensure_connected()
-            
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    DELETE FROM memories
-                    WHERE user_id = %s AND character_id = %s
-                """, (user_id, character_id))
+            async with db_pool.acquire() as conn:
+                await conn.execute(MEMORY_CLEAR, user_id, character_id)
             
             print(f"已清除用戶 {user_id} 與角色 {character_id} 的所有記憶")
         except Exception as e:
@@ -308,7 +630,8 @@ class MemoryManager:
         # 在此只提供基本框架，實際實現需要更多的工作
         # 這應該在一個單獨的非同步任務中執行，以避免阻塞主對話流程
         
-        # 示例實現：使用簡單啟發式方法根據消息中的關鍵詞提取信息
+        # 目前的實現：以詞庫中的關鍵詞（所有類別、所有語言編譯成一個自動機）掃描每條用戶消息，
+        # 只記錄從關鍵詞開始到子句結尾的片段，而不是整條消息
         # 實際實現應該使用LLM或專門的分析工具
         
         memory = {
@@ -317,31 +640,17 @@ class MemoryManager:
             "important_events": []
         }
         
-        # 示例：簡單的關鍵詞檢測（實際實現應該使用NLP或LLM）
         for msg in recent_messages:
             if msg["role"] == "user":
-                content = msg["content"].lower()
-                
-                # 檢測個人信息
-                if "我是" in content or "我叫" in content or "我的名字" in content:
-                    memory["personal_info"].append(f"用戶可能透露了名字：{msg['content']}")
-                
-                # 檢測偏好
-                if "我喜歡" in content or "我愛" in content:
-                    memory["preferences"].append(f"用戶表達了喜好：{msg['content']}")
-                
-                # 檢測重要事件
-                if "昨天" in content or "今天" in content or "明天" in content:
-                    memory["important_events"].append(f"用戶提到的事件：{msg['content']}")
+                for category, span in self.matcher.extract(msg["content"]):
+                    # 詞庫中不屬於記憶類型的類別不寫入記憶
+                    if category not in memory:
+                        continue
+                    item = self.matcher.format(category, span)
+                    if item not in memory[category]:
+                        memory[category].append(item)
         
         return memory
-    
-    async def disconnect(self):
-        """斷開與數據庫的連接"""
-        if self._connected and self.conn:
-            self.conn.close()
-            self._connected = False
-            print("已斷開與記憶數據庫的連接")
 
 # 單例模式，確保整個應用只有一個記憶管理器實例
 memory_manager = MemoryManager() 
\ No newline at end of file
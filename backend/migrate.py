@@ -0,0 +1,187 @@
+import os
+import re
+import sys
+import asyncio
+from typing import List, Tuple
+from dotenv import load_dotenv
+from db_pool import db_pool
+
+# 載入環境變數
+load_dotenv()
+
+# 遷移檔案目錄：檔名為「三位數版本號_說明.sql」，按版本號依序套用
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# 已套用的版本記錄在此表中
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+# 多個 worker 同時啟動時，只讓一個套用遷移
+MIGRATION_LOCK_ID = 726354901
+
+def load_migrations() -> List[Tuple[int, str, str]]:
+    """
+    讀取遷移檔案
+
+    返回:
+        按版本號排序的 (版本號, 名稱, SQL) 列表
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = re.match(r"^(\d+)_(.+)\.sql$", filename)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), encoding="utf-8") as f:
+            migrations.append((int(match.group(1)), match.group(2), f.read()))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"遷移版本號重複: {versions}")
+    return migrations
+
+async def apply_migrations(conn) -> List[str]:
+    """
+    套用尚未套用的遷移，每個版本在獨立的交易中執行
+
+    參數:
+        conn: asyncpg 連接
+
+    返回:
+        本次套用的遷移名稱
+    """
+    applied_now = []
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+    try:
+        await conn.execute(MIGRATIONS_TABLE)
+        applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, name, sql in load_migrations():
+            if version in applied:
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name
+                )
+            applied_now.append(f"{version:03d}_{name}")
+            print(f"已套用資料庫遷移 {version:03d}_{name}")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+    return applied_now
+
+async def get_status(conn) -> List[Tuple[int, str, bool]]:
+    """
+    獲取每個遷移的套用狀態
+
+    參數:
+        conn: asyncpg 連接
+
+    返回:
+        (版本號, 名稱, 是否已套用) 列表
+    """
+    await conn.execute(MIGRATIONS_TABLE)
+    applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+    return [(version, name, version in applied) for version, name, _ in load_migrations()]
+
+async def run_migrations() -> None:
+    """在應用啟動時套用遷移（使用記憶資料庫連接池，DB_MIGRATE_ON_STARTUP=false 時跳過）"""
+    if not db_pool.available or os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() != "true":
+        return
+    try:
+        async with db_pool.acquire() as conn:
+            await apply_migrations(conn)
+    except Exception as e:
+        print(f"套用資料庫遷移時出錯: {str(e)}")
+
+async def partition_memories(conn, partitions: int) -> None:
+    """
+    把記憶表改為按 user_id 雜湊分區（可選，適用於記憶數量非常大的部署）
+
+    在一個交易中建立分區表、複製資料並取代原表，期間會鎖住記憶表，應在維護時段執行。
+    分區表的主鍵改為 (user_id, id)，唯一索引和查詢不需要修改。
+
+    參數:
+        conn: asyncpg 連接
+        partitions: 分區數量
+    """
+    if partitions < 2:
+        raise ValueError("分區數量至少為 2")
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE memories IN ACCESS EXCLUSIVE MODE")
+        is_partitioned = await conn.fetchval(
+            "SELECT relkind = 'p' FROM pg_class WHERE oid = 'memories'::regclass"
+        )
+        if is_partitioned:
+            print("記憶表已經分區，略過")
+            return
+        sequence = await conn.fetchval("SELECT pg_get_serial_sequence('memories', 'id')")
+
+        await conn.execute("""
+            CREATE TABLE memories_partitioned (LIKE memories INCLUDING DEFAULTS INCLUDING GENERATED)
+            PARTITION BY HASH (user_id)
+        """)
+        for remainder in range(partitions):
+            await conn.execute(
+                f"CREATE TABLE memories_p{remainder} PARTITION OF memories_partitioned "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+            )
+        result = await conn.execute("""
+            INSERT INTO memories_partitioned (id, user_id, character_id, memory_type, content, created_at,
+                                              source, mention_count, last_seen_at, minhash)
+            SELECT id, user_id, character_id, memory_type, content, created_at,
+                   source, mention_count, last_seen_at, minhash
+            FROM memories
+        """)
+
+        # 序列原本屬於舊表，先解除關聯，刪除舊表時才不會一併刪除
+        if sequence:
+            await conn.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        await conn.execute("DROP TABLE memories")
+        await conn.execute("ALTER TABLE memories_partitioned RENAME TO memories")
+        if sequence:
+            await conn.execute(f"ALTER SEQUENCE {sequence} OWNED BY memories.id")
+        # 資料複製完成後再建立索引，比逐行維護索引快
+        await conn.execute("ALTER TABLE memories ADD PRIMARY KEY (user_id, id)")
+        await conn.execute("""
+            CREATE UNIQUE INDEX memories_content_key
+            ON memories (user_id, character_id, memory_type, content_hash)
+        """)
+        # 觸發器隨舊表刪除，重新建立（見 migrations/003_memory_notify.sql 和 004_memory_importance.sql）
+        if await conn.fetchval("SELECT to_regproc('notify_memory_change')") is not None:
+            await conn.execute("""
+                CREATE TRIGGER memories_notify
+                AFTER INSERT OR UPDATE OF memory_type, content OR DELETE ON memories
+                FOR EACH ROW EXECUTE FUNCTION notify_memory_change()
+            """)
+    print(f"已將記憶表改為 {partitions} 個雜湊分區（{result}）")
+
+async def main(args: List[str]) -> None:
+    """命令列入口"""
+    import asyncpg
+
+    if not db_pool.db_url:
+        print("請設定 DATABASE_URL")
+        sys.exit(1)
+    conn = await asyncpg.connect(db_pool.db_url)
+    try:
+        if not args:
+            applied = await apply_migrations(conn)
+            print(f"共套用 {len(applied)} 個遷移" if applied else "資料庫已是最新版本")
+        elif args[0] == "status":
+            for version, name, applied in await get_status(conn):
+                print(f"{version:03d}_{name:<40}{'已套用' if applied else '未套用'}")
+        elif args[0] == "partition" and len(args) == 2:
+            await apply_migrations(conn)
+            await partition_memories(conn, int(args[1]))
+        else:
+            print("用法: python migrate.py [status | partition 分區數量]")
+            sys.exit(1)
+    finally:
+        await conn.close()
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,9 @@
+-- 記憶表（舊部署可能已由其他工具建立，因此使用 IF NOT EXISTS）
+CREATE TABLE IF NOT EXISTS memories (
+    id SERIAL PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    character_id TEXT NOT NULL,
+    memory_type TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,15 @@
+-- 內容雜湊欄位：由資料庫根據內容產生，供去重和集合式同步比對
+ALTER TABLE memories ADD COLUMN IF NOT EXISTS content_hash TEXT GENERATED ALWAYS AS (md5(content)) STORED;
+
+-- 建立唯一索引前刪除重複的記憶（保留最早的一條）
+DELETE FROM memories a
+USING memories b
+WHERE a.user_id = b.user_id AND a.character_id = b.character_id
+  AND a.memory_type = b.memory_type AND a.content_hash = b.content_hash
+  AND a.id > b.id;
+
+-- 同一對話中同類型、同內容的記憶只保存一條。
+-- 前三欄同時作為 (user_id, character_id, memory_type) 的複合索引，
+-- 供每個回合的讀取、同步和清除使用，不需要另外建立一個前綴相同的索引。
+CREATE UNIQUE INDEX IF NOT EXISTS memories_content_key
+ON memories (user_id, character_id, memory_type, content_hash);
@@ -0,0 +1,20 @@
+-- 記憶變更時通知各 worker 移除對應的緩存（見 memory_cache.py）。
+-- 同一交易中內容相同的通知只會送出一次，因此清除或同步整段對話只產生一則通知。
+CREATE OR REPLACE FUNCTION notify_memory_change() RETURNS trigger AS $$
+DECLARE
+    changed RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+    ELSE
+        changed := NEW;
+    END IF;
+    PERFORM pg_notify('memory_invalidate', changed.user_id || chr(31) || changed.character_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS memories_notify ON memories;
+CREATE TRIGGER memories_notify
+AFTER INSERT OR UPDATE OR DELETE ON memories
+FOR EACH ROW EXECUTE FUNCTION notify_memory_change();
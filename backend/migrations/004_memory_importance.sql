@@ -0,0 +1,16 @@
+-- 記憶重要性評分所需的欄位（見 memory_manager.py 的 IMPORTANCE_SCORE）：
+-- source 區分用戶或 API 明確新增的記憶（explicit）與從對話推斷的記憶（inferred），
+-- mention_count 為再次提到同一內容的次數，last_seen_at 為最後一次提到的時間，用於時間衰減。
+-- 既有的記憶來源不明，按推斷的記憶處理。
+ALTER TABLE memories
+    ADD COLUMN IF NOT EXISTS source TEXT NOT NULL DEFAULT 'inferred',
+    ADD COLUMN IF NOT EXISTS mention_count INTEGER NOT NULL DEFAULT 1,
+    ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+UPDATE memories SET last_seen_at = created_at;
+
+-- 只更新提及次數和時間時內容沒有變化，不需要通知其他 worker 移除緩存
+DROP TRIGGER IF EXISTS memories_notify ON memories;
+CREATE TRIGGER memories_notify
+AFTER INSERT OR UPDATE OF memory_type, content OR DELETE ON memories
+FOR EACH ROW EXECUTE FUNCTION notify_memory_change();
@@ -0,0 +1,3 @@
+-- 近似去重用的 MinHash 簽名（見 memory_dedup.py）。NULL 表示尚未計算，
+-- 空值表示正規化後沒有可比對的內容。既有的記憶以 python memory_dedup.py 回填簽名並合併重複項目
+ALTER TABLE memories ADD COLUMN IF NOT EXISTS minhash BYTEA;
@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Tuple
+
+# 本地模擬服務的位址
+MOCK_HOST = os.getenv("MOCK_PROVIDER_HOST", "127.0.0.1")
+MOCK_PORT = int(os.getenv("MOCK_PROVIDER_PORT", "8100"))
+
+# 模擬供應商端緩存的最低前綴 token 數（OpenAI 和 Claude 的實際門檻都是 1024）
+MIN_CACHEABLE_TOKENS = 1024
+
+def count_tokens(text: str) -> int:
+    """粗略計算 token 數（模擬服務只需要前後一致）"""
+    return max(1, len(text) // 2) if text else 0
+
+def prefix_hash(*parts: Any) -> str:
+    """計算前綴內容的摘要"""
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+class MockState:
+    """模擬服務在請求間保留的緩存狀態"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.openai_prefixes = set()  # 已見過的消息前綴摘要
+        self.claude_prefixes = set()  # 已寫入的緩存斷點前綴摘要
+        self.gemini_caches = {}  # 緩存名稱 -> 緩存內容的 token 數
+
+    def openai_cached_tokens(self, messages: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """返回 (輸入 token 數, 命中緩存的前綴 token 數)，並記住這次請求的所有前綴"""
+        total = 0
+        cached = 0
+        with self.lock:
+            for i, message in enumerate(messages):
+                total += count_tokens(message.get("content") or "") + 4
+                key = prefix_hash(messages[:i + 1])
+                if key in self.openai_prefixes and total >= MIN_CACHEABLE_TOKENS:
+                    cached = total
+                self.openai_prefixes.add(key)
+        return total, cached
+
+    def claude_usage(self, payload: Dict[str, Any]) -> Dict[str, int]:
+        """按 cache_control 斷點計算 Claude 的 usage 欄位"""
+        system = payload.get("system") or []
+        if isinstance(system, str):
+            system = [{"type": "text", "text": system}]
+
+        prefix = [payload.get("tools") or []]
+        breakpoint_tokens = 0
+        breakpoint_key = None
+        tokens = sum(count_tokens(json.dumps(tool, ensure_ascii=False)) for tool in prefix[0])
+        for block in system:
+            tokens += count_tokens(block.get("text", ""))
+            prefix.append(block.get("text", ""))
+            if block.get("cache_control"):
+                breakpoint_tokens = tokens
+                breakpoint_key = prefix_hash(prefix)
+        for message in payload.get("messages", []):
+            tokens += count_tokens(message.get("content") if isinstance(message.get("content"), str) else json.dumps(message.get("content"), ensure_ascii=False)) + 4
+
+        usage = {"input_tokens": tokens, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+        if breakpoint_key and breakpoint_tokens >= MIN_CACHEABLE_TOKENS:
+            with self.lock:
+                if breakpoint_key in self.claude_prefixes:
+                    usage["cache_read_input_tokens"] = breakpoint_tokens
+                else:
+                    usage["cache_creation_input_tokens"] = breakpoint_tokens
+                    self.claude_prefixes.add(breakpoint_key)
+            usage["input_tokens"] = tokens - breakpoint_tokens
+        return usage
+
+state = MockState()
+
+def last_user_text(texts: List[str]) -> str:
+    """取出提示詞最後的用戶消息，用於組成模擬回覆"""
+    return (texts[-1] if texts else "")[-40:].replace("\n", " ")
+
+def mock_reply(user_text: str) -> str:
+    """模擬的角色回覆"""
+    return f"*(模擬角色點點頭)*\n我聽到你說：{user_text}"
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    """模擬 Gemini、OpenAI 和 Claude 的生成端點及其緩存 usage 欄位"""
+
+    def log_message(self, format, *args):
+        print(f"[mock] {self.command} {self.path.split('?')[0]}")
+
+    def _send_json(self, data: Dict[str, Any], status: int = 200) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_sse(self, events: List[Dict[str, Any]], done_marker: bool = False) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for event in events:
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        if done_marker:
+            self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?")[0]
+
+        if path.endswith("/chat/completions"):
+            self._openai(payload)
+        elif path.endswith("/v1/messages"):
+            self._claude(payload)
+        elif path.endswith("/cachedContents"):
+            self._gemini_create_cache(payload)
+        elif ":generateContent" in path or ":streamGenerateContent" in path:
+            self._gemini(payload, stream=":streamGenerateContent" in path)
+        else:
+            self._send_json({"error": {"message": f"unknown path {path}"}}, 404)
+
+    def _openai(self, payload: Dict[str, Any]) -> None:
+        messages = payload.get("messages", [])
+        prompt_tokens, cached = state.openai_cached_tokens(messages)
+        reply = mock_reply(last_user_text([m.get("content", "") for m in messages if m.get("role") == "user"]))
+        if payload.get("response_format", {}).get("type") == "json_object":
+            reply = json.dumps({"reply": reply, "affinity_change": 1}, ensure_ascii=False)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": count_tokens(reply),
+            "prompt_tokens_details": {"cached_tokens": cached}
+        }
+
+        if payload.get("stream"):
+            self._send_sse([
+                {"choices": [{"index": 0, "delta": {"content": reply}}]},
+                {"choices": [], "usage": usage}
+            ], done_marker=True)
+            return
+        self._send_json({
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}}],
+            "usage": usage
+        })
+
+    def _claude(self, payload: Dict[str, Any]) -> None:
+        usage = state.claude_usage(payload)
+        texts = [m["content"] for m in payload.get("messages", []) if m.get("role") == "user" and isinstance(m.get("content"), str)]
+        reply = mock_reply(last_user_text(texts))
+
+        if payload.get("stream"):
+            self._send_sse([
+                {"type": "message_start", "message": {"usage": usage}},
+                {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": reply}},
+                {"type": "message_stop"}
+            ])
+            return
+
+        if payload.get("tool_choice", {}).get("type") == "tool":
+            content = [{"type": "tool_use", "name": payload["tool_choice"]["name"],
+                        "input": {"reply": reply, "affinity_change": 1}}]
+        else:
+            content = [{"type": "text", "text": reply}]
+        self._send_json({"content": content, "usage": {**usage, "output_tokens": count_tokens(reply)}})
+
+    def _gemini_create_cache(self, payload: Dict[str, Any]) -> None:
+        text = "".join(part.get("text", "") for part in payload.get("systemInstruction", {}).get("parts", []))
+        name = f"cachedContents/{prefix_hash(text)[:12]}"
+        with state.lock:
+            state.gemini_caches[name] = count_tokens(text)
+        self._send_json({"name": name, "model": payload.get("model"), "expireTime": time.time() + 3600})
+
+    def _gemini(self, payload: Dict[str, Any], stream: bool) -> None:
+        texts = [part.get("text", "") for content in payload.get("contents", []) for part in content.get("parts", [])]
+        prompt_tokens = sum(count_tokens(text) for text in texts)
+        cached = 0
+        if payload.get("cachedContent"):
+            cached = state.gemini_caches.get(payload["cachedContent"])
+            if cached is None:
+                self._send_json({"error": {"message": "cached content not found"}}, 404)
+                return
+            prompt_tokens += cached
+
+        reply = mock_reply(last_user_text(texts))
+        schema = payload.get("generationConfig", {}).get("responseSchema") or {}
+        if schema.get("type") == "ARRAY":
+            reply = "[]"
+        elif schema:
+            reply = json.dumps({"reply": reply, "affinity_change": 1}, ensure_ascii=False)
+
+        usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": count_tokens(reply)}
+        if cached:
+            usage["cachedContentTokenCount"] = cached
+        response = {"candidates": [{"content": {"parts": [{"text": reply}], "role": "model"}}], "usageMetadata": usage}
+        if stream:
+            self._send_sse([response])
+            return
+        self._send_json(response)
+
+def start_server(host: str = MOCK_HOST, port: int = MOCK_PORT) -> ThreadingHTTPServer:
+    """在背景執行緒中啟動模擬服務"""
+    server = ThreadingHTTPServer((host, port), MockProviderHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+async def run_self_test() -> None:
+    """讓三個處理器對模擬服務各發送兩次請求，檢查第二次請求命中緩存"""
+    base = f"http://{MOCK_HOST}:{MOCK_PORT}"
+    os.environ["GEMINI_API_BASE"] = base
+    os.environ["OPENAI_API_BASE"] = f"{base}/v1"
+    os.environ["CLAUDE_API_BASE"] = base
+    os.environ["GEMINI_CONTEXT_CACHE_MIN_TOKENS"] = "0"
+
+    # 必須在設定環境變數之後才匯入處理器
+    from model_factory import ModelFactory
+    from http_client import http_client_pool
+
+    character = {
+        "id": "mock_character",
+        "name": "模擬角色",
+        "personality": "溫柔",
+        "description": "用於測試供應商緩存的角色。" * 200
+    }
+    history = [{"role": "user", "content": "你好"}]
+
+    for model_type in ("gemini", "openai", "claude"):
+        handler = ModelFactory.get_model_handler(model_type)
+        for _ in range(2):
+            result = await handler.generate_response("mock-key", "你好", history, character)
+            if not result["success"]:
+                print(f"{model_type} 請求失敗: {result}")
+        async for event in handler.generate_response_stream("mock-key", "你好", history, character):
+            if event["type"] == "error":
+                print(f"{model_type} 串流請求失敗: {event}")
+
+        stats = handler.get_cache_stats()
+        status = "✅" if stats["hits"] >= 2 else "❌"
+        print(f"{status} {model_type}: 請求 {stats['requests']}, 命中 {stats['hits']}, "
+              f"緩存 token {stats['cached_tokens']}/{stats['input_tokens']}")
+
+    await ModelFactory.close()
+    await http_client_pool.close()
+
+if __name__ == "__main__":
+    server = start_server()
+    print(f"模擬供應商服務已啟動: http://{MOCK_HOST}:{MOCK_PORT}")
+
+    if "--self-test" in sys.argv:
+        asyncio.run(run_self_test())
+        server.shutdown()
+    else:
+        print(f"請設定 GEMINI_API_BASE=http://{MOCK_HOST}:{MOCK_PORT} "
+              f"OPENAI_API_BASE=http://{MOCK_HOST}:{MOCK_PORT}/v1 "
+              f"CLAUDE_API_BASE=http://{MOCK_HOST}:{MOCK_PORT} 後啟動後端")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -1,4 +1,6 @@
-from typing import Dict, Any
+import os
+import json
+from typing import Dict, Any, Type
 from model_interface import ModelHandler
 from gemini_handler import GeminiHandler
 from openai_handler import OpenAIHandler
@@ -6,42 +8,166 @@ from claude_handler import ClaudeHandler
 
 class ModelFactory:
     """
-    模型工廠類，用於創建適合的模型處理器
+    模型工廠類，維護模型處理器的註冊表
+    
+    每個處理器只在啟動時建立一次，之後所有請求共用同一個實例，
+    處理器上的限流器、緩存等資源因此可以跨請求保留。
     """
     
-    @staticmethod
-    def get_model_handler(model_type: str) -> ModelHandler:
+    # 可用的處理器類型
+    HANDLER_TYPES: Dict[str, Type[ModelHandler]] = {
+        "gemini": GeminiHandler,
+        "openai": OpenAIHandler,
+        "claude": ClaudeHandler
+    }
+    
+    # 內建模型及其描述
+    BUILTIN_MODELS = {
+        "gemini": "Gemini 1.5 Flash - Google的大型語言模型",
+        "openai": "GPT-3.5 Turbo - OpenAI的對話模型",
+        "claude": "Claude 3 Sonnet - Anthropic的對話模型"
+    }
+    
+    # 找不到指定模型時使用的默認模型
+    DEFAULT_MODEL = "gemini"
+    
+    _handlers: Dict[str, ModelHandler] = {}
+    _descriptions: Dict[str, str] = {}
+    
+    @classmethod
+    def register(cls, name: str, handler: ModelHandler, description: str = "") -> None:
         """
-        根據模型類型返回相應的處理器實例
+        註冊模型處理器
         
         參數:
-            model_type: 模型類型，可選 "gemini", "openai", "claude"
+            name: 模型名稱（請求中的 model_type）
+            handler: 處理器實例
+            description: 模型描述
+        """
+        name = name.lower()
+        cls._handlers[name] = handler
+        cls._descriptions[name] = description or f"{handler.__class__.__name__} ({handler.model})"
+        print(f"已註冊模型處理器: {name} -> {handler.__class__.__name__} ({handler.model})")
+    
+    @classmethod
+    def register_from_config(cls, config: Dict[str, Dict[str, Any]]) -> None:
+        """
+        根據設定註冊額外的模型
+        
+        參數:
+            config: 模型名稱 -> {"handler": 處理器類型, "model": 模型名稱,
+                    "description": 描述, "max_concurrency": 並發上限,
+                    "input_token_budget": 輸入 token 預算}
+        """
+        for name, options in config.items():
+            handler_type = options.get("handler", "").lower()
+            handler_class = cls.HANDLER_TYPES.get(handler_type)
+            if handler_class is None:
+                print(f"忽略模型 {name}: 未知的處理器類型 {handler_type}")
+                continue
             
+            handler = handler_class(
+                model=options.get("model"),
+                max_concurrency=options.get("max_concurrency"),
+                input_token_budget=options.get("input_token_budget")
+            )
+            cls.register(name, handler, options.get("description", ""))
+    
+    @classmethod
+    def _load_config(cls) -> Dict[str, Dict[str, Any]]:
+        """從 MODEL_REGISTRY 環境變數（JSON 字串或 JSON 檔案路徑）讀取額外的模型設定"""
+        raw = os.getenv("MODEL_REGISTRY", "").strip()
+        if not raw:
+            return {}
+        
+        try:
+            if not raw.startswith("{") and os.path.exists(raw):
+                with open(raw, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            return json.loads(raw)
+        except Exception as e:
+            print(f"讀取 MODEL_REGISTRY 設定時出錯: {str(e)}")
+            return {}
+    
+    @classmethod
+    def startup(cls) -> None:
+        """建立內建和設定中的所有模型處理器（應用啟動時呼叫）"""
+        if cls._handlers:
+            return
+        
+        for name, description in cls.BUILTIN_MODELS.items():
+            cls.register(name, cls.HANDLER_TYPES[name](), description)
+        
+        cls.register_from_config(cls._load_config())
+    
+    @classmethod
+    def get_model_handler(cls, model_type: str) -> ModelHandler:
+        """
+        根據模型類型返回已註冊的處理器實例
+        
+        參數:
+            model_type: 模型類型，例如 "gemini", "openai", "claude" 或設定中註冊的名稱
+        
         返回:
             ModelHandler的實例
         """
-        model_type = model_type.lower()
+        if not cls._handlers:
+            # 未經應用生命週期啟動（例如獨立腳本）時延遲建立
+            cls.startup()
         
-        if model_type == "gemini":
-            return GeminiHandler()
-        elif model_type == "openai":
-            return OpenAIHandler()
-        elif model_type == "claude":
-            return ClaudeHandler()
-        else:
+        handler = cls._handlers.get((model_type or "").lower())
+        if handler is None:
             # 默認返回Gemini處理器
-            return GeminiHandler()
+            handler = cls._handlers[cls.DEFAULT_MODEL]
+        return handler
     
-    @staticmethod
-    def get_supported_models() -> Dict[str, str]:
+    @classmethod
+    def get_supported_models(cls) -> Dict[str, str]:
         """
         獲取支持的模型和它們的描述
         
         返回:
             包含模型類型及其描述的字典
         """
-        return {
-            "gemini": "Gemini 1.5 Flash - Google的大型語言模型",
-            "openai": "GPT-3.5 Turbo - OpenAI的對話模型",
-            "claude": "Claude 3 Sonnet - Anthropic的對話模型"
-        } 
\ No newline at end of file
+        if not cls._handlers:
+            cls.startup()
+        return dict(cls._descriptions)
+    
+    @classmethod
+    def get_cache_stats(cls) -> Dict[str, Dict[str, Any]]:
+        """
+        獲取每個已註冊模型的提示詞緩存統計
+        
+        返回:
+            模型名稱 -> 統計字典
+        """
+        if not cls._handlers:
+            cls.startup()
+        return {name: handler.get_cache_stats() for name, handler in cls._handlers.items()}
+    
+    @classmethod
+    def invalidate_character(cls, character_id: str = None) -> int:
+        """
+        使所有處理器中指定角色的已編譯提示詞失效
+        
+        參數:
+            character_id: 角色ID（可選，不提供時清空所有角色）
+        
+        返回:
+            移除的緩存項目總數
+        """
+        # 多個註冊名稱可能指向同一個處理器
+        handlers = {id(handler): handler for handler in cls._handlers.values()}
+        return sum(handler.invalidate_prompt_cache(character_id) for handler in handlers.values())
+    
+    @classmethod
+    async def close(cls) -> None:
+        """關閉所有處理器並清空註冊表（應用關閉時呼叫）"""
+        handlers = list(cls._handlers.values())
+        cls._handlers = {}
+        cls._descriptions = {}
+        for handler in handlers:
+            try:
+                await handler.close()
+            except Exception as e:
+                print(f"關閉模型處理器時出錯: {str(e)}")
@@ -1,14 +1,188 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, AsyncIterator, Optional
+from http_client import http_client_pool
+from prompt_cache import PromptTemplateCache
+from token_budget import TokenEstimator, get_input_token_budget, select_history, MESSAGE_OVERHEAD_TOKENS
 
 class ModelHandler(ABC):
     """
     模型處理器的抽象基類，定義所有模型處理器必須實現的方法
+    
+    處理器實例由 ModelFactory 在啟動時建立一次並在所有請求間共用，
+    因此可以在實例上持有限流器、緩存等長期資源。
     """
     
+    # 供應商名稱，決定 token 估算係數和預算的環境變數
+    provider = ""
+    
+    def __init__(self, model: str, max_concurrency: int = 0, input_token_budget: int = None):
+        """
+        初始化處理器
+        
+        參數:
+            model: 使用的模型名稱
+            max_concurrency: 同時進行的 API 請求上限（0 表示不限制）
+            input_token_budget: 每次請求的輸入 token 預算（可選，默認讀取 <供應商>_INPUT_TOKEN_BUDGET）
+        """
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self._limiter = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        
+        # 輸入 token 預算和估算器，用於決定對話歷史能放入多少條消息
+        self.input_token_budget = get_input_token_budget(self.provider, input_token_budget)
+        self.token_estimator = TokenEstimator(self.provider)
+        
+        # 供應商端提示詞緩存的命中統計（從 API 回應的 usage 欄位取得）
+        self._cache_stats = {
+            "requests": 0,
+            "hits": 0,
+            "misses": 0,
+            "input_tokens": 0,
+            "cached_tokens": 0,
+            "cache_write_tokens": 0
+        }
+        
+        # 已編譯角色提示詞的緩存（每個處理器一份，鍵中因此隱含供應商）
+        self.prompt_cache = PromptTemplateCache()
+    
+    async def _post(self, url: str, headers: Dict[str, str], payload: Dict[str, Any]):
+        """透過共用的 HTTP 連接池發送請求（受處理器的並發上限限制）"""
+        if self._limiter is None:
+            return await http_client_pool.post(url, headers=headers, json=payload)
+        async with self._limiter:
+            return await http_client_pool.post(url, headers=headers, json=payload)
+    
+    @asynccontextmanager
+    async def _stream(self, url: str, headers: Dict[str, str], payload: Dict[str, Any]):
+        """透過共用的 HTTP 連接池發送串流請求（受處理器的並發上限限制）"""
+        if self._limiter is None:
+            async with http_client_pool.stream(url, headers=headers, json=payload) as response:
+                yield response
+        else:
+            async with self._limiter:
+                async with http_client_pool.stream(url, headers=headers, json=payload) as response:
+                    yield response
+    
+    def _get_summary_text(self, user_id: Optional[str], character_id: Optional[str]) -> str:
+        """獲取對話的滾動摘要（較早的對話已被摺疊進摘要並從歷史中移除）"""
+        if not user_id or not character_id:
+            return ""
+        from conversation_summarizer import conversation_summarizer
+        return conversation_summarizer.get_summary(user_id, character_id)
+    
+    def _history_budget(self, *fixed_texts: str) -> int:
+        """
+        計算扣除固定內容（系統提示詞、記憶、當前消息等）後可用於對話歷史的 token 數
+        
+        參數:
+            fixed_texts: 每次請求都必須送出的文本
+            
+        返回:
+            可用於歷史的 token 數（不小於 0）
+        """
+        fixed = sum(self.token_estimator.estimate(text) for text in fixed_texts if text)
+        return max(0, self.input_token_budget - fixed)
+    
+    def _select_history(self, chat_history: List[Dict[str, str]], budget: int, user_message: str,
+                        summary_prompt: str = "", user_id: str = None, character_id: str = None) -> List[Dict[str, str]]:
+        """
+        在歷史預算內挑選對話歷史；對話有摘要時，記錄摘要為這次請求節省的輸入 token
+        
+        參數:
+            chat_history: 對話歷史
+            budget: 可用於歷史的 token 數（已扣除摘要）
+            user_message: 當前用戶消息
+            summary_prompt: 提示詞中的摘要段落（可選）
+            user_id: 用戶ID（可選，沒有時不記錄）
+            character_id: 角色ID（可選）
+            
+        返回:
+            由舊到新排列的歷史消息
+        """
+        recent = select_history(chat_history, budget, self.token_estimator, current_message=user_message)
+        if not summary_prompt or not user_id or not character_id:
+            return recent
+        
+        # 保留的歷史全部放得進預算時，不使用摘要的話，空出的預算（含摘要佔用的部分）才會放入被摺疊的消息
+        summary_tokens = self.token_estimator.estimate(summary_prompt)
+        eligible = sum(1 for msg in chat_history if msg["role"] != "system")
+        if eligible and chat_history[-1]["role"] == "user" and chat_history[-1]["content"] == user_message:
+            eligible -= 1
+        free_tokens = 0
+        if len(recent) >= eligible:
+            used = sum(self.token_estimator.estimate(msg["content"]) + MESSAGE_OVERHEAD_TOKENS for msg in recent)
+            free_tokens = budget + summary_tokens - used
+        
+        from conversation_summarizer import conversation_summarizer
+        saved = conversation_summarizer.record_request(user_id, character_id, free_tokens, summary_tokens,
+                                                       self.token_estimator)
+        if saved:
+            print(f"對話摘要節省約 {saved} 個輸入 token")
+        return recent
+    
+    def _record_usage(self, estimated_tokens: int, usage_tokens: Optional[int]) -> None:
+        """以 API 回傳的實際輸入 token 數校正估算器"""
+        if usage_tokens:
+            self.token_estimator.observe(estimated_tokens, int(usage_tokens))
+    
+    def _record_cache_usage(self, input_tokens: Optional[int], cached_tokens: Optional[int],
+                            cache_write_tokens: Optional[int] = None) -> None:
+        """
+        記錄一次請求的供應商端緩存用量
+        
+        參數:
+            input_tokens: 輸入 token 總數（包含從緩存讀取的部分）
+            cached_tokens: 從緩存讀取的 token 數
+            cache_write_tokens: 寫入緩存的 token 數（僅 Claude 回傳）
+        """
+        if not input_tokens:
+            return
+        stats = self._cache_stats
+        stats["requests"] += 1
+        stats["input_tokens"] += int(input_tokens)
+        if cached_tokens:
+            stats["hits"] += 1
+            stats["cached_tokens"] += int(cached_tokens)
+        else:
+            stats["misses"] += 1
+        if cache_write_tokens:
+            stats["cache_write_tokens"] += int(cache_write_tokens)
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """
+        獲取供應商端提示詞緩存和 token 估算的統計
+        
+        返回:
+            包含請求數、命中/未命中次數、緩存 token 數和估算器校正狀態的字典
+        """
+        stats = dict(self._cache_stats)
+        stats["cached_token_ratio"] = round(stats["cached_tokens"] / stats["input_tokens"], 3) if stats["input_tokens"] else 0.0
+        stats["prompt_templates"] = self.prompt_cache.get_stats()
+        stats["token_estimator"] = self.token_estimator.get_stats()
+        return stats
+    
+    def invalidate_prompt_cache(self, character_id: Optional[str] = None) -> int:
+        """
+        使已編譯的角色提示詞失效（角色目錄變更時呼叫）
+        
+        參數:
+            character_id: 角色ID（可選，不提供時清空所有角色）
+            
+        返回:
+            移除的緩存項目數
+        """
+        return self.prompt_cache.invalidate(character_id)
+    
+    async def close(self) -> None:
+        """釋放處理器持有的資源（應用關閉時由 ModelFactory 呼叫）"""
+        pass
+    
     @abstractmethod
     async def generate_response(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
-                              character: Dict[str, Any], user_id: str = None, character_id: str = None) -> Dict[str, Any]:
+                              character: Dict[str, Any], user_id: str = None, character_id: str = None, 
+                              current_affinity: Optional[int] = None) -> Dict[str, Any]:
         """
         生成對話回應的抽象方法
         
@@ -19,15 +193,59 @@ class ModelHandler(ABC):
             character: 角色設定
             user_id: 用戶ID（可選）
             character_id: 角色ID（可選）
+            current_affinity: 當前好感度（可選，提供時要求模型以結構化輸出一併返回好感度變化）
+            
+        返回:
+            包含成功狀態和回應內容的字典；提供 current_affinity 時另含 "affinity_change"
+            （模型未輸出有效值時為 None）
+        """
+        pass
+    
+    @abstractmethod
+    def generate_response_stream(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
+                                 character: Dict[str, Any], user_id: str = None, 
+                                 character_id: str = None, 
+                                 current_affinity: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        以串流方式生成對話回應的抽象方法（async generator）
+        
+        參數:
+            api_key: API密鑰
+            user_message: 用戶消息
+            chat_history: 對話歷史
+            character: 角色設定
+            user_id: 用戶ID（可選）
+            character_id: 角色ID（可選）
+            current_affinity: 當前好感度（可選，提供時要求模型在結尾附加好感度標記）
+            
+        返回:
+            依序產生的事件字典：
+            {"type": "delta", "text": ...} 已格式化的回覆片段（不含好感度標記）
+            {"type": "done", "reply": ..., "affinity_change": ...} 完整的格式化回覆
+            {"type": "error", "error": ..., "details": ...} 發生錯誤
+        """
+        pass
+    
+    @abstractmethod
+    async def complete(self, api_key: str, prompt: str, model: Optional[str] = None, 
+                       max_output_tokens: int = 512) -> Dict[str, Any]:
+        """
+        以單一提示詞向模型請求純文本回覆（用於摘要等後台工作）
+        
+        參數:
+            api_key: API密鑰
+            prompt: 提示詞
+            model: 使用的模型（可選，默認使用處理器的模型）
+            max_output_tokens: 最大輸出 token 數
             
         返回:
-            包含成功狀態和回應內容的字典
+            {"success": True, "text": 回覆文本} 或包含 "error" 和 "details" 的錯誤字典
         """
         pass
     
     @abstractmethod
     def create_prompt(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                     user_message: str, memory_text: str = "") -> str:
+                     user_message: str, memory_text: str = "", summary_text: str = "") -> str:
         """
         創建提示詞的抽象方法
         
@@ -36,6 +254,7 @@ class ModelHandler(ABC):
             chat_history: 對話歷史
             user_message: 用戶消息
             memory_text: 記憶文本（可選）
+            summary_text: 已從歷史中移除的較早對話的摘要（可選）
             
         返回:
             構建好的提示詞
@@ -44,7 +263,7 @@ class ModelHandler(ABC):
     
     @abstractmethod
     def format_messages(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                       user_message: str, memory_text: str = "") -> List[Dict[str, str]]:
+                       user_message: str, memory_text: str = "", summary_text: str = "") -> List[Dict[str, str]]:
         """
         將對話歷史格式化為模型可接受的消息格式
         
@@ -53,6 +272,7 @@ class ModelHandler(ABC):
             chat_history: 對話歷史
             user_message: 用戶消息
             memory_text: 記憶文本（可選）
+            summary_text: 已從歷史中移除的較早對話的摘要（可選）
             
         返回:
             格式化後的消息列表
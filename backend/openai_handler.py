@@ -1,28 +1,50 @@
-import re
+import os
 import json
-import requests
-from typing import Dict, Any, List
+from typing import Dict, Any, List, AsyncIterator, Optional
 from model_interface import ModelHandler
+from http_client import iter_sse_data
+from response_formatter import format_reply, parse_structured_reply, StreamingReplyFormatter
+from affinity_evaluator import build_inline_affinity_instruction
+
+# 記憶段落的前後文字（與記憶文本分開估算 token，記憶文本的字元數已預先計算）
+MEMORY_PROMPT_HEADER = "與用戶的互動記憶：\n"
+MEMORY_PROMPT_FOOTER = "\n\n請根據這些記憶，以自然的方式在對話中體現你對用戶過去互動的記憶，但不要直接提及你記得用戶說過什麼。"
 
 class OpenAIHandler(ModelHandler):
     """OpenAI模型處理器"""
     
-    def __init__(self):
-        self.api_url = "https://api.openai.com/v1/chat/completions"
-        self.model = "gpt-3.5-turbo"  # 默認模型
+    provider = "openai"
+    
+    def __init__(self, model: str = None, max_concurrency: int = None, input_token_budget: int = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("OPENAI_MAX_CONCURRENCY", "0"))
+        super().__init__(model or "gpt-3.5-turbo", max_concurrency, input_token_budget)  # 默認模型
+        api_base = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1").rstrip("/")
+        self.api_url = f"{api_base}/chat/completions"
+        
+        # 滾動摘要等後台工作使用的低成本模型
+        self.summary_model = os.getenv("OPENAI_SUMMARY_MODEL", "gpt-4o-mini")
     
     async def generate_response(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
-                              character: Dict[str, Any], user_id: str = None, character_id: str = None) -> Dict[str, Any]:
+                              character: Dict[str, Any], user_id: str = None, character_id: str = None, 
+                              current_affinity: Optional[int] = None) -> Dict[str, Any]:
         """
         使用OpenAI API生成回應
         """
         # 獲取記憶文本（如果有）
         memory_text = ""
         if user_id and character_id:
-            memory_text = await self._get_memory_text(user_id, character_id)
+            memory_text = await self._get_memory_text(user_id, character_id, user_message, chat_history)
+        
+        # 內嵌好感度模式：以 JSON 模式要求同時輸出回覆和好感度變化
+        structured = current_affinity is not None
+        instruction = build_inline_affinity_instruction(character, current_affinity, "json") if structured else ""
         
         # 格式化消息
-        messages = self.format_messages(character, chat_history, user_message, memory_text)
+        summary_text = self._get_summary_text(user_id, character_id)
+        messages = self.format_messages(character, chat_history, user_message, memory_text, 
+                                        summary_text, extra_instructions=instruction,
+                                        user_id=user_id, character_id=character_id)
         
         # 構建請求數據
         payload = {
@@ -30,6 +52,8 @@ class OpenAIHandler(ModelHandler):
             "messages": messages,
             "temperature": 0.9
         }
+        if structured:
+            payload["response_format"] = {"type": "json_object"}
         
         headers = {
             "Content-Type": "application/json",
@@ -38,7 +62,7 @@ class OpenAIHandler(ModelHandler):
         
         try:
             # 發送請求到OpenAI API
-            response = requests.post(self.api_url, headers=headers, json=payload)
+            response = await self._post(self.api_url, headers, payload)
             
             if response.status_code != 200:
                 error_details = response.text
@@ -60,15 +84,28 @@ class OpenAIHandler(ModelHandler):
             
             # 解析回應
             result = response.json()
+            
+            # 以實際輸入 token 數校正估算器，並記錄自動提示詞緩存的命中情況
+            usage = result.get("usage") or {}
+            self._record_usage(self.token_estimator.estimate_messages(messages), usage.get("prompt_tokens"))
+            self._record_cache_usage(usage.get("prompt_tokens"),
+                                     (usage.get("prompt_tokens_details") or {}).get("cached_tokens"))
             ai_reply = result["choices"][0]["message"]["content"]
             
+            affinity_change = None
+            if structured:
+                ai_reply, affinity_change = parse_structured_reply(ai_reply)
+            
             # 處理回應
             ai_reply = self.post_process_response(ai_reply, character)
             
-            return {
+            reply_result = {
                 "success": True,
                 "reply": ai_reply
             }
+            if structured:
+                reply_result["affinity_change"] = affinity_change
+            return reply_result
             
         except Exception as e:
             print(f"呼叫 OpenAI API 時發生錯誤: {str(e)}")
@@ -78,12 +115,97 @@ class OpenAIHandler(ModelHandler):
                 "details": str(e)
             }
     
-    def create_prompt(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                     user_message: str, memory_text: str = "") -> str:
+    async def generate_response_stream(self, api_key: str, user_message: str, chat_history: List[Dict[str, str]], 
+                                       character: Dict[str, Any], user_id: str = None, 
+                                       character_id: str = None, 
+                                       current_affinity: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
         """
-        創建OpenAI的系統提示詞
+        使用OpenAI API（stream: true）以串流方式生成回應
+        """
+        try:
+            # 獲取記憶文本（如果有）
+            memory_text = ""
+            if user_id and character_id:
+                memory_text = await self._get_memory_text(user_id, character_id, user_message, chat_history)
+            
+            # 串流時無法使用 JSON 模式，改為要求在結尾附加好感度標記
+            instruction = ""
+            if current_affinity is not None:
+                instruction = build_inline_affinity_instruction(character, current_affinity, "trailer")
+            summary_text = self._get_summary_text(user_id, character_id)
+            messages = self.format_messages(character, chat_history, user_message, memory_text, 
+                                            summary_text, extra_instructions=instruction,
+                                            user_id=user_id, character_id=character_id)
+            
+            payload = {
+                "model": self.model,
+                "messages": messages,
+                "temperature": 0.9,
+                "stream": True,
+                # 最後一個事件附帶 usage，用於校正 token 估算
+                "stream_options": {"include_usage": True}
+            }
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {api_key}"
+            }
+            
+            formatter = StreamingReplyFormatter(character, report_affinity_change=current_affinity is not None)
+            usage = {}
+            
+            async with self._stream(self.api_url, headers, payload) as response:
+                if response.status_code != 200:
+                    error_details = (await response.aread()).decode("utf-8", errors="replace")
+                    print(f"OpenAI 串流請求失敗，狀態碼: {response.status_code}")
+                    error_message = None
+                    try:
+                        error_json = json.loads(error_details)
+                        if "error" in error_json:
+                            error_message = error_json["error"].get("message")
+                    except Exception:
+                        pass
+                    
+                    yield {
+                        "type": "error",
+                        "error": "OpenAI API 請求失敗",
+                        "status_code": response.status_code,
+                        "details": error_message or error_details
+                    }
+                    return
+                
+                async for event in iter_sse_data(response):
+                    if event.get("usage"):
+                        usage = event["usage"]
+                    for choice in event.get("choices", [])[:1]:
+                        text = formatter.feed(choice.get("delta", {}).get("content") or "")
+                        if text:
+                            yield {"type": "delta", "text": text}
+            
+            text = formatter.finish()
+            if text:
+                yield {"type": "delta", "text": text}
+            
+            self._record_usage(self.token_estimator.estimate_messages(messages), usage.get("prompt_tokens"))
+            self._record_cache_usage(usage.get("prompt_tokens"),
+                                     (usage.get("prompt_tokens_details") or {}).get("cached_tokens"))
+            print(f"OpenAI 串流回應完成，回覆長度: {len(formatter.text)}")
+            yield {"type": "done", "reply": formatter.text, "affinity_change": formatter.affinity_change}
+            
+        except Exception as e:
+            print(f"OpenAI 串流請求時發生錯誤: {str(e)}")
+            import traceback
+            print(f"錯誤詳情:\n{traceback.format_exc()}")
+            
+            yield {
+                "type": "error",
+                "error": "呼叫 OpenAI API 時發生錯誤",
+                "details": str(e)
+            }
+    
+    def _build_character_prompt(self, character: Dict[str, Any]) -> str:
+        """
+        編譯系統提示詞中只由角色設定決定的部分（結果由 prompt_cache 緩存）
         """
-        # OpenAI使用消息格式，所以這個方法只返回系統消息文本
         system_prompt = f"""你是 {character['name']}，一個虛擬角色。請完全按照以下設定行事：
 
 名稱: {character['name']}
@@ -157,35 +279,114 @@ class OpenAIHandler(ModelHandler):
    
 6. 請確保每次回覆都包含至少一段旁白描述，用 *()* 符號包圍，對話和文字之間要換行
 7. 請不要重複我的話"""
+        return system_prompt
+    
+    async def complete(self, api_key: str, prompt: str, model: Optional[str] = None, 
+                       max_output_tokens: int = 512) -> Dict[str, Any]:
+        """
+        以單一提示詞向OpenAI請求純文本回覆
+        """
+        payload = {
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.3,
+            "max_tokens": max_output_tokens
+        }
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        try:
+            response = await self._post(self.api_url, headers, payload)
+            if response.status_code != 200:
+                return {
+                    "success": False,
+                    "error": "OpenAI API 請求失敗",
+                    "status_code": response.status_code,
+                    "details": response.text
+                }
+            result = response.json()
+            return {"success": True, "text": result["choices"][0]["message"]["content"] or ""}
+        except Exception as e:
+            return {
+                "success": False,
+                "error": "呼叫 OpenAI API 時發生錯誤",
+                "details": str(e)
+            }
+    
+    def create_prompt(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
+                     user_message: str, memory_text: str = "", summary_text: str = "") -> str:
+        """
+        創建OpenAI的系統提示詞
+        """
+        # OpenAI使用消息格式，所以這個方法只返回系統消息文本
+        # 角色設定部分按角色版本緩存，只有記憶需要每次組裝
+        system_prompt = self.prompt_cache.get_or_build(character, self._build_character_prompt)
         
         # 如果有記憶文本，添加到提示詞中
         if memory_text:
-            memory_part = f"\n\n與用戶的互動記憶：\n{memory_text}\n\n請根據這些記憶，以自然的方式在對話中體現你對用戶過去互動的記憶，但不要直接提及你記得用戶說過什麼。"
-            system_prompt += memory_part
+            system_prompt += f"\n\n{self._memory_prompt(memory_text)}"
+        
+        # 如果有較早對話的摘要，添加到提示詞中
+        if summary_text:
+            system_prompt += f"\n\n{self._summary_prompt(summary_text)}"
         
         return system_prompt
     
+    def _memory_prompt(self, memory_text: str) -> str:
+        """將記憶文本包裝成提示詞段落"""
+        return f"{MEMORY_PROMPT_HEADER}{memory_text}{MEMORY_PROMPT_FOOTER}"
+    
+    def _summary_prompt(self, summary_text: str) -> str:
+        """將滾動摘要包裝成提示詞段落"""
+        return f"之前對話的摘要（更早的對話記錄已省略）：\n{summary_text}"
+    
     def format_messages(self, character: Dict[str, Any], chat_history: List[Dict[str, str]], 
-                       user_message: str, memory_text: str = "") -> List[Dict[str, str]]:
+                       user_message: str, memory_text: str = "", summary_text: str = "", 
+                       extra_instructions: str = "", user_id: str = None,
+                       character_id: str = None) -> List[Dict[str, str]]:
         """
         將對話歷史和當前消息格式化為OpenAI所需的消息格式
+        
+        OpenAI 會自動緩存請求中相同的前綴，因此消息按變動頻率排列：
+        角色設定（同一角色的所有用戶共用）-> 較早對話的摘要（每 K 回合更新一次）
+        -> 對話歷史（同一對話中只會在後面追加）-> 記憶和額外指示（每回合可能不同）
+        -> 最新的用戶消息
+        
+        參數:
+            summary_text: 較早對話的摘要（可選）
+            extra_instructions: 附加在記憶之後的指示（例如內嵌好感度的輸出要求）
+            user_id: 用戶ID（可選，提供時記錄摘要節省的 token）
+            character_id: 角色ID（可選）
         """
-        # 獲取系統提示詞
-        system_prompt = self.create_prompt(character, chat_history, user_message, memory_text)
+        # 角色設定部分按角色版本緩存，作為固定的前綴
+        system_prompt = self.prompt_cache.get_or_build(character, self._build_character_prompt)
+        
+        # 每回合可能變動的內容放在最新消息之前，避免破壞前綴
+        context_prompt = self._memory_prompt(memory_text) if memory_text else ""
+        if extra_instructions:
+            context_prompt = f"{context_prompt}{extra_instructions}".strip()
         
         # 構建消息列表，從系統提示開始
         messages = [{"role": "system", "content": system_prompt}]
         
-        # 加入歷史消息（最多 10 條）
-        recent_messages = chat_history[-10:-1]  # 不包括最新的用戶消息
+        summary_prompt = self._summary_prompt(summary_text) if summary_text else ""
+        if summary_prompt:
+            messages.append({"role": "system", "content": summary_prompt})
+        
+        # 在輸入 token 預算內加入歷史消息（不包括最新的用戶消息，系統消息會被跳過）
+        memory_parts = (MEMORY_PROMPT_HEADER, memory_text, MEMORY_PROMPT_FOOTER) if memory_text else ()
+        budget = self._history_budget(system_prompt, summary_prompt, *memory_parts, extra_instructions, user_message)
+        recent_messages = self._select_history(chat_history, budget, user_message, summary_prompt, user_id, character_id)
         for msg in recent_messages:
-            if msg["role"] == "system":
-                continue  # 跳過系統消息，我們已經添加了自己的系統消息
             messages.append({
                 "role": "user" if msg["role"] == "user" else "assistant",
                 "content": msg["content"]
             })
         
+        if context_prompt:
+            messages.append({"role": "system", "content": context_prompt})
+        
         # 添加最新的用戶消息
         messages.append({"role": "user", "content": user_message})
         
@@ -195,47 +396,18 @@ class OpenAIHandler(ModelHandler):
         """
         處理OpenAI的回應
         """
-        # 清理回覆
-        ai_reply = response.strip()
-        
-        # 確保回覆中有旁白描述
-        if "*(" not in ai_reply and ")*" not in ai_reply and "**" not in ai_reply:
-            # 生成更自然的旁白
-            character_name = character['name']
-            personality = character.get('personality', '').lower()
-            
-            # 根據角色性格生成合適的旁白
-            if '害羞' in personality or '內向' in personality:
-                narration = f"*({character_name}輕聲說道，眼神略顯羞澀)*"
-            elif '活潑' in personality or '開朗' in personality or '熱情' in personality:
-                narration = f"*({character_name}精神抖擻地說，臉上掛著明朗的笑容)*"
-            elif '冷靜' in personality or '沉穩' in personality:
-                narration = f"*({character_name}沉穩地回應，表情平靜而專注)*"
-            elif '傲嬌' in personality or '高傲' in personality:
-                narration = f"*({character_name}微微揚起下巴，假裝不太在意地說)*"
-            elif '溫柔' in personality or '體貼' in personality:
-                narration = f"*({character_name}溫柔地微笑著，眼中流露出關切之情)*"
-            else:
-                narration = f"*({character_name}看著你，眼神中帶著一絲好奇)*"
-            
-            ai_reply = f"{narration}\n{ai_reply}"
-        
-        # 確保旁白和對話之間有換行
-        ai_reply = re.sub(r'\)\*([^\n])', r')*\n\1', ai_reply)
-        
-        # 確保對話和旁白之間有換行
-        ai_reply = re.sub(r'([^\n])\*\(', r'\1\n*(', ai_reply)
-        
-        return ai_reply
+        return format_reply(response, character)
     
-    async def _get_memory_text(self, user_id: str, character_id: str) -> str:
+    async def _get_memory_text(self, user_id: str, character_id: str, user_message: str = "",
+                               chat_history: List[Dict[str, str]] = None) -> str:
         """
-        獲取角色記憶文本
+        獲取角色記憶文本（記憶很多時按與當前消息的相關度挑選）
         """
         try:
             # 從記憶管理器獲取格式化的記憶文本
             from memory_manager import memory_manager
-            return await memory_manager.get_formatted_memory(user_id, character_id)
+            return await memory_manager.get_formatted_memory(user_id, character_id, user_message, chat_history,
+                                                             self.token_estimator)
         except Exception as e:
             print(f"獲取記憶時出錯: {str(e)}")
             return "" 
\ No newline at end of file
@@ -0,0 +1,97 @@
+import json
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional
+
+# 影響角色提示詞內容的欄位，任何一個改變都視為新版本
+PROMPT_FIELDS = (
+    "updatedAt", "name", "gender", "age", "job", "personality", "speakingStyle",
+    "description", "likes", "dislikes", "quote", "basicInfo", "firstChatScene", "firstChatLine"
+)
+
+def character_version(character: Dict[str, Any]) -> Any:
+    """
+    計算角色提示詞的版本
+
+    以相關欄位值組成的元組作為版本：字串的雜湊值會被 Python 緩存，
+    同一份角色資料（包括其淺拷貝）計算版本幾乎沒有成本。
+    """
+    version = tuple(character.get(field) for field in PROMPT_FIELDS)
+    try:
+        hash(version)
+    except TypeError:
+        # extraInfo 可能帶入列表或字典等不可雜湊的值
+        version = json.dumps(version, ensure_ascii=False, sort_keys=True, default=str)
+    return version
+
+class PromptTemplateCache:
+    """
+    已編譯角色提示詞的緩存
+
+    以 (角色ID, 角色名稱, 角色版本) 為鍵保存角色提示詞中的靜態部分，
+    每個處理器持有自己的實例，因此鍵中隱含了供應商。
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        """
+        初始化緩存
+
+        參數:
+            max_entries: 最多緩存的角色版本數（超過時淘汰最久未使用的）
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (角色ID, 角色名稱, 版本) -> 已編譯的模板
+        self._hits = 0
+        self._misses = 0
+
+    def get_or_build(self, character: Dict[str, Any], builder: Callable[[Dict[str, Any]], Any]) -> Any:
+        """
+        獲取角色的已編譯模板，不存在時呼叫 builder 建立
+
+        參數:
+            character: 角色設定
+            builder: 根據角色設定建立模板的函數
+
+        返回:
+            已編譯的模板
+        """
+        key = (character.get("id"), character.get("name"), character_version(character))
+        template = self._entries.get(key)
+        if template is not None:
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return template
+
+        self._misses += 1
+        template = builder(character)
+        self._entries[key] = template
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return template
+
+    def invalidate(self, character_id: Optional[str] = None) -> int:
+        """
+        使緩存失效
+
+        參數:
+            character_id: 角色ID（可選，不提供時清空所有緩存）；沒有ID的角色以名稱緩存，也會比對名稱
+
+        返回:
+            移除的項目數
+        """
+        if character_id is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+
+        keys = [key for key in self._entries if character_id in (key[0], key[1])]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取緩存統計"""
+        return {
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses
+        }
@@ -0,0 +1,279 @@
+import re
+import json
+from typing import Dict, Any, Optional, Tuple
+
+# 判斷回覆是否已包含旁白的標記
+NARRATION_MARKERS = ("*(", ")*", "**")
+
+# 串流時尚未輸出完的原始文本超過此長度後，把已輸出的部分移出，避免每次重新處理整段回覆
+STREAMING_CHECKPOINT_CHARS = 256
+
+# 內嵌好感度模式下，模型在回覆最後附加的機器可讀標記，例如 [[affinity:+2]]
+AFFINITY_TRAILER_PATTERN = re.compile(r'\s*\[\[affinity:\s*([+-]?\d+)\s*\]\]\s*', re.IGNORECASE)
+
+def _prefix_pattern(parts) -> "re.Pattern":
+    """由依序出現的片段建立只匹配完整序列前綴的正規表達式（至少包含第一個片段）"""
+    pattern = ""
+    for part in reversed(parts[1:]):
+        pattern = f"(?:{part}{pattern})?"
+    return re.compile(parts[0] + pattern, re.IGNORECASE)
+
+# 串流時用來判斷結尾是否可能是尚未完整的好感度標記（與 AFFINITY_TRAILER_PATTERN 對應）
+AFFINITY_TRAILER_PREFIX = _prefix_pattern(
+    [r"\[", r"\["] + list("affinity") + [r":\s*", r"[+-]?", r"\d+\s*", r"\]", r"\]\s*"]
+)
+
+# 不可能出現在好感度標記或換行規則中的字元：在它之後切開，兩邊的處理結果互不影響
+TRAILER_CHARS = set("[]:+-0123456789()*affinityAFFINITY")
+
+# 好感度變化的允許範圍
+MAX_AFFINITY_CHANGE = 5
+
+def build_narration(character: Dict[str, Any]) -> str:
+    """
+    根據角色性格生成預設旁白
+
+    參數:
+        character: 角色設定
+
+    返回:
+        用 *()* 包圍的旁白文字
+    """
+    character_name = character['name']
+    personality = character.get('personality', '').lower()
+
+    if '害羞' in personality or '內向' in personality:
+        return f"*({character_name}輕聲說道，眼神略顯羞澀)*"
+    elif '活潑' in personality or '開朗' in personality or '熱情' in personality:
+        return f"*({character_name}精神抖擻地說，臉上掛著明朗的笑容)*"
+    elif '冷靜' in personality or '沉穩' in personality:
+        return f"*({character_name}沉穩地回應，表情平靜而專注)*"
+    elif '傲嬌' in personality or '高傲' in personality:
+        return f"*({character_name}微微揚起下巴，假裝不太在意地說)*"
+    elif '溫柔' in personality or '體貼' in personality:
+        return f"*({character_name}溫柔地微笑著，眼中流露出關切之情)*"
+    else:
+        return f"*({character_name}看著你，眼神中帶著一絲好奇)*"
+
+def has_narration(text: str) -> bool:
+    """檢查文本中是否已有旁白標記"""
+    return any(marker in text for marker in NARRATION_MARKERS)
+
+def apply_newline_rules(text: str) -> str:
+    """
+    確保旁白和對話之間有換行
+
+    兩條規則都只檢查插入位置前後的字元而不消耗它們，
+    因此結果不受文本在哪裡被切開影響（串流時可以只保留結尾幾個字元再決定）。
+    """
+    # 確保旁白和對話之間有換行
+    text = re.sub(r'\)\*(?=[^\n])', ')*\n', text)
+
+    # 確保對話和旁白之間有換行
+    text = re.sub(r'(?<=[^\n])\*\(', '\n*(', text)
+
+    return text
+
+def clamp_affinity_change(change: int) -> int:
+    """將好感度變化限制在 -5 到 +5 之間"""
+    return max(-MAX_AFFINITY_CHANGE, min(MAX_AFFINITY_CHANGE, int(change)))
+
+def extract_affinity_trailer(text: str) -> Tuple[str, Optional[int]]:
+    """
+    從回覆中移除好感度標記
+
+    參數:
+        text: 模型回覆
+
+    返回:
+        (移除標記後的回覆, 好感度變化；沒有標記時為 None)
+    """
+    matches = list(AFFINITY_TRAILER_PATTERN.finditer(text))
+    if not matches:
+        return text, None
+
+    change = clamp_affinity_change(int(matches[-1].group(1)))
+    return AFFINITY_TRAILER_PATTERN.sub("\n", text).strip(), change
+
+def parse_structured_reply(text: str) -> Tuple[str, Optional[int]]:
+    """
+    解析結構化輸出（JSON 物件 {"reply": ..., "affinity_change": ...}）
+
+    參數:
+        text: 模型以 JSON 模式輸出的文本
+
+    返回:
+        (回覆文本, 好感度變化)；無法解析為 JSON 時退回好感度標記格式
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return extract_affinity_trailer(text)
+
+    if not isinstance(data, dict) or "reply" not in data:
+        return extract_affinity_trailer(text)
+
+    change = None
+    try:
+        if data.get("affinity_change") is not None:
+            change = clamp_affinity_change(int(data["affinity_change"]))
+    except (TypeError, ValueError):
+        pass
+    return str(data["reply"]), change
+
+def format_reply(response: str, character: Dict[str, Any]) -> str:
+    """
+    處理模型的完整回應：補上旁白並整理換行
+
+    參數:
+        response: 原始模型回應
+        character: 角色設定
+
+    返回:
+        處理後的回應
+    """
+    # 好感度標記只供後端使用，不能出現在用戶看到的回覆中
+    ai_reply, _ = extract_affinity_trailer(response)
+    ai_reply = ai_reply.strip()
+
+    # 確保回覆中有旁白描述
+    if not has_narration(ai_reply):
+        ai_reply = f"{build_narration(character)}\n{ai_reply}"
+
+    return apply_newline_rules(ai_reply)
+
+class StreamingReplyFormatter:
+    """
+    增量套用 format_reply 規則的串流格式化器
+
+    每次收到新片段時，對已確定的部分套用與 format_reply 相同的處理：
+    結尾可能是好感度標記的內容和結尾的空白（最後可能被 strip 掉）會被暫緩，
+    換行規則只看插入位置前後的字元，因此處理結果的最後 2 個字元之前都不會再改變，可以先輸出。
+    已輸出的部分在適當的字元之後被移出（保留該字元作為換行規則的上下文），每次只重新處理尚未輸出的結尾。
+    好感度標記和 format_reply 一樣一律移除；啟用 report_affinity_change 時，
+    結束時解析出的好感度變化存放在 affinity_change。
+    是否補上旁白要看整段回覆有沒有旁白標記，因此在看到第一個標記之前不輸出任何內容；
+    整段都沒有標記的回覆在結束時才一次輸出（與 format_reply 的結果相同）。
+    """
+
+    def __init__(self, character: Dict[str, Any], report_affinity_change: bool = False):
+        """
+        初始化格式化器
+
+        參數:
+            character: 角色設定
+            report_affinity_change: 是否回報好感度標記中的變化（內嵌好感度模式）
+        """
+        self.character = character
+        self.report_affinity_change = report_affinity_change
+        self.affinity_change = None  # 從好感度標記解析出的變化值
+        self._raw = ""  # 上一個切點之後收到的模型輸出
+        self._context = ""  # 切點前的最後一個字元，還沒有切點時為空字串
+        self._narration = None  # 補在開頭的旁白（含換行），尚未決定時為 None
+        self._probed = 0  # 已檢查過沒有旁白標記的原始輸出長度
+        self._sent = 0  # _raw 的處理結果中已輸出的字元數
+        self._parts = []  # 已輸出的所有片段
+
+    @property
+    def text(self) -> str:
+        """目前為止已輸出的完整文本"""
+        return "".join(self._parts)
+
+    def feed(self, chunk: str) -> str:
+        """
+        輸入一段模型輸出，返回可以立即發送給客戶端的文本
+
+        參數:
+            chunk: 模型新產生的文本片段
+
+        返回:
+            可以輸出的文本（可能為空字串）
+        """
+        if not chunk:
+            return ""
+
+        self._raw += chunk
+        if self._narration is None:
+            # 標記最長 2 個字元，從上次檢查位置的前 1 個字元開始，涵蓋跨越片段的標記
+            if not has_narration(self._raw[max(0, self._probed - 1):]):
+                self._probed = len(self._raw)
+                return ""
+            self._narration = ""
+
+        settled = self._settled_end()
+        # 最後 2 個字元之後可能被插入換行，留到下次再輸出
+        out = self._emit(self._format(self._raw[:settled])[:-2])
+        if len(self._raw) > STREAMING_CHECKPOINT_CHARS:
+            self._checkpoint(settled)
+        return out
+
+    def finish(self) -> str:
+        """
+        模型輸出結束，返回剩餘的文本
+
+        返回:
+            剩餘需要輸出的文本
+        """
+        if self._narration is None:
+            body, _ = extract_affinity_trailer(self._raw)
+            self._narration = "" if has_narration(body.strip()) else f"{build_narration(self.character)}\n"
+        self._record_affinity(self._raw)
+        return self._emit(self._format(self._raw))
+
+    def _format(self, raw: str) -> str:
+        """
+        對切點之後的原始輸出套用 format_reply 的處理
+
+        參數:
+            raw: 切點之後的原始輸出（結尾的空白會被去除）
+
+        返回:
+            處理結果（不含上下文字元）
+        """
+        body = AFFINITY_TRAILER_PATTERN.sub("\n", raw)
+        if not self._context:
+            return apply_newline_rules(self._narration + body.strip())
+        return apply_newline_rules(self._context + body.rstrip())[len(self._context):]
+
+    def _settled_end(self) -> int:
+        """
+        已確定的原始輸出長度：之後不論接著收到什麼，這部分的處理結果都不會改變
+
+        返回:
+            結尾可能是未完成的好感度標記的內容之前的位置
+        """
+        # 由前往後找第一個可能延續成好感度標記的 "["，前綴匹配逐字元擴展，因此越早的位置涵蓋越多內容
+        start = self._raw.find("[")
+        while start != -1:
+            if AFFINITY_TRAILER_PREFIX.fullmatch(self._raw, start):
+                return start
+            start = self._raw.find("[", start + 1)
+        return len(self._raw)
+
+    def _checkpoint(self, settled: int) -> None:
+        """把處理結果已全部輸出的開頭部分移出，以其最後一個字元作為之後的上下文"""
+        for cut in range(settled - 1, 0, -1):
+            char = self._raw[cut - 1]
+            if char.isspace() or char in TRAILER_CHARS:
+                continue
+            done = self._format(self._raw[:cut])
+            if len(done) > self._sent:
+                continue
+            self._record_affinity(self._raw[:cut])
+            self._raw, self._context = self._raw[cut:], char
+            self._sent -= len(done)
+            return
+
+    def _record_affinity(self, raw: str) -> None:
+        """記錄原始輸出中最後一個好感度標記的變化"""
+        _, change = extract_affinity_trailer(raw)
+        if self.report_affinity_change and change is not None:
+            self.affinity_change = change
+
+    def _emit(self, processed: str) -> str:
+        """輸出處理結果中尚未輸出的部分"""
+        out = processed[self._sent:]
+        if out:
+            self._sent = len(processed)
+            self._parts.append(out)
+        return out
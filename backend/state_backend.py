@@ -0,0 +1,648 @@
+import os
+import json
+import uuid
+import asyncio
+import inspect
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Callable, Optional, Tuple
+from dotenv import load_dotenv
+from conversation_store import conversation_store, Message
+from conversation_persistence import conversation_persistence
+
+# 載入環境變數
+load_dotenv()
+
+# 共享狀態後端只保留每段對話最近的好感度變化數量
+MAX_AFFINITY_UPDATES = 20
+
+class StateBackend(ABC):
+    """
+    對話狀態後端的抽象基類
+
+    ChatManager 透過後端修改對話歷史、好感度、回合ID和摘要，並讀取本程序對話存儲中的副本。
+    後端也負責在多個程序之間廣播失效通知（對話、角色設定；記憶緩存改由資料庫通知，見 memory_cache.py）。
+    """
+
+    # 是否在多個程序之間共享狀態
+    shared = False
+
+    def __init__(self):
+        """初始化後端"""
+        self._subscribers = {}  # 通知類型 -> [回呼函數]
+        self._loading = {}  # (用戶ID, 角色ID) -> 載入中的 Future
+        self._stats = {
+            "loads": 0,
+            "published": 0,
+            "received": 0
+        }
+
+    async def start(self) -> None:
+        """建立連接（應用啟動時呼叫）"""
+
+    async def close(self) -> None:
+        """關閉連接（應用關閉時呼叫）"""
+
+    def subscribe(self, kind: str, callback: Callable[..., Any]) -> None:
+        """
+        訂閱其他程序發出的失效通知
+
+        參數:
+            kind: 通知類型（例如 "characters"）
+            callback: 收到通知時呼叫的函數（可以是協程函數），參數為發送時的 args
+        """
+        self._subscribers.setdefault(kind, []).append(callback)
+
+    async def publish(self, kind: str, *args: Any) -> None:
+        """
+        通知其他程序某項狀態已改變（只有一個程序時不需要通知）
+
+        參數:
+            kind: 通知類型
+            args: 通知參數（必須可以 JSON 序列化）
+        """
+
+    async def _dispatch(self, kind: str, args: List[Any]) -> None:
+        """呼叫訂閱者"""
+        self._stats["received"] += 1
+        for callback in self._subscribers.get(kind, []):
+            try:
+                result = callback(*args)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"處理 {kind} 失效通知時出錯: {str(e)}")
+
+    def is_loaded(self, user_id: str, character_id: str) -> bool:
+        """對話是否已在本程序的對話存儲中且為最新狀態"""
+        return conversation_store.peek(user_id, character_id) is not None
+
+    async def ensure_loaded(self, user_id: str, character_id: str) -> None:
+        """
+        確保對話已載入本程序的對話存儲（同一對話同時只載入一次）
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+
+        異常:
+            ConversationLoadError: 無法從資料庫讀取對話（對話不會被建立，同時等待的呼叫者也收到此錯誤）
+        """
+        if self.is_loaded(user_id, character_id):
+            return
+
+        key = (user_id, character_id)
+        loading = self._loading.get(key)
+        if loading is not None:
+            error = await loading
+            if error is not None:
+                raise error
+            return
+
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[key] = loading
+        error = None
+        try:
+            await self.load(user_id, character_id)
+            self._stats["loads"] += 1
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._loading.pop(key, None)
+            loading.set_result(error)
+
+    @abstractmethod
+    async def load(self, user_id: str, character_id: str) -> None:
+        """從後端（或資料庫）載入對話到本程序的對話存儲；讀取失敗時拋出異常且不建立對話"""
+        pass
+
+    @abstractmethod
+    async def append_message(self, user_id: str, character_id: str, role: str, content: str) -> Message:
+        """
+        添加消息到對話
+
+        返回:
+            新增的消息（帶有分配的序號）
+        """
+        pass
+
+    @abstractmethod
+    async def add_affinity(self, user_id: str, character_id: str, change: int) -> int:
+        """
+        原子地調整好感度（限制在 0-100 之間）
+
+        返回:
+            調整後的好感度
+        """
+        pass
+
+    @abstractmethod
+    async def set_affinity(self, user_id: str, character_id: str, value: int) -> int:
+        """
+        設置好感度（呼叫者負責限制範圍）
+
+        返回:
+            設置後的好感度
+        """
+        pass
+
+    @abstractmethod
+    async def next_turn_id(self, user_id: str, character_id: str) -> int:
+        """
+        原子地分配新的回合ID
+
+        返回:
+            新的回合ID
+        """
+        pass
+
+    @abstractmethod
+    async def record_affinity_update(self, user_id: str, character_id: str, update: Dict[str, Any]) -> None:
+        """記錄一筆完成的好感度變化 {turn_id, affinity_change, affinity}"""
+        pass
+
+    @abstractmethod
+    async def get_affinity_updates(self, user_id: str, character_id: str) -> List[Dict[str, Any]]:
+        """獲取最近完成的好感度變化（由舊到新）"""
+        pass
+
+    @abstractmethod
+    async def set_summary(self, user_id: str, character_id: str, summary: Dict[str, Any],
+                          first_seq: int) -> bool:
+        """
+        保存滾動摘要，並移除序號不大於 summary["folded_seq"] 的消息
+
+        參數:
+            user_id: 用戶ID
+            character_id: 角色ID
+            summary: 摘要記錄
+            first_seq: 摘要開始時對話的第一條消息序號；對話已被重置或已摺疊時不一致，摘要會被丟棄
+
+        返回:
+            是否已保存
+        """
+        pass
+
+    @abstractmethod
+    async def advance_memory_seq(self, user_id: str, character_id: str, seq: int) -> None:
+        """記錄記憶提取已成功處理到的消息序號（只會前移）"""
+        pass
+
+    @abstractmethod
+    async def clear(self, user_id: Optional[str] = None, character_id: Optional[str] = None) -> None:
+        """清除對話消息和摘要（保留好感度和回合ID）"""
+        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取後端統計"""
+        return {"backend": self.__class__.__name__, "shared": self.shared, **self._stats}
+
+class InProcessStateBackend(StateBackend):
+    """
+    程序內的狀態後端（默認）
+
+    本程序的對話存儲就是唯一的狀態，只能以單一 worker 執行。
+    """
+
+    async def load(self, user_id: str, character_id: str) -> None:
+        # 讀取失敗時 fetch_state 拋出 ConversationLoadError，不會以默認狀態建立對話
+        state = await conversation_persistence.fetch_state(user_id, character_id)
+        if conversation_store.peek(user_id, character_id) is not None:
+            return
+        if state is not None:
+            conversation_store.restore(user_id, character_id, **state)
+        else:
+            conversation_store.get(user_id, character_id)
+
+    async def append_message(self, user_id: str, character_id: str, role: str, content: str) -> Message:
+        return conversation_store.append(user_id, character_id, role, content)
+
+    async def add_affinity(self, user_id: str, character_id: str, change: int) -> int:
+        conversation = conversation_store.get(user_id, character_id)
+        conversation.affinity = max(0, min(100, conversation.affinity + change))
+        return conversation.affinity
+
+    async def set_affinity(self, user_id: str, character_id: str, value: int) -> int:
+        conversation_store.get(user_id, character_id).affinity = value
+        return value
+
+    async def next_turn_id(self, user_id: str, character_id: str) -> int:
+        conversation = conversation_store.get(user_id, character_id)
+        conversation.turn_id += 1
+        return conversation.turn_id
+
+    async def record_affinity_update(self, user_id: str, character_id: str, update: Dict[str, Any]) -> None:
+        # deque 的 maxlen 自動丟棄較早的記錄
+        conversation_store.get(user_id, character_id).affinity_updates.append(update)
+
+    async def get_affinity_updates(self, user_id: str, character_id: str) -> List[Dict[str, Any]]:
+        conversation = conversation_store.peek(user_id, character_id)
+        return list(conversation.affinity_updates) if conversation is not None else []
+
+    async def set_summary(self, user_id: str, character_id: str, summary: Dict[str, Any],
+                          first_seq: int) -> bool:
+        conversation = conversation_store.peek(user_id, character_id)
+        if conversation is None or not conversation.messages or conversation.messages[0].seq != first_seq:
+            return False
+        conversation_store.drop_through(user_id, character_id, summary["folded_seq"])
+        conversation.summary = summary
+        return True
+
+    async def advance_memory_seq(self, user_id: str, character_id: str, seq: int) -> None:
+        conversation = conversation_store.get(user_id, character_id)
+        conversation.memory_seq = max(conversation.memory_seq, seq)
+
+    async def clear(self, user_id: Optional[str] = None, character_id: Optional[str] = None) -> None:
+        conversation_store.clear_messages(user_id, character_id)
+
+# 以 Lua 腳本在 Redis 端原子執行的操作（消息以 "序號\x1f角色\x1f內容" 保存在列表中）
+APPEND_SCRIPT = """
+local seq = redis.call('HINCRBY', KEYS[1], 'message_seq', 1)
+redis.call('RPUSH', KEYS[2], seq .. '\\031' .. ARGV[1] .. '\\031' .. ARGV[2])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[3]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return seq
+"""
+
+ADD_AFFINITY_SCRIPT = """
+local value = tonumber(redis.call('HGET', KEYS[1], 'affinity') or ARGV[2]) + tonumber(ARGV[1])
+value = math.max(0, math.min(100, value))
+redis.call('HSET', KEYS[1], 'affinity', value)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return value
+"""
+
+SEED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'affinity', ARGV[2], 'turn_id', ARGV[3], 'message_seq', ARGV[4], 'memory_seq', ARGV[5])
+if ARGV[6] ~= '' then
+    redis.call('HSET', KEYS[1], 'summary', ARGV[6])
+end
+redis.call('DEL', KEYS[2])
+for i = 7, #ARGV do
+    redis.call('RPUSH', KEYS[2], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+if #ARGV >= 7 then
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+ADVANCE_MEMORY_SEQ_SCRIPT = """
+if tonumber(redis.call('HGET', KEYS[1], 'memory_seq') or '0') < tonumber(ARGV[1]) then
+    redis.call('HSET', KEYS[1], 'memory_seq', ARGV[1])
+end
+return tonumber(redis.call('HGET', KEYS[1], 'memory_seq'))
+"""
+
+SET_SUMMARY_SCRIPT = """
+local head = redis.call('LINDEX', KEYS[2], 0)
+if not head or tonumber(string.match(head, '^(%d+)')) ~= tonumber(ARGV[2]) then
+    return 0
+end
+while head and tonumber(string.match(head, '^(%d+)')) <= tonumber(ARGV[3]) do
+    redis.call('LPOP', KEYS[2])
+    head = redis.call('LINDEX', KEYS[2], 0)
+end
+redis.call('HSET', KEYS[1], 'summary', ARGV[1])
+return 1
+"""
+
+class RedisStateBackend(StateBackend):
+    """
+    以 Redis 共享狀態的後端，讓多個 worker 或多個 Pod 看到相同的對話
+
+    - 每段對話保存為一個狀態 hash（好感度、回合ID、消息序號、摘要、記憶提取序號）和一個消息列表
+    - 追加消息、調整好感度、分配回合ID和保存摘要都在 Redis 端原子執行
+    - 修改後透過 pub/sub 通知其他程序，其他程序在下次存取時重新讀取該對話
+    - Redis 中沒有的對話先從資料庫載入（見 conversation_persistence.py）再寫入 Redis
+
+    需要安裝 redis 套件 (pip install redis)。
+    """
+
+    shared = True
+
+    def __init__(self, url: str):
+        """
+        初始化後端
+
+        參數:
+            url: Redis 位址（redis://主機:埠/資料庫）
+        """
+        super().__init__()
+        self.url = url
+        self.prefix = os.getenv("STATE_KEY_PREFIX", "chat:")
+        self.channel = f"{self.prefix}invalidate"
+        self.ttl = int(conversation_store.ttl)
+        self.worker_id = uuid.uuid4().hex  # 忽略自己發出的通知
+
+        self.client = None
+        self._pubsub = None
+        self._listener = None
+        self._scripts = {}
+        self._stale = set()  # 被其他程序修改過、下次存取時需要重新讀取的對話
+
+    async def start(self) -> None:
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis 需要安裝 redis 套件 (pip install redis)")
+
+        self.client = redis.from_url(self.url, decode_responses=True)
+        await self.client.ping()
+        self._scripts = {
+            "append": self.client.register_script(APPEND_SCRIPT),
+            "add_affinity": self.client.register_script(ADD_AFFINITY_SCRIPT),
+            "seed": self.client.register_script(SEED_SCRIPT),
+            "advance_memory_seq": self.client.register_script(ADVANCE_MEMORY_SEQ_SCRIPT),
+            "set_summary": self.client.register_script(SET_SUMMARY_SCRIPT)
+        }
+        # 預先載入腳本，第一次呼叫不必先收到 NOSCRIPT 再重送
+        for script in self._scripts.values():
+            await self.client.script_load(script.script)
+
+        self._pubsub = self.client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._listener = asyncio.create_task(self._listen())
+        print(f"已連接共享狀態後端: {self.url}")
+
+    async def close(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _keys(self, user_id: str, character_id: str) -> Tuple[str, str, str]:
+        """對話的 (狀態 hash, 消息列表, 好感度變化列表) 鍵名"""
+        base = f"{self.prefix}{self._encode_id(user_id)}{self._encode_id(character_id)}"
+        return f"{base}state", f"{base}messages", f"{base}updates"
+
+    @staticmethod
+    def _encode_id(value: str) -> str:
+        """以長度前綴編碼鍵名中的ID，ID 含有 ":" 時不同對話的鍵名也不會相同"""
+        return f"{len(value)}:{value}:"
+
+    def _parse_key(self, key: str) -> Optional[Tuple[str, str]]:
+        """從鍵名解析出 (用戶ID, 角色ID)，不是本後端的鍵名時返回 None"""
+        if not key.startswith(self.prefix):
+            return None
+        ids = []
+        position = len(self.prefix)
+        for _ in range(2):
+            length, separator, _ = key[position:].partition(":")
+            if not separator or not length.isdigit():
+                return None
+            start = position + len(length) + 1
+            position = start + int(length)
+            if key[position:position + 1] != ":":
+                return None
+            ids.append(key[start:position])
+            position += 1
+        return ids[0], ids[1]
+
+    # ---- 失效通知 ----
+
+    async def publish(self, kind: str, *args: Any) -> None:
+        await self.client.publish(self.channel, json.dumps(
+            {"origin": self.worker_id, "kind": kind, "args": list(args)}, ensure_ascii=False
+        ))
+        self._stats["published"] += 1
+
+    async def _listen(self) -> None:
+        """接收其他程序的失效通知"""
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data.get("origin") == self.worker_id:
+                        continue
+                    if data["kind"] == "conversation":
+                        self._stale.add(tuple(data["args"]))
+                        self._stats["received"] += 1
+                    elif data["kind"] == "clear":
+                        conversation_store.clear_messages(*data["args"])
+                        self._stats["received"] += 1
+                    else:
+                        await self._dispatch(data["kind"], data["args"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 連接中斷期間可能錯過通知，將所有對話視為過期
+                print(f"接收共享狀態通知時出錯，稍後重試: {str(e)}")
+                self._stale.update(conversation_store.keys())
+                await asyncio.sleep(1)
+
+    async def _changed(self, user_id: str, character_id: str) -> None:
+        """通知其他程序對話已改變"""
+        await self.publish("conversation", user_id, character_id)
+
+    # ---- 對話狀態 ----
+
+    def is_loaded(self, user_id: str, character_id: str) -> bool:
+        return (user_id, character_id) not in self._stale and super().is_loaded(user_id, character_id)
+
+    @staticmethod
+    def _encode_message(seq: int, role: str, content: str) -> str:
+        return f"{seq}\x1f{role}\x1f{content}"
+
+    @staticmethod
+    def _decode_message(entry: str) -> Tuple[int, str, str]:
+        seq, role, content = entry.split("\x1f", 2)
+        return int(seq), role, content
+
+    async def load(self, user_id: str, character_id: str) -> None:
+        state_key, messages_key, _ = self._keys(user_id, character_id)
+        self._stale.discard((user_id, character_id))
+        try:
+            state, entries = await self._read(state_key, messages_key)
+            if not state:
+                state, entries = await self._seed(user_id, character_id, state_key, messages_key)
+        except Exception:
+            # 本程序中的舊副本不能被當成最新狀態使用
+            self._stale.add((user_id, character_id))
+            raise
+
+        conversation_store.restore(
+            user_id,
+            character_id,
+            [self._decode_message(entry) for entry in entries],
+            affinity=int(state.get("affinity", conversation_store.default_affinity)),
+            turn_id=int(state.get("turn_id", 0)),
+            message_seq=int(state.get("message_seq", 0)),
+            summary=json.loads(state["summary"]) if state.get("summary") else None,
+            memory_seq=int(state.get("memory_seq", 0))
+        )
+
+    async def _seed(self, user_id: str, character_id: str, state_key: str,
+                    messages_key: str) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Redis 中沒有（新對話或已過期）時從資料庫載入後寫入；其他程序可能同時寫入，以先寫入的為準
+
+        讀取資料庫失敗時拋出 ConversationLoadError，不會寫入默認狀態
+        """
+        persisted = await conversation_persistence.fetch_state(user_id, character_id) or {
+            "messages": [], "affinity": conversation_store.default_affinity,
+            "turn_id": 0, "message_seq": 0, "summary": None, "memory_seq": 0
+        }
+        summary = persisted["summary"]
+        await self._scripts["seed"](keys=[state_key, messages_key], args=[
+            self.ttl, persisted["affinity"], persisted["turn_id"], persisted["message_seq"], persisted["memory_seq"],
+            json.dumps(summary, ensure_ascii=False) if summary else "",
+            *(self._encode_message(*message) for message in persisted["messages"])
+        ])
+        return await self._read(state_key, messages_key)
+
+    async def _read(self, state_key: str, messages_key: str) -> Tuple[Dict[str, str], List[str]]:
+        """一次往返讀取對話狀態和消息"""
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hgetall(state_key)
+            pipe.lrange(messages_key, 0, -1)
+            state, entries = await pipe.execute()
+        return state, entries
+
+    async def _local(self, user_id: str, character_id: str):
+        """
+        獲取本程序中的對話副本（修改共享狀態後同步更新）
+
+        副本被其他程序標記為過期時先重新讀取，避免之後以舊的 turn_id、message_seq 保存到資料庫。
+        """
+        if not self.is_loaded(user_id, character_id):
+            await self.ensure_loaded(user_id, character_id)
+        return conversation_store.get(user_id, character_id)
+
+    async def append_message(self, user_id: str, character_id: str, role: str, content: str) -> Message:
+        state_key, messages_key, _ = self._keys(user_id, character_id)
+        # 先確保本程序有副本，否則載入時會讀到這條消息而重複加入
+        await self._local(user_id, character_id)
+        seq = await self._scripts["append"](
+            keys=[state_key, messages_key], args=[role, content, conversation_store.message_capacity, self.ttl]
+        )
+        message = conversation_store.append(user_id, character_id, role, content, seq=int(seq))
+        await self._changed(user_id, character_id)
+        return message
+
+    async def add_affinity(self, user_id: str, character_id: str, change: int) -> int:
+        state_key, _, _ = self._keys(user_id, character_id)
+        value = int(await self._scripts["add_affinity"](
+            keys=[state_key], args=[change, conversation_store.default_affinity, self.ttl]
+        ))
+        (await self._local(user_id, character_id)).affinity = value
+        await self._changed(user_id, character_id)
+        return value
+
+    async def set_affinity(self, user_id: str, character_id: str, value: int) -> int:
+        state_key, _, _ = self._keys(user_id, character_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(state_key, "affinity", value)
+            pipe.expire(state_key, self.ttl)
+            await pipe.execute()
+        (await self._local(user_id, character_id)).affinity = value
+        await self._changed(user_id, character_id)
+        return value
+
+    async def next_turn_id(self, user_id: str, character_id: str) -> int:
+        state_key, _, _ = self._keys(user_id, character_id)
+        turn_id = int(await self.client.hincrby(state_key, "turn_id", 1))
+        (await self._local(user_id, character_id)).turn_id = turn_id
+        await self._changed(user_id, character_id)
+        return turn_id
+
+    async def record_affinity_update(self, user_id: str, character_id: str, update: Dict[str, Any]) -> None:
+        _, _, updates_key = self._keys(user_id, character_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.rpush(updates_key, json.dumps(update))
+            pipe.ltrim(updates_key, -MAX_AFFINITY_UPDATES, -1)
+            pipe.expire(updates_key, self.ttl)
+            await pipe.execute()
+
+    async def get_affinity_updates(self, user_id: str, character_id: str) -> List[Dict[str, Any]]:
+        _, _, updates_key = self._keys(user_id, character_id)
+        return [json.loads(entry) for entry in await self.client.lrange(updates_key, 0, -1)]
+
+    async def set_summary(self, user_id: str, character_id: str, summary: Dict[str, Any],
+                          first_seq: int) -> bool:
+        state_key, messages_key, _ = self._keys(user_id, character_id)
+        saved = await self._scripts["set_summary"](
+            keys=[state_key, messages_key],
+            args=[json.dumps(summary, ensure_ascii=False), first_seq, summary["folded_seq"]]
+        )
+        if not saved:
+            return False
+        conversation = conversation_store.peek(user_id, character_id)
+        if conversation is not None:
+            conversation_store.drop_through(user_id, character_id, summary["folded_seq"])
+            conversation.summary = summary
+        await self._changed(user_id, character_id)
+        return True
+
+    async def advance_memory_seq(self, user_id: str, character_id: str, seq: int) -> None:
+        state_key, _, _ = self._keys(user_id, character_id)
+        value = int(await self._scripts["advance_memory_seq"](keys=[state_key], args=[seq]))
+        (await self._local(user_id, character_id)).memory_seq = value
+        await self._changed(user_id, character_id)
+
+    async def clear(self, user_id: Optional[str] = None, character_id: Optional[str] = None) -> None:
+        if user_id is not None and character_id is not None:
+            state_keys = [self._keys(user_id, character_id)[0]]
+        else:
+            user_part = self._escape(self._encode_id(user_id)) if user_id is not None else "*"
+            pattern = f"{self._escape(self.prefix)}{user_part}*state"
+            # 模式只縮小掃描範圍，仍需解析鍵名確認屬於要清除的對話
+            state_keys = []
+            async for key in self.client.scan_iter(match=pattern, count=500):
+                ids = self._parse_key(key)
+                if ids is None or key != self._keys(*ids)[0]:
+                    continue
+                if (user_id is None or ids[0] == user_id) and (character_id is None or ids[1] == character_id):
+                    state_keys.append(key)
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            for state_key in state_keys:
+                pipe.hdel(state_key, "summary")
+                pipe.delete(state_key[:-len("state")] + "messages")
+            await pipe.execute()
+
+        conversation_store.clear_messages(user_id, character_id)
+        await self.publish("clear", user_id, character_id)
+
+    @staticmethod
+    def _escape(text: str) -> str:
+        """轉義 SCAN 模式中的萬用字元"""
+        for char in "\\*?[]":
+            text = text.replace(char, f"\\{char}")
+        return text
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**super().get_stats(), "url": self.url, "stale": len(self._stale)}
+
+def create_state_backend() -> StateBackend:
+    """
+    依 STATE_BACKEND 環境變數建立狀態後端
+
+    返回:
+        memory（默認，單一 worker）或 redis（多個 worker / 多個 Pod）後端
+    """
+    backend = os.getenv("STATE_BACKEND", "memory").lower()
+    if backend == "redis":
+        return RedisStateBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if backend != "memory":
+        print(f"未知的狀態後端 {backend}，使用程序內後端")
+    return InProcessStateBackend()
+
+# 創建單例實例
+state_backend = create_state_backend()
@@ -0,0 +1,24 @@
+from affinity_scorer import local_affinity_scorer
+
+# 不需要 API 金鑰，可直接執行本檔案或用 pytest 執行
+CHARACTER = {"name": "小雪", "personality": "溫柔體貼", "likes": "咖啡", "dislikes": "下雨"}
+THRESHOLD = 0.75  # AFFINITY_LOCAL_THRESHOLD 的預設值
+
+def test_short_single_hit_resolves_locally():
+    """只有一個禮貌或敵意詞彙的短訊息在本地判定，不交給模型"""
+    for message, expected in [("hi", 1), ("thanks", 1), ("謝謝", 1), ("你好", 1), ("謝謝你！", 1), ("笨蛋", -1)]:
+        change, confidence = local_affinity_scorer.score(CHARACTER, message)
+        assert confidence >= THRESHOLD, (message, confidence)
+        assert (change > 0) == (expected > 0), (message, change)
+
+def test_single_hit_with_context_escalates():
+    """帶否定詞或其他內容的單一詞彙訊息仍然交給模型判斷"""
+    for message in ["我不喜歡你說謝謝", "不謝謝", "hi there", "thanks a lot", "醜 hi", "咖啡"]:
+        _, confidence = local_affinity_scorer.score(CHARACTER, message)
+        assert confidence < THRESHOLD, (message, confidence)
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: 通過")
@@ -61,7 +61,7 @@ def test_chat_with_character():
             print("\n角色回應:")
             print(result.get("reply", "無回應"))
             print(f"\n好感度: {result.get('affinity', 'N/A')}")
-            print(f"好感度變化: {result.get('affinity_change', 'N/A')}")
+            print(f"回合ID: {result.get('turn_id', 'N/A')}（好感度變化於後台計算）")
         else:
             print(f"聊天請求失敗: {chat_response.status_code}")
             print(chat_response.text)
@@ -66,7 +66,7 @@ def test_gemini_chat():
                 print(result.get("reply", "無回應"))
                 print("\n===== 其他資訊 =====")
                 print(f"好感度: {result.get('affinity', 'N/A')}")
-                print(f"好感度變化: {result.get('affinity_change', 'N/A')}")
+                print(f"回合ID: {result.get('turn_id', 'N/A')}（好感度變化於後台計算）")
         else:
             print(f"\n❌ 請求失敗: {chat_response.status_code}")
             print(f"錯誤詳情: {chat_response.text}")
@@ -0,0 +1,51 @@
+from memory_dedup import NearDuplicateIndex, minhash, shingles, jaccard, SIMILARITY_THRESHOLD
+
+# 不需要資料庫，可直接執行本檔案或用 pytest 執行
+TYPE = "preferences"
+
+def find_after(existing: str, text: str):
+    """索引中只有 existing 時，text 找到的近似重複項目"""
+    index = NearDuplicateIndex()
+    index.add(TYPE, existing, minhash(existing))
+    return index.find(TYPE, text, minhash(text))
+
+def test_merges_near_duplicates():
+    """只差在語氣詞、標點或全形半形的記憶視為重複"""
+    pairs = [
+        ("用戶表達了喜好：我喜歡吃很辣的四川菜", "用戶表達了喜好：我真的喜歡吃很辣的四川菜啦"),
+        ("用戶表達了喜好：I like spicy food", "用戶表達了喜好：ｉ ｌｉｋｅ　spicy food!"),
+        ("用戶表達了喜好：我特別喜歡吃很辣的四川菜", "用戶表達了喜好：我特別喜歡吃很辣的四川菜呢"),
+    ]
+    for existing, text in pairs:
+        assert find_after(existing, text) == existing, (existing, text)
+
+def test_keeps_opposite_polarity():
+    """字面相似但否定詞或關鍵詞不同的記憶意思相反，不能合併"""
+    pairs = [
+        ("用戶表達了喜好：我喜歡吃很辣的四川菜", "用戶表達了喜好：我不喜歡吃很辣的四川菜"),
+        ("用戶表達了喜好：I like eating very spicy sichuan food with my best friends on weekends",
+         "用戶表達了喜好：I don't like eating very spicy sichuan food with my best friends on weekends"),
+        ("用戶表達了喜好：I like eating very spicy sichuan food with my best friends on weekends",
+         "用戶表達了喜好：I don’t like eating very spicy sichuan food with my best friends on weekends"),
+        ("用戶表達了喜好：我愛吃很辣的四川菜和重慶火鍋", "用戶表達了喜好：我討厭吃很辣的四川菜和重慶火鍋"),
+        ("用戶提到的事件：今天去了台北看牙醫", "用戶提到的事件：明天去了台北看牙醫"),
+    ]
+    for existing, text in pairs:
+        # 確認這些例子的字面相似度確實達到門檻，是否定詞或關鍵詞阻止了合併
+        assert jaccard(shingles(existing), shingles(text)) >= SIMILARITY_THRESHOLD, (existing, text)
+        assert find_after(existing, text) is None, (existing, text)
+        assert find_after(text, existing) is None, (text, existing)
+
+def test_prefers_same_polarity_candidate():
+    """同時有相反和相同意思的候選項目時，合併到意思相同的項目"""
+    index = NearDuplicateIndex()
+    for text in ("用戶表達了喜好：我不喜歡吃很辣的四川菜", "用戶表達了喜好：我喜歡吃很辣的四川菜"):
+        index.add(TYPE, text, minhash(text))
+    text = "用戶表達了喜好：我喜歡吃很辣的四川菜喔"
+    assert index.find(TYPE, text, minhash(text)) == "用戶表達了喜好：我喜歡吃很辣的四川菜"
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: 通過")
@@ -75,7 +75,7 @@ def test_chat(model_type="gemini"):
                 print(response_data.get("reply", "無回應"))
                 print("\n===== 其他資訊 =====")
                 print(f"好感度: {response_data.get('affinity', 'N/A')}")
-                print(f"好感度變化: {response_data.get('affinity_change', 'N/A')}")
+                print(f"回合ID: {response_data.get('turn_id', 'N/A')}（好感度變化於後台計算）")
         except:
             print("無法解析回應為JSON格式")
             print(f"原始回應: {chat_response.text}")
@@ -0,0 +1,92 @@
+import random
+import response_formatter
+from response_formatter import format_reply, extract_affinity_trailer, StreamingReplyFormatter
+
+# 不需要 API 金鑰或後端服務，可直接執行本檔案或用 pytest 執行
+CHARACTER = {"name": "小雪", "personality": "溫柔體貼"}
+
+# 串流格式化器應與 format_reply 產生相同結果的回覆（旁白標記可能在開頭、在後段，或整段都沒有）
+SAMPLES = [
+    ")*[[x]]",
+    "*(她笑了)*你好呀)*[[x]]",
+    "*(她笑了)*你好呀，今天過得怎麼樣？*(歪著頭)*要不要一起去散步？",
+    "*(她笑了)*嗯……)*[[affinity:+2]]",
+    "*(她笑了)*我也這麼覺得！ [[affinity: -3]]  ",
+    "*(她笑了)*[[affinity:+1]]中間的標記也會被移除[[affinity:+2]]",
+    "*(她笑了)*陣列寫法 [1, 2] 和 [[不是標記]] 都要保留",
+    "*(她笑了)*連續的旁白*(*(*(咦)*)*)*結束",
+    "   你好，這是一段沒有旁白、需要自動補上的回覆。   ",
+    "短回覆",
+    "[[affinity:+5]]",
+    "*(她笑了)*" + "很長的回覆，" * 80 + "*(揮手)*再見！[[affinity:+1]]",
+    "今天天氣很好，我們一起去公園散步吧，你覺得怎麼樣呢？*(小明微笑著看著你)*\n好啊",
+    "很長的回覆，" * 60 + "最後才有旁白**[[affinity:-1]]",
+    "沒有旁白的長回覆，" * 60 + "[[affinity:+3]]",
+]
+
+def stream(text: str, sizes: list, report_affinity_change: bool) -> StreamingReplyFormatter:
+    """按給定的片段長度把文本餵給串流格式化器，返回結束後的格式化器"""
+    formatter = StreamingReplyFormatter(CHARACTER, report_affinity_change=report_affinity_change)
+    output = ""
+    position = 0
+    for size in sizes:
+        output += formatter.feed(text[position:position + size])
+        position += size
+    output += formatter.feed(text[position:])
+    output += formatter.finish()
+    assert output == formatter.text
+    return formatter
+
+def check_parity(text: str, sizes: list, report_affinity_change: bool) -> None:
+    """串流結果與 format_reply 一致，且只在內嵌模式回報好感度變化"""
+    formatter = stream(text, sizes, report_affinity_change)
+    assert formatter.text == format_reply(text, CHARACTER), (text, sizes, report_affinity_change)
+    expected_change = extract_affinity_trailer(text)[1] if report_affinity_change else None
+    assert formatter.affinity_change == expected_change, (text, sizes, report_affinity_change)
+
+def test_streaming_matches_format_reply():
+    """固定長度切片：每個範例用 1 到 7 個字元的片段輸入"""
+    for text in SAMPLES:
+        for size in range(1, 8):
+            for report_affinity_change in (False, True):
+                check_parity(text, [size] * len(text), report_affinity_change)
+
+def test_streaming_matches_format_reply_random_chunks():
+    """隨機切片，並縮短切點間隔以涵蓋移出已輸出部分的路徑"""
+    rng = random.Random(7)
+    original = response_formatter.STREAMING_CHECKPOINT_CHARS
+    try:
+        for checkpoint in (1, 8, original):
+            response_formatter.STREAMING_CHECKPOINT_CHARS = checkpoint
+            for text in SAMPLES:
+                for _ in range(20):
+                    sizes = [rng.randint(1, 6) for _ in range(len(text))]
+                    check_parity(text, sizes, rng.random() < 0.5)
+    finally:
+        response_formatter.STREAMING_CHECKPOINT_CHARS = original
+
+def test_streaming_emits_before_finish():
+    """長回覆在結束前就開始輸出，並且不會提前輸出好感度標記"""
+    text = "*(她笑了)*" + "你好呀，" * 30 + "[[affinity:+2]]"
+    formatter = StreamingReplyFormatter(CHARACTER, report_affinity_change=True)
+    early = "".join(formatter.feed(text[i:i + 3]) for i in range(0, len(text), 3))
+    assert early and "[[" not in early
+    formatter.finish()
+    assert formatter.affinity_change == 2
+
+def test_streaming_waits_for_late_narration():
+    """旁白標記出現在後段時，看到標記之前不輸出，之後也不補上旁白"""
+    text = "今天天氣很好，我們一起去公園散步吧，你覺得怎麼樣呢？*(小明微笑著看著你)*\n好啊"
+    marker = text.index("*(")
+    formatter = StreamingReplyFormatter(CHARACTER)
+    assert "".join(formatter.feed(char) for char in text[:marker + 1]) == ""
+    formatter.feed(text[marker + 1:])
+    formatter.finish()
+    assert formatter.text == format_reply(text, CHARACTER)
+    assert formatter.text.startswith("今天天氣很好")
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: 通過")
@@ -0,0 +1,156 @@
+import os
+import asyncio
+import json
+
+# 不連接對話資料庫，Redis 中沒有的對話從空白狀態開始
+os.environ["CONVERSATION_PERSISTENCE_ENABLED"] = "false"
+
+import fakeredis
+import redis.asyncio
+from conversation_store import conversation_store
+from state_backend import RedisStateBackend
+
+# 以 fakeredis 模擬 Redis（需要安裝 requirements-dev.txt 中的 fakeredis[lua] 才能執行 Lua 腳本），可直接執行本檔案或用 pytest 執行
+
+async def start_workers(count: int) -> list:
+    """建立共用同一個模擬 Redis 的多個後端，模擬多個 worker"""
+    server = fakeredis.FakeServer()
+    original = redis.asyncio.from_url
+    redis.asyncio.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+    try:
+        workers = [RedisStateBackend("redis://fake") for _ in range(count)]
+        for worker in workers:
+            await worker.start()
+    finally:
+        redis.asyncio.from_url = original
+    conversation_store.clear_messages()
+    return workers
+
+async def close_workers(workers: list) -> None:
+    for worker in workers:
+        await worker.close()
+
+async def wait_until(condition) -> None:
+    """等待其他 worker 收到通知"""
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("逾時仍未收到通知")
+
+def test_keys_do_not_collide():
+    """含有 ":" 或萬用字元的ID不會產生相同的鍵名，並可以從鍵名解析回來"""
+    backend = RedisStateBackend("redis://fake")
+    pairs = [("a:b", "c"), ("a", "b:c"), ("a*", "c"), ("1:a", "c"), ("", "x"), ("用戶", "角色:1")]
+    keys = [backend._keys(*pair) for pair in pairs]
+    assert len({key for triple in keys for key in triple}) == 3 * len(pairs)
+    for pair, triple in zip(pairs, keys):
+        for key in triple:
+            assert backend._parse_key(key) == pair
+    assert backend._parse_key("other:1:a:1:b:state") is None
+
+def test_scripts():
+    """Lua 腳本：分配序號並截斷列表、限制好感度範圍、記憶提取序號只前移、不覆蓋已有狀態、摘要移除已摺疊的消息"""
+    async def run():
+        worker, = await start_workers(1)
+        try:
+            user_id, character_id = "u:1", "c"
+            state_key, messages_key, _ = worker._keys(user_id, character_id)
+            capacity = conversation_store.message_capacity
+
+            messages = [await worker.append_message(user_id, character_id, "user", f"消息{i}")
+                        for i in range(capacity + 3)]
+            assert [message.seq for message in messages] == list(range(1, capacity + 4))
+            entries = await worker.client.lrange(messages_key, 0, -1)
+            assert len(entries) == capacity
+            assert worker._decode_message(entries[0]) == (4, "user", "消息3")
+
+            assert await worker.add_affinity(user_id, character_id, 200) == 100
+            assert await worker.add_affinity(user_id, character_id, -300) == 0
+            assert await worker.next_turn_id(user_id, character_id) == 1
+
+            # 記憶提取序號只會前移
+            await worker.advance_memory_seq(user_id, character_id, 5)
+            await worker.advance_memory_seq(user_id, character_id, 3)
+            assert (await worker.client.hget(state_key, "memory_seq")) == "5"
+            assert conversation_store.peek(user_id, character_id).memory_seq == 5
+
+            # 已有狀態時不覆蓋
+            seeded = await worker._scripts["seed"](keys=[state_key, messages_key], args=[60, 50, 9, 9, 0, ""])
+            assert seeded == 0
+            assert (await worker.client.hget(state_key, "message_seq")) == str(capacity + 3)
+
+            # 第一條消息序號不一致時不保存摘要
+            summary = {"text": "摘要", "folded_seq": 6}
+            assert not await worker.set_summary(user_id, character_id, summary, first_seq=1)
+            assert await worker.set_summary(user_id, character_id, summary, first_seq=4)
+            entries = await worker.client.lrange(messages_key, 0, -1)
+            assert worker._decode_message(entries[0])[0] == 7
+            assert json.loads(await worker.client.hget(state_key, "summary")) == summary
+            assert conversation_store.peek(user_id, character_id).messages[0].seq == 7
+        finally:
+            await close_workers([worker])
+    asyncio.run(run())
+
+def test_invalidation():
+    """一個 worker 修改對話後，其他 worker 將本地副本標記為過期並在下次存取時重新讀取"""
+    async def run():
+        first, second = await start_workers(2)
+        try:
+            key = ("u", "c")
+            await second.ensure_loaded(*key)
+            await first.append_message(*key, "user", "你好")
+            await wait_until(lambda: key in second._stale)
+            assert not second.is_loaded(*key)
+
+            # 模擬 second 的舊副本，重新載入後與 Redis 一致
+            conversation_store.clear_messages(*key)
+            await second.ensure_loaded(*key)
+            assert second.is_loaded(*key)
+            assert [message.content for message in conversation_store.peek(*key).messages] == ["你好"]
+
+            # 修改共享狀態時，過期的本地副本先重新讀取，不會以舊的序號覆蓋
+            await second.next_turn_id(*key)
+            await first.append_message(*key, "assistant", "嗨")
+            await wait_until(lambda: key in second._stale)
+            assert (await second.next_turn_id(*key)) == 2
+            conversation = conversation_store.peek(*key)
+            assert second.is_loaded(*key)
+            assert (conversation.turn_id, conversation.message_seq) == (2, 2)
+
+            # 清除通知直接清除其他 worker 的本地副本
+            await first.clear(*key)
+            await wait_until(lambda: second._stats["received"] >= 3)
+            assert not conversation_store.peek(*key).messages
+        finally:
+            await close_workers([first, second])
+    asyncio.run(run())
+
+def test_clear_only_matching_conversations():
+    """清除某個用戶（或某個角色）的對話時，不會清除ID恰好符合模式的其他對話"""
+    async def run():
+        worker, = await start_workers(1)
+        try:
+            conversations = [("a", "c"), ("a", "d"), ("a*", "c"), ("a:1", "c"), ("b", "a:c")]
+            for conversation in conversations:
+                await worker.append_message(*conversation, "user", "你好")
+
+            async def remaining():
+                return {conversation for conversation in conversations
+                        if await worker.client.exists(worker._keys(*conversation)[1])}
+
+            await worker.clear("a*")
+            assert await remaining() == set(conversations) - {("a*", "c")}
+            await worker.clear(None, "c")
+            assert await remaining() == {("a", "d"), ("b", "a:c")}
+            await worker.clear("a")
+            assert await remaining() == {("b", "a:c")}
+        finally:
+            await close_workers([worker])
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: 通過")
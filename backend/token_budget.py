@@ -0,0 +1,175 @@
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Any, List, Sequence, Tuple
+
+# 中日韓文字（含全形標點），大多數分詞器對它們大約每字一個 token 甚至更多
+CJK_PATTERN = re.compile(
+    r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+# 各供應商分詞器的初始估算係數：(每個中日韓字元的 token 數, 每個其他字元的 token 數)
+PROVIDER_TOKEN_RATIOS = {
+    "gemini": (0.8, 0.25),
+    "openai": (1.1, 0.25),
+    "claude": (1.3, 0.28),
+}
+DEFAULT_TOKEN_RATIOS = (1.2, 0.27)
+
+# 每條消息的格式開銷（角色標記、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 各供應商默認的輸入 token 預算（可用 <供應商>_INPUT_TOKEN_BUDGET 覆蓋）
+DEFAULT_INPUT_TOKEN_BUDGETS = {
+    "gemini": 8000,
+    "openai": 3000,
+    "claude": 8000,
+}
+
+@lru_cache(maxsize=4096)
+def _count_characters(text: str) -> Tuple[int, int]:
+    """計算文本中的 (中日韓字元數, 其他字元數)；同一段歷史每回合都會重新估算，因此緩存結果"""
+    cjk = len(text) - len(CJK_PATTERN.sub("", text))
+    return cjk, len(text) - cjk
+
+def count_characters(text: str) -> Tuple[int, int]:
+    """計算文本中的 (中日韓字元數, 其他字元數)，用於保存後再以 TokenEstimator.estimate_counts 估算"""
+    return _count_characters.__wrapped__(text)
+
+class CountedText(str):
+    """
+    預先計算好字元數的字串
+
+    用於每回合都會放進提示詞、但很少變動的長文本（例如格式化的記憶），
+    估算 token 數時直接使用保存的字元數，不需要重新掃描文本。
+    """
+
+    def __new__(cls, text: str):
+        obj = super().__new__(cls, text)
+        # 直接計算，不經過 lru_cache，避免長文本佔用緩存位置
+        obj.char_counts = count_characters(text)
+        return obj
+
+def get_input_token_budget(provider: str, override: int = None) -> int:
+    """
+    獲取供應商的輸入 token 預算
+
+    參數:
+        provider: 供應商名稱（gemini / openai / claude）
+        override: 模型設定中指定的預算（可選，優先使用）
+
+    返回:
+        輸入 token 預算
+    """
+    if override:
+        return int(override)
+    default = DEFAULT_INPUT_TOKEN_BUDGETS.get(provider, 4000)
+    return int(os.getenv(f"{provider.upper()}_INPUT_TOKEN_BUDGET", str(default)))
+
+class TokenEstimator:
+    """
+    不依賴分詞器的 token 估算器
+
+    以中日韓字元和其他字元的比例估算 token 數，並根據 API 回傳的實際用量
+    （usage 欄位）持續校正整體比例，讓估算逐漸貼近該供應商的分詞器。
+    """
+
+    # 校正比例的平滑係數和上下限
+    CALIBRATION_WEIGHT = 0.1
+    MIN_SCALE = 0.5
+    MAX_SCALE = 2.0
+
+    def __init__(self, provider: str):
+        """
+        初始化估算器
+
+        參數:
+            provider: 供應商名稱，決定初始估算係數
+        """
+        self.provider = provider
+        self.cjk_ratio, self.other_ratio = PROVIDER_TOKEN_RATIOS.get(provider, DEFAULT_TOKEN_RATIOS)
+        self.scale = 1.0
+        self._observations = 0
+
+    def estimate(self, text: str) -> int:
+        """
+        估算文本的 token 數
+
+        參數:
+            text: 文本
+
+        返回:
+            估算的 token 數
+        """
+        if not text:
+            return 0
+        return self.estimate_counts(*(getattr(text, "char_counts", None) or _count_characters(text)))
+
+    def estimate_counts(self, cjk: int, other: int) -> int:
+        """以預先計算的 (中日韓字元數, 其他字元數) 估算 token 數（見 count_characters）"""
+        return int((cjk * self.cjk_ratio + other * self.other_ratio) * self.scale) + 1
+
+    def estimate_messages(self, messages: Sequence[Dict[str, Any]]) -> int:
+        """估算消息列表（{"role", "content"}）的 token 數，包含每條消息的格式開銷"""
+        return sum(self.estimate(msg.get("content") or "") + MESSAGE_OVERHEAD_TOKENS for msg in messages)
+
+    def observe(self, estimated: int, actual: int) -> None:
+        """
+        以 API 回傳的實際輸入 token 數校正估算比例
+
+        參數:
+            estimated: 本次請求的估算 token 數（以目前的比例計算）
+            actual: API usage 欄位中的實際輸入 token 數
+        """
+        if not estimated or not actual:
+            return
+        ratio = self.scale * actual / estimated
+        self.scale += (ratio - self.scale) * self.CALIBRATION_WEIGHT
+        self.scale = max(self.MIN_SCALE, min(self.MAX_SCALE, self.scale))
+        self._observations += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取估算器的校正狀態"""
+        return {
+            "provider": self.provider,
+            "scale": round(self.scale, 3),
+            "observations": self._observations
+        }
+
+def select_history(chat_history: Sequence[Dict[str, Any]], budget: int, estimator: TokenEstimator,
+                   current_message: str = None, start_with_user: bool = True) -> List[Dict[str, Any]]:
+    """
+    從最新到最舊挑選能放進 token 預算的歷史消息
+
+    參數:
+        chat_history: 對話歷史（任何可以 reversed() 的序列，由舊到新）
+        budget: 可用於歷史的 token 數
+        estimator: 供應商的 token 估算器
+        current_message: 當前用戶消息（ChatManager 在呼叫處理器前已將它加入歷史，
+                         處理器會另外加入，因此位於歷史結尾時跳過）
+        start_with_user: 是否丟棄窗口開頭的非用戶消息（各供應商都要求對話由用戶開始）
+
+    返回:
+        由舊到新排列的歷史消息
+    """
+    selected = []
+    used = 0
+    skip_current = current_message is not None
+    for msg in reversed(chat_history):
+        if skip_current:
+            skip_current = False
+            if msg["role"] == "user" and msg["content"] == current_message:
+                continue
+        if msg["role"] == "system":
+            continue
+        cost = estimator.estimate(msg["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget:
+            break
+        used += cost
+        selected.append(msg)
+    selected.reverse()
+
+    if start_with_user:
+        while selected and selected[0]["role"] != "user":
+            selected.pop(0)
+    return selected